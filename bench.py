@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+"""
+Benchmark filesync against generated configs, with a localhost stand-in for
+ssh (and for rsync, if it is not installed) so no remote host is needed.
+
+Each scenario writes N files with a chosen size distribution, generates a
+filesync.conf for them, then times a cold push, a warm push with nothing
+changed, and a pull after some remote files changed.  For every run the
+wall time, spawned processes, bytes moved, literal bytes sent and per-entry
+latency percentiles are reported; '--json PATH' saves the results so runs
+can be compared.  '--transfer both' runs every scenario through rsync and
+through the native delta transfer, on the same generated files.
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+
+from configparser import ConfigParser
+from fs import fs
+
+# Stands in for ssh: skip the options, then run the command on this host
+SSH_STANDIN = r'''#!/usr/bin/env python3
+import os, sys
+args = sys.argv[1:]
+with open(os.environ["FILESYNC_BENCH_LOG"], "a") as log:
+    log.write("ssh\n")
+i = 0
+while i < len(args) and args[i].startswith("-"):
+    if args[i] == "-O":
+        sys.exit(0)
+    i += 2 if args[i] in ("-o", "-S", "-p", "-l", "-i", "-F", "-E") else 1
+if i + 1 >= len(args):
+    sys.exit(0)  # A master connection with nothing to run
+os.execvp("sh", ["sh", "-c", " ".join(args[i + 1:])])
+'''
+
+# Stands in for rsync when it is not installed: copies the sources filesync
+# passes (including --files-from lists) into the destination directory
+RSYNC_STANDIN = r'''#!/usr/bin/env python3
+import os, shutil, sys
+with open(os.environ["FILESYNC_BENCH_LOG"], "a") as log:
+    log.write("rsync\n")
+args, files_from, from0, paths, i = sys.argv[1:], None, False, [], 0
+while i < len(args):
+    if args[i] == "-e":
+        i += 1
+    elif args[i].startswith("--files-from="):
+        files_from = args[i].split("=", 1)[1]
+    elif args[i] == "--from0":
+        from0 = True
+    elif not args[i].startswith("-"):
+        p = args[i]
+        paths.append(p.split(":", 1)[1].replace("\\", "") if ":" in p and not p.startswith("/") else p)
+    i += 1
+srcs, dest = paths[:-1], paths[-1]
+if files_from:
+    with open(files_from) as f:
+        names = f.read().split("\0" if from0 else "\n")
+    srcs = [os.path.join(srcs[0], n) for n in names if n]
+rc = 0
+for src in srcs:
+    target = os.path.join(dest, os.path.basename(src)) if os.path.isdir(dest) else dest
+    try:
+        if not (os.path.exists(target) and os.path.samefile(src, target)):
+            shutil.copy2(src, target)
+    except OSError as e:
+        sys.stderr.write('rsync: link_stat "{0}" failed: {1} (2)\n'.format(src, e.strerror))
+        rc = 23
+sys.exit(rc)
+'''
+
+SCENARIOS = {
+    # name: (entries, function giving the size of entry i, name template)
+    "tiny saves": (200, lambda i, r: r.randint(512, 64 << 10), "save {}.srm"),
+    "large images": (3, lambda i, r: 256 << 20, "disk{}.img"),
+    "awkward names": (50, lambda i, r: r.randint(1 << 10, 256 << 10),
+                      "WWF No Mercy (U) (V1.{}) [!].mpk"),
+    "mixed": (100, lambda i, r: 64 << 20 if i % 25 == 0 else r.randint(512, 128 << 10),
+              "mixed {}.sav"),
+}
+
+
+def install_standins(bindir: str):
+    "Put the ssh (and, if needed, rsync) stand-ins first in $PATH."
+    standins = {"ssh": SSH_STANDIN}
+    if not shutil.which("rsync"):
+        standins["rsync"] = RSYNC_STANDIN
+    for name, source in standins.items():
+        path = os.path.join(bindir, name)
+        with open(path, "w") as f:
+            f.write(source)
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+    os.environ["PATH"] = bindir + os.pathsep + os.environ["PATH"]
+    return sorted(standins)
+
+
+def write_file(path: str, size: int, rng: random.Random):
+    with open(path, "wb") as f:
+        while size > 0:
+            n = min(size, 1 << 20)
+            f.write(rng.randbytes(n))
+            size -= n
+
+
+def make_config(root: str, entries: int, size_of, template: str, scale: float,
+                seed=0) -> ConfigParser:
+    "Write the local files for a scenario and return a config for them."
+    rng = random.Random(seed)
+    local, remote = os.path.join(root, "local"), os.path.join(root, "remote")
+    os.makedirs(local)
+    os.makedirs(remote)
+    c = ConfigParser()
+    c.read_dict({"global": {"remote host": "localhost"}, "local": {}, "remote": {}})
+    for i in range(entries):
+        name = template.format(i)
+        write_file(os.path.join(local, name), max(int(size_of(i, rng) * scale), 1), rng)
+        c["local"]["entry {}".format(i)] = os.path.join(local, name)
+        c["remote"]["entry {}".format(i)] = os.path.join(remote, name)
+    return c
+
+
+def snapshot(directory: str) -> dict:
+    return {e.path: (e.stat().st_size, e.stat().st_mtime_ns) for e in os.scandir(directory)}
+
+
+class ResultTimes(logging.Handler):
+    "Remember when each entry's result was logged."
+    def __init__(self):
+        super().__init__()
+        self.times = []
+
+    def emit(self, record):
+        msg = record.getMessage()
+        if "synced" in msg and "entries synced" not in msg or "Unable to sync" in msg:
+            self.times.append(time.monotonic())
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(round(p / 100 * (len(values) - 1))), len(values) - 1)]
+
+
+def run(config: ConfigParser, direction: str, log: str, state: str, **sync_opts) -> dict:
+    dest = os.path.dirname(next(iter(config["remote" if direction == "push" else "local"]
+                                     .values())))
+    before = snapshot(dest)
+    open(log, "w").close()
+    handler = ResultTimes()
+    logging.getLogger().addHandler(handler)
+    manifest = fs.Manifest(os.path.join(state, "manifest.json"))
+    literal = (fs._STATS.counters.get("delta literal bytes", 0)
+               + fs._STATS.rsync.get("literal data", 0))
+    start = time.monotonic()
+    results = fs.sync_files(config, direction, manifest=manifest, **sync_opts)
+    wall = time.monotonic() - start
+    fs.stop_agents()
+    fs.stop_ssh_masters()
+    logging.getLogger().removeHandler(handler)
+    after = snapshot(dest)
+    with open(log) as f:
+        spawned = f.read().split()
+    latencies = [t - start for t in handler.times]
+    return {
+        "direction": direction,
+        "entries": len(results),
+        "failed": len([v for v in results.values() if v is not True]),
+        "wall time": round(wall, 4),
+        "processes": {name: spawned.count(name) for name in sorted(set(spawned))},
+        "bytes moved": sum(size for path, (size, mtime) in after.items()
+                           if before.get(path) != (size, mtime)),
+        # What the native transfer sent as new data, or what rsync --stats reported
+        "literal bytes": fs._STATS.counters.get("delta literal bytes", 0)
+        + fs._STATS.rsync.get("literal data", 0) - literal,
+        "latency": {"p50": round(percentile(latencies, 50), 4),
+                    "p90": round(percentile(latencies, 90), 4),
+                    "p99": round(percentile(latencies, 99), 4)},
+    }
+
+
+def bench_scenario(name: str, scale: float, **sync_opts) -> list:
+    entries, size_of, template = SCENARIOS[name]
+    root = tempfile.mkdtemp(prefix="filesync-bench-")
+    try:
+        config = make_config(root, entries, size_of, template, scale)
+        log, state = os.path.join(root, "spawned.log"), os.path.join(root, "state")
+        os.environ["FILESYNC_BENCH_LOG"] = log
+        runs = [("push (cold)", run(config, "push", log, state, **sync_opts)),
+                ("push (warm)", run(config, "push", log, state, **sync_opts))]
+        # Change a tenth of the remote copies, then pull them back
+        for i, path in enumerate(config["remote"].values()):
+            if i % 10 == 0:
+                with open(path, "ab") as f:
+                    f.write(b"changed")
+        runs.append(("pull (10% changed)", run(config, "pull", log, state, **sync_opts)))
+        return [dict(r, scenario=name, run=label, transfer=sync_opts.get("transfer", "rsync"))
+                for label, r in runs]
+    finally:
+        shutil.rmtree(root)
+
+
+def print_table(results: list):
+    print("{0:<16} {1:<19} {2:<8} {3:>7} {4:>9} {5:>6} {6:>12} {7:>12} {8:>8} {9:>8}".format(
+        "scenario", "run", "transfer", "entries", "wall (s)", "procs", "bytes", "literal",
+        "p50 (s)", "p99 (s)"))
+    for r in results:
+        print("{0:<16} {1:<19} {2:<8} {3:>7} {4:>9.3f} {5:>6} {6:>12} {7:>12} {8:>8.3f} "
+              "{9:>8.3f}".format(
+                  r["scenario"], r["run"], r["transfer"], r["entries"], r["wall time"],
+                  sum(r["processes"].values()), r["bytes moved"], r["literal bytes"],
+                  r["latency"]["p50"], r["latency"]["p99"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark filesync on this host.")
+    parser.add_argument("scenarios", nargs="*", default=sorted(SCENARIOS),
+                        help="Scenarios to run (default: all of {})".format(
+                            ", ".join(sorted(SCENARIOS))))
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="Multiply every generated file size by this")
+    parser.add_argument("--batch", action="store_true", help="Use batched rsync runs")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Run up to N syncs at once")
+    parser.add_argument("--small-file-size", type=int, default=0,
+                        help="Send files under this many bytes as one archive")
+    parser.add_argument("--transfer", choices=("rsync", "native", "both"), default="rsync",
+                        help="Send files with rsync, the native delta transfer, or both in turn")
+    parser.add_argument("--json", metavar="PATH", help="Save the results as JSON")
+    args = parser.parse_args()
+
+    bindir = tempfile.mkdtemp(prefix="filesync-bench-bin-")
+    standins = install_standins(bindir)
+    # Result lines are INFO; let them reach ResultTimes without printing them
+    logging.basicConfig(format=fs.LOGFMT, level=logging.INFO, stream=sys.stderr)
+    logging.getLogger().handlers[0].setLevel(logging.WARN)
+    sync_opts = dict(batch=args.batch, jobs=args.jobs, small_file_size=args.small_file_size)
+    transfers = ["rsync", "native"] if args.transfer == "both" else [args.transfer]
+    results = []
+    try:
+        for name in args.scenarios:
+            for transfer in transfers:
+                results += bench_scenario(name, args.scale, transfer=transfer, **sync_opts)
+    finally:
+        shutil.rmtree(bindir)
+    print_table(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"options": dict(sync_opts, transfer=args.transfer), "scale": args.scale,
+                       "stand-ins": standins,
+                       "python": sys.version.split()[0],
+                       "rsync": subprocess.getoutput("rsync --version").splitlines()[0]
+                       if "rsync" not in standins else None,
+                       "results": results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
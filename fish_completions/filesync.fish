@@ -2,14 +2,30 @@
 
 set c filesync
 
+complete -c $c -l batch -d "Sync all entries that share a destination directory with one rsync"
+complete -c $c -l bwlimit -r -d "Limit the bandwidth of each large file's rsync to RATE"
 complete -c $c -l clean -d "Clean up backup files created during sync"
 complete -c $c -l conf -s c -d "Optionally specify a config file."
+complete -c $c -l durability -x -a "none batch file" -d "Flush received files to disk never, in batches, or one by one"
+complete -c $c -l execute-plan -r -d "Make the transfers in a plan saved with --plan-out"
 complete -c $c -l force -d "Force removal of backup files when 'gvfs-trash' is not available"
 complete -c $c -l help -s h -d "Show the help and exit"
-complete -c $c -l host -s H -d "Specify a remote host to sync to"
+complete -c $c -l host -s H -d "Specify a remote host to sync to; repeat it to sync to several"
+complete -c $c -l jobs -s j -d "Run up to N syncs at the same time"
 complete -c $c -l local-file -s L -d "Specify a local file to sync when pushing"
+complete -c $c -l log-json -r -d "Also write every log message to PATH as JSON lines"
+complete -c $c -l no-manifest -d "Sync every entry, even those unchanged since their last sync"
+complete -c $c -l no-multiplex -d "Open a new ssh connection for every remote operation"
+complete -c $c -l parallel-hosts -d "Sync with up to N remote hosts at the same time"
+complete -c $c -l plan -d "Show what --push, --pull or --sync would do, without doing it"
+complete -c $c -l plan-out -r -d "Save the plan to PATH (implies --plan)"
+complete -c $c -l rehash -d "Hash every local file again instead of using cached digests"
 complete -c $c -l remote-file -s R -d "Specify a remote file to sync when pulling"
+complete -c $c -l stats-json -r -d "Write timings and process counts for the run to PATH"
+complete -c $c -l transfer -x -a "rsync native" -d "Send files with rsync or with filesync's own delta transfer"
 complete -c $c -l pull -d "Sync files from the remote to your local"
 complete -c $c -l push -d "Sync files from your local to the remote"
+complete -c $c -l sync -d "Push or pull each file, whichever side changed since the last sync"
+complete -c $c -l watch -d "Keep running and push local files to the remote as they change"
 complete -c $c -l verbose -s v -d "Show extra logging messages"
 complete -c $c -l version -d "Show the version number and exit"
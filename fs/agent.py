@@ -0,0 +1,1076 @@
+"""
+The filesync agent: the stat, hash, backup, scan and transfer work that
+filesync does on each host.  It is imported for use on this host, and its
+source is sent over ssh to be run by 'python3' on each remote host for the
+whole run (see RemoteAgent in fs.py), so it only uses the standard library.
+
+Requests and responses are frames of a 4-byte big-endian length, a JSON
+header and, when the header has a non-zero "size", that many bytes of
+payload.  Batched ops return {"results": ..., "errors": ...} maps.
+"""
+import errno
+import fnmatch
+import hashlib
+import io
+import itertools
+import json
+import os
+import re
+import shutil
+import stat
+import struct
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import zlib
+
+FICLONE = 0x40049409
+STORE_LOCK = threading.Lock()
+
+
+def recv(stream):
+    n = stream.read(4)
+    if len(n) < 4:
+        return None, b""
+    header = json.loads(stream.read(struct.unpack(">I", n)[0]).decode())
+    return header, stream.read(header["size"]) if header.get("size") else b""
+
+
+def send(stream, header, payload=b""):
+    header["size"] = len(payload)
+    data = json.dumps(header).encode()
+    stream.write(struct.pack(">I", len(data)) + data)
+    stream.write(payload)
+    stream.flush()
+
+
+def batch(fn, items):
+    results, errors = {}, {}
+    for item in items:
+        path = item[0] if isinstance(item, list) else item
+        try:
+            results[path] = fn(item)
+        except (OSError, KeyError, shutil.Error, tarfile.TarError) as e:
+            errors[path] = getattr(e, "strerror", None) or str(e)
+    return {"results": results, "errors": errors}
+
+
+def sha(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+CHUNK_SIZE = 1 << 23  # Bytes per chunk of a tree digest
+TREE_SIZE = 1 << 26  # Files this big or bigger get a tree digest
+
+
+def chunk_digests(path, algorithm="sha256", workers=None, chunk=None):
+    """
+    Return the 'algorithm' hex digest of each 'chunk' sized (CHUNK_SIZE by
+    default) piece of 'path'.  The chunks are read with pread() and hashed
+    by a pool of threads, which hashlib lets run in parallel.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    chunk = chunk or CHUNK_SIZE
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+
+        def one(i):
+            return hashlib.new(algorithm, os.pread(fd, chunk, i * chunk)).hexdigest()
+        with ThreadPoolExecutor(max_workers=workers or min(os.cpu_count() or 1, 16)) as pool:
+            return list(pool.map(one, range(max((size + chunk - 1) // chunk, 1))))
+    finally:
+        os.close(fd)
+
+
+def tree_digest(chunks, algorithm="sha256"):
+    "Combine the chunk digests of a file into its digest."
+    return hashlib.new(algorithm, "".join(chunks).encode()).hexdigest()
+
+
+def file_digest(path, algorithm="sha256", tree=True):
+    """
+    Return the digest of 'path': a plain 'algorithm' digest (so a sha256 is
+    what sha256sum gives) for files under TREE_SIZE, a tree_digest() of its
+    chunks for bigger ones unless 'tree' is False.
+    """
+    if tree and os.path.getsize(path) >= TREE_SIZE:
+        return tree_digest(chunk_digests(path, algorithm), algorithm)
+    h = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def meta(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns, stat.S_ISREG(st.st_mode)]
+
+
+def clone_file(src, dest):
+    "Copy 'src' to 'dest', sharing blocks through a reflink or copy_file_range() if possible."
+    with open(src, "rb") as fin, open(dest, "wb") as fout:
+        try:
+            import fcntl
+            fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+            return
+        except (ImportError, OSError):
+            pass
+        try:
+            size, copied = os.fstat(fin.fileno()).st_size, 0
+            while copied < size:
+                n = os.copy_file_range(fin.fileno(), fout.fileno(), size - copied)
+                if not n:
+                    break
+                copied += n
+            return
+        except (AttributeError, OSError):
+            fin.seek(0)
+            fout.seek(0)
+            fout.truncate()
+        shutil.copyfileobj(fin, fout, 1 << 20)
+
+
+def clone_new(src, dest):
+    "Clone 'src' into a temp file next to 'dest' and rename it to 'dest'."
+    tmp = stage_file(dest, b"")
+    try:
+        clone_file(src, tmp)
+        shutil.copystat(src, tmp)
+        os.replace(tmp, dest)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def link_or_clone(src, dest):
+    """
+    Hardlink 'src' at 'dest', or clone it where the filesystem cannot link
+    it.  An existing 'dest' is an error, never written through.
+    """
+    try:
+        os.link(src, dest)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        clone_new(src, dest)
+
+
+def free_name(path):
+    "Return 'path', or 'path.N' with the lowest N that is not taken."
+    name, n = path, 0
+    while os.path.lexists(name):
+        n += 1
+        name = "{0}.{1}".format(path, n)
+    return name
+
+
+def load_index(store):
+    try:
+        with open(os.path.join(store, "index.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_index(store, index):
+    os.makedirs(store, exist_ok=True)
+    os.replace(stage_file(os.path.join(store, "index.json"), json.dumps(index).encode()),
+               os.path.join(store, "index.json"))
+
+
+def store_object(store, path):
+    "Add the regular file at 'path' to 'store' unless its content is already there."
+    digest = sha(path)
+    obj = os.path.join(store, "objects", digest[:2], digest)
+    if not os.path.exists(obj):
+        os.makedirs(os.path.dirname(obj), exist_ok=True)
+        tmp = obj + ".tmp"
+        clone_file(path, tmp)
+        shutil.copystat(path, tmp)
+        os.replace(tmp, obj)
+    return digest, obj
+
+
+def same_device(store, path):
+    "Whether 'path' is on the filesystem of 'store', so it can be hardlinked from there."
+    os.makedirs(store, exist_ok=True)
+    return os.stat(store).st_dev == os.stat(os.path.dirname(os.path.abspath(path))).st_dev
+
+
+def backup(path, suffix, store, key=None):
+    """
+    Back 'path' up as 'path' + 'suffix', or 'path' + 'suffix' + '.N' if a
+    backup was already made under that name.  Regular files are kept once per
+    distinct content in 'store' and the backup is a hardlink of that copy.
+    A file on another filesystem than the store could not be linked from it,
+    so its backup is the only copy (a reflink where possible) and is not
+    stored.  Every backup is recorded in the store's index.
+    """
+    dest = free_name(path + suffix)
+    store = os.path.expanduser(store)
+    stored = False
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.copytree(path, dest, symlinks=True)
+        digest = None
+    elif os.path.isfile(path) and not os.path.islink(path):
+        if same_device(store, path):
+            digest, obj = store_object(store, path)
+            link_or_clone(obj, dest)
+            stored = True
+        else:
+            digest = sha(path)
+            clone_new(path, dest)
+    else:
+        shutil.copy2(path, dest, follow_symlinks=False)
+        digest = None
+    with STORE_LOCK:
+        index = load_index(store)
+        index.setdefault(os.path.abspath(path), []).append(
+            {"key": key, "backup": os.path.abspath(dest), "digest": digest, "stored": stored,
+             "size": os.lstat(dest).st_size, "time": time.time()})
+        save_index(store, index)
+    return dest
+
+
+def versions(path, store):
+    "Return every recorded backup of 'path', oldest first."
+    return load_index(os.path.expanduser(store)).get(os.path.abspath(path), [])
+
+
+def restore(path, digest, store):
+    """
+    Put the stored content with 'digest' back at 'path', or the content of
+    a backup of it with that digest that was not stored.
+    """
+    obj = os.path.join(os.path.expanduser(store), "objects", digest[:2], digest)
+    if not os.path.exists(obj):
+        obj = next((r["backup"] for r in versions(path, store)
+                    if r["digest"] == digest and os.path.isfile(r["backup"])), obj)
+    tmp = stage_file(path, b"")
+    try:
+        clone_file(obj, tmp)
+        shutil.copystat(obj, tmp)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return path
+
+
+def stage_file(path, data, mode=None, mtime=None):
+    "Write 'data' to a temp file next to 'path' and return the temp file's name."
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".filesync-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        if mode is not None:
+            os.chmod(tmp, mode)
+        if mtime is not None:
+            os.utime(tmp, ns=(mtime, mtime))
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return tmp
+
+
+def write_file(path, data, mode=None, mtime=None, durability="none"):
+    "Write 'data' to 'path' through a temp file in the same directory and a rename."
+    commit({path: stage_file(path, data, mode, mtime)}, durability)
+
+
+def fsync_path(path):
+    "Flush the file or directory at 'path' to disk."
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def commit(staged, durability="none"):
+    """
+    Rename each temp file in 'staged', a dict of paths and the temp files
+    staged next to them, over its path.  With a 'durability' of "file", each
+    temp file is flushed to disk before its rename and its directory after
+    it; with "batch", all of the temp files are flushed, then all renamed,
+    then each directory flushed once; with "none", nothing is flushed.  Temp
+    files not yet renamed when something fails are removed.
+    """
+    done = set()
+    try:
+        if durability == "batch":
+            for tmp in staged.values():
+                fsync_path(tmp)
+        for path, tmp in staged.items():
+            if durability == "file":
+                fsync_path(tmp)
+            os.replace(tmp, path)
+            done.add(path)
+            if durability == "file":
+                fsync_path(os.path.dirname(path) or ".")
+    except BaseException:
+        for path, tmp in staged.items():
+            if path not in done and os.path.exists(tmp):
+                os.unlink(tmp)
+        raise
+    if durability == "batch":
+        for directory in sorted({os.path.dirname(path) or "." for path in staged}):
+            fsync_path(directory)
+
+
+def flush(paths):
+    """
+    Flush each of 'paths' to disk, then each of their directories once, so
+    the renames that put them there last too.  A directory that cannot be
+    flushed counts as an error for every path in it.
+    """
+    result = batch(lambda path: fsync_path(os.path.expanduser(path)), paths)
+    dirs = {}
+    for path in result["results"]:
+        dirs.setdefault(os.path.dirname(os.path.expanduser(path)) or ".", []).append(path)
+    for directory, dir_paths in sorted(dirs.items()):
+        try:
+            fsync_path(directory)
+        except OSError as e:
+            for path in dir_paths:
+                del result["results"][path]
+                result["errors"][path] = e.strerror
+    return result
+
+
+def pack_archive(paths):
+    """
+    Return a tar of 'paths' with members named by their index, plus the batch
+    result.  Paths that are not regular files themselves (symlinks included)
+    are not packed but listed in the result's "skipped", for rsync to send.
+    """
+    buf = io.BytesIO()
+    skipped = []
+    with tarfile.open(fileobj=buf, mode="w", format=tarfile.PAX_FORMAT) as tar:
+        def add(item):
+            path, name = item
+            if not stat.S_ISREG(os.lstat(path).st_mode):
+                skipped.append(path)
+                return None
+            info = tar.gettarinfo(path, arcname=name)
+            # The header's mtime is a float; keep the exact one alongside it
+            info.pax_headers["filesync.mtime_ns"] = str(os.stat(path).st_mtime_ns)
+            if info.isreg():
+                with open(path, "rb") as f:
+                    tar.addfile(info, f)
+            else:
+                tar.addfile(info)
+            return name
+        result = batch(add, [[path, str(i)] for i, path in enumerate(paths)])
+    for path in skipped:
+        result["results"].pop(path, None)
+    result["skipped"] = skipped
+    return result, buf.getvalue()
+
+
+def unpack_archive(data, files, durability="none"):
+    """
+    Extract a tar made by pack_archive(), where 'files' maps member names to
+    their destination paths.  Every member is staged next to its destination
+    first and only then renamed into place with commit() at 'durability',
+    keeping its mode and mtime.
+    """
+    staged = {}
+    with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+        members = {m.name: m for m in tar.getmembers()}
+
+        def stage(name):
+            member = members[name]
+            mtime = member.pax_headers.get("filesync.mtime_ns")
+            staged[files[name]] = stage_file(files[name], tar.extractfile(member).read(),
+                                             member.mode,
+                                             int(mtime) if mtime else int(member.mtime * 1e9))
+            return member.size
+        result = batch(stage, list(files))
+    commit(staged, durability)
+    # Report by destination path rather than member name
+    result["results"] = {files[n]: size for n, size in result["results"].items()}
+    result["errors"] = {files[n]: error for n, error in result["errors"].items()}
+    return result
+
+
+def op_clean(req, payload):
+    return clean(req["paths"], req["store"], req.get("force", False), req.get("keep_last"),
+                 req.get("keep_days"), req.get("max_size")), b""
+
+
+def op_pack(req, payload):
+    return pack_archive(req["paths"])
+
+
+def op_unpack(req, payload):
+    return unpack_archive(payload, req["files"], req.get("durability", "none")), b""
+
+
+def op_sha(req, payload):
+    return batch(lambda path: file_digest(path, req.get("algorithm", "sha256"),
+                                          req.get("tree", True)), req["paths"]), b""
+
+
+def op_stat(req, payload):
+    missing = set()
+
+    def _meta(path):
+        try:
+            return meta(path)
+        except (FileNotFoundError, NotADirectoryError):
+            missing.add(path)
+            raise
+    found = batch(_meta, req["paths"])
+    if req.get("missing_ok"):
+        # Paths that do not exist are no error, just absent from the results
+        found["errors"] = {p: e for p, e in found["errors"].items() if p not in missing}
+    return found, b""
+
+
+def glob_match(parts, pattern):
+    "Match path 'parts' against glob 'pattern' parts; '**' matches any number of directories."
+    if not pattern:
+        return not parts
+    if pattern[0] == "**":
+        return any(glob_match(parts[i:], pattern[1:]) for i in range(len(parts) + 1))
+    return bool(parts) and fnmatch.fnmatchcase(parts[0], pattern[0]) \
+        and glob_match(parts[1:], pattern[1:])
+
+
+def glob_prefix(parts, pattern):
+    "Return True if files under the directory 'parts' could match glob 'pattern' parts."
+    for i, part in enumerate(parts):
+        if i >= len(pattern):
+            return False
+        if pattern[i] == "**":
+            return True
+        if not fnmatch.fnmatchcase(part, pattern[i]):
+            return False
+    return len(parts) < len(pattern)
+
+
+def scan_tree(root, pattern=None, dirs=False):
+    """
+    Yield '[relpath, size, mtime_ns]' for each regular file under 'root' that
+    matches the glob 'pattern' parts (every file if there are none.)  Only
+    one directory is read at a time, and only the directories still to be
+    read are kept, so memory does not grow with the number of files.  With
+    'dirs', each directory read is followed by '[relpath, None, subdirs]',
+    naming the subdirectories that will be read.
+    """
+    root = os.path.expanduser(root)
+    pending = [[]]
+    while pending:
+        parts = pending.pop()
+        try:
+            it = os.scandir(os.path.join(root, *parts))
+        except OSError:
+            continue
+        subdirs = []
+        with it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if not pattern or glob_prefix(parts + [entry.name], pattern):
+                            pending.append(parts + [entry.name])
+                            subdirs.append(entry.name)
+                    elif entry.is_file() and (not pattern or glob_match(parts + [entry.name], pattern)):
+                        st = entry.stat()
+                        yield ["/".join(parts + [entry.name]), st.st_size, st.st_mtime_ns]
+                except OSError:
+                    continue
+        if dirs:
+            yield ["/".join(parts), None, subdirs]
+
+
+SCANS = {}
+SCAN_IDS = itertools.count()
+
+
+def op_scan(req, payload):
+    "A page of up to 'limit' scan_tree() files; send the returned 'scan' back for the next."
+    scan = req.get("scan")
+    if scan is None:
+        scan = next(SCAN_IDS)
+        SCANS[scan] = scan_tree(req["root"], req.get("pattern"), req.get("dirs", False))
+    files = list(itertools.islice(SCANS[scan], req["limit"]))
+    done = len(files) < req["limit"]
+    if done:
+        del SCANS[scan]
+    return {"scan": scan, "files": files, "done": done}, b""
+
+
+DELTA_OPS = 1 << 14  # Most ops per delta request
+DELTA_WINDOW = 1 << 22  # Bytes of literal data per delta request
+DELTA_SEARCH = 8  # Of each run of this many unmatched blocks, only one is searched byte by byte
+
+
+def block_size(size):
+    "The delta block size for a basis file of 'size' bytes: about its square root."
+    return min(max(int(size ** 0.5) & ~1023, 2048), 1 << 17)
+
+
+def weak_sum(block):
+    "The Adler-32 checksum of 'block' as its '(a, b)' halves, which delta() rolls along."
+    v = zlib.adler32(block)
+    return v & 0xffff, v >> 16
+
+
+def strong_sum(block):
+    return hashlib.blake2b(block, digest_size=16).hexdigest()
+
+
+def signature(path):
+    """
+    Return '{"block": n, "sums": [[weak, strong], ...]}' for each n-byte block
+    of the basis file 'path'; there are no sums if it does not exist yet.
+    """
+    try:
+        f = open(os.path.expanduser(path), "rb")
+    except FileNotFoundError:
+        return {"block": block_size(0), "sums": []}
+    with f:
+        n = block_size(os.fstat(f.fileno()).st_size)
+        sums = []
+        for block in iter(lambda: f.read(n), b""):
+            sums.append([zlib.adler32(block), strong_sum(block)])
+    return {"block": n, "sums": sums}
+
+
+def delta(path, block, sums):
+    """
+    Yield '(ops, data, final)' windows of the delta that turns the basis file
+    with 'block' sized blocks and signature 'sums' into the file at 'path'.
+    An op is ["c", i] to copy basis block i or ["d", n] to take the next n
+    bytes of 'data'.  'final' is None until the last window, which gives the
+    file's sha256, mode and mtime_ns.  After a match the next one is looked
+    for at every byte with the rolling checksum for two blocks, which finds
+    the old data again after a small edit.  Past that, only one block in
+    every DELTA_SEARCH is searched byte by byte and the rest are checked at
+    their start; any block's worth of offsets includes the one where shifted
+    old data lines up again, so new data costs a fraction of a full scan.  About two windows
+    of the file are held at a time.
+    """
+    table = {}
+    for i, (weak, strong) in enumerate(sums):
+        table.setdefault(weak, {}).setdefault(strong, i)
+    h = hashlib.sha256()
+    with open(os.path.expanduser(path), "rb") as f:
+        st = os.fstat(f.fileno())
+        buf, pos, run, eof = b"", 0, 0, False
+        ops, data, size, misses, rolling = [], [], 0, 0, None
+        while True:
+            if not eof and len(buf) - pos <= block:
+                chunk = f.read(DELTA_WINDOW)
+                h.update(chunk)
+                eof = not chunk
+                buf, pos, run = buf[run:] + chunk, pos - run, 0
+            if pos >= len(buf):
+                break
+            end = min(pos + block, len(buf))
+            if rolling is None:
+                rolling = weak_sum(buf[pos:end])
+            a, b = rolling
+            found = table.get(a | b << 16)
+            match = found.get(strong_sum(buf[pos:end])) if found else None
+            if match is not None:
+                if run < pos:
+                    ops.append(["d", pos - run])
+                    data.append(buf[run:pos])
+                    size += pos - run
+                ops.append(["c", match])
+                pos = run = end
+                misses, rolling = 0, None
+            elif not table or end == len(buf) or \
+                    misses >= 2 * block and misses // block % DELTA_SEARCH:
+                misses += end - pos
+                pos, rolling = end, None
+            else:
+                out, new = buf[pos], buf[end]
+                a = (a - out + new) % 65521
+                rolling = a, (b - block * out + a - 1) % 65521
+                pos += 1
+                misses += 1
+            if pos - run >= DELTA_WINDOW:
+                ops.append(["d", pos - run])
+                data.append(buf[run:pos])
+                size += pos - run
+                run = pos
+            if size >= DELTA_WINDOW or len(ops) >= DELTA_OPS:
+                yield ops, b"".join(data), None
+                ops, data, size = [], [], 0
+        if run < pos:
+            ops.append(["d", pos - run])
+            data.append(buf[run:pos])
+    yield ops, b"".join(data), {"digest": h.hexdigest(), "mode": stat.S_IMODE(st.st_mode),
+                                "mtime": st.st_mtime_ns}
+
+
+class Patch:
+    """
+    A file being rebuilt next to 'path' from delta() windows, out of its old
+    'block' sized blocks and new data, and renamed over it once complete.
+    """
+    def __init__(self, path, block):
+        self.path, self.block = os.path.expanduser(path), block
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        fd, self.tmp = tempfile.mkstemp(dir=os.path.dirname(self.path) or ".",
+                                        prefix=".filesync-")
+        self.out = os.fdopen(fd, "wb")
+        try:
+            self.basis = open(self.path, "rb")
+        except FileNotFoundError:
+            self.basis = None
+        self.hash = hashlib.sha256()
+
+    def apply(self, ops, data):
+        data, offset = memoryview(data), 0
+        for kind, n in ops:
+            if kind == "c":
+                self.basis.seek(n * self.block)
+                chunk = self.basis.read(self.block)
+            else:
+                chunk = data[offset:offset + n]
+                offset += n
+            self.out.write(chunk)
+            self.hash.update(chunk)
+
+    def _close(self):
+        self.out.close()
+        if self.basis:
+            self.basis.close()
+
+    def finish(self, digest, mode, mtime, durability="none"):
+        """
+        Check the rebuilt file against the sender's 'digest', then rename it
+        into place with commit() at 'durability'.
+        """
+        self._close()
+        if self.hash.hexdigest() != digest:
+            os.unlink(self.tmp)
+            raise ValueError("{}: rebuilt file does not match its source".format(self.path))
+        os.chmod(self.tmp, mode)
+        os.utime(self.tmp, ns=(mtime, mtime))
+        commit({self.path: self.tmp}, durability)
+
+    def abort(self):
+        self._close()
+        os.unlink(self.tmp)
+
+
+COMPRESS_PROBE = 1 << 16  # Bytes at the start of a file compressed to see how well it does
+
+
+def probe(path, levels):
+    "Return how small the start of 'path' gets, compressed at each of 'levels', as fractions."
+    with open(os.path.expanduser(path), "rb") as f:
+        sample = f.read(COMPRESS_PROBE)
+    if not sample:
+        return [1.0 for level in levels]
+    return [round(len(zlib.compress(sample, level)) / len(sample), 4) for level in levels]
+
+
+def op_probe(req, payload):
+    return batch(lambda path: probe(path, req["levels"]), req["paths"]), b""
+
+
+DELTAS, PATCHES = {}, {}
+DELTA_IDS = itertools.count()
+
+
+def op_signature(req, payload):
+    return batch(signature, req["paths"]), b""
+
+
+def op_delta(req, payload):
+    """
+    The next delta() window of 'path'; send the returned 'delta' back for
+    the one after, or with 'abort' to stop early.
+    """
+    d = req.get("delta")
+    if req.get("abort"):
+        DELTAS.pop(d).close()
+        return {"delta": d}, b""
+    if d is None:
+        d = next(DELTA_IDS)
+        DELTAS[d] = delta(req["path"], req["block"], req["sums"])
+    try:
+        ops, data, final = next(DELTAS[d])
+    except BaseException:
+        del DELTAS[d]
+        raise
+    if final:
+        del DELTAS[d]
+    if req.get("compress") and data:
+        return {"delta": d, "ops": ops, "final": final, "compressed": True}, \
+            zlib.compress(data, req["compress"])
+    return {"delta": d, "ops": ops, "final": final}, data
+
+
+def op_patch(req, payload):
+    """
+    Apply a delta() window to 'path', 'compressed' with zlib if so.  The
+    first request starts a Patch and returns the 'patch' to send with the
+    rest; the one with a 'final' renames the file into place (flushing it
+    to disk at 'durability'), and one with 'abort' throws it away.
+    """
+    p = req.get("patch")
+    if p is None:
+        p = next(DELTA_IDS)
+        PATCHES[p] = Patch(req["path"], req["block"])
+    patch = PATCHES[p]
+    try:
+        if req.get("abort"):
+            patch.abort()
+        else:
+            patch.apply(req["ops"], zlib.decompress(payload) if req.get("compressed") else payload)
+            if req.get("final"):
+                patch.finish(durability=req.get("durability", "none"), **req["final"])
+    except BaseException:
+        del PATCHES[p]
+        if not req.get("abort"):
+            patch.abort()
+        raise
+    if req.get("final") or req.get("abort"):
+        del PATCHES[p]
+    return {"patch": p}, b""
+
+
+def chunk_info(path, algorithm):
+    "Return what a resumable transfer of 'path' needs to know about it."
+    path = os.path.expanduser(path)
+    st = os.stat(path)
+    return {"size": st.st_size, "mode": stat.S_IMODE(st.st_mode), "mtime": st.st_mtime_ns,
+            "chunk": CHUNK_SIZE, "chunks": chunk_digests(path, algorithm)}
+
+
+def partial_paths(path):
+    "The partial file and the journal a resumable transfer into 'path' keeps next to it."
+    directory, name = os.path.split(os.path.expanduser(path))
+    return (os.path.join(directory, ".{}.filesync-partial".format(name)),
+            os.path.join(directory, ".{}.filesync-journal".format(name)))
+
+
+def load_journal(journal):
+    try:
+        with open(journal) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def op_chunks(req, payload):
+    return batch(lambda path: chunk_info(path, req["algorithm"]), req["paths"]), b""
+
+
+def seed_partial(path, part, source):
+    """
+    Copy the chunks of the existing file at 'path' that already match the
+    'source' chunk digests into the new partial file 'part', so only the
+    rest need to be sent.  Returns the indices of the chunks copied.
+    """
+    try:
+        digests = chunk_digests(path, source["algorithm"], chunk=source["chunk"])
+    except OSError:
+        return []
+    have = [i for i, (old, new) in enumerate(zip(digests, source["chunks"])) if old == new]
+    if have:
+        with open(path, "rb") as fin, open(part, "r+b") as fout:
+            for i in have:
+                data = os.pread(fin.fileno(), source["chunk"], i * source["chunk"])
+                os.pwrite(fout.fileno(), data, i * source["chunk"])
+            os.fsync(fout.fileno())
+    return have
+
+
+def op_resume(req, payload):
+    """
+    Start receiving 'path' in chunks, or carry on with an earlier transfer of
+    it.  The journal next to it records the source's chunk digests and which
+    chunks of the partial file were written and verified; those that still
+    match the source's are kept.  A new transfer starts from the chunks of
+    the existing 'path' that match the source's.  Returns the 'missing'
+    chunks, which are all that still need to be sent.
+    """
+    path = os.path.expanduser(req["path"])
+    part, journal = partial_paths(path)
+    source = {k: req[k] for k in ("algorithm", "chunk", "chunks")}
+    state, have = load_journal(journal), []
+    if state and os.path.exists(part) and \
+            all(state[k] == source[k] for k in ("algorithm", "chunk")):
+        # Journals from before 'have' recorded a prefix of 'done' chunks
+        have = [i for i in state.get("have", range(state.get("done", 0)))
+                if i < len(source["chunks"]) and state["chunks"][i] == source["chunks"][i]]
+    else:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        open(part, "wb").close()
+        if os.path.isfile(path):
+            have = seed_partial(path, part, source)
+    write_file(journal, json.dumps(dict(source, have=have)).encode())
+    return {"missing": sorted(set(range(len(source["chunks"]))) - set(have))}, b""
+
+
+def op_fetch(req, payload):
+    "Read chunk 'index' of 'path' for a resumable transfer, compressed at level 'compress' if set."
+    with open(os.path.expanduser(req["path"]), "rb") as f:
+        data = os.pread(f.fileno(), req["chunk"], req["index"] * req["chunk"])
+    if req.get("compress"):
+        return {"compressed": True}, zlib.compress(data, req["compress"])
+    return {}, data
+
+
+def op_chunk(req, payload):
+    """
+    Write chunk 'index' of 'path' into its partial file, once it matches the
+    digest the journal has for it, and record it in the journal.
+    """
+    part, journal = partial_paths(req["path"])
+    state = load_journal(journal)
+    data = zlib.decompress(payload) if req.get("compressed") else payload
+    i = req["index"]
+    if state is None or "have" not in state or not 0 <= i < len(state["chunks"]):
+        raise ValueError("{}: no transfer of chunk {} started".format(req["path"], i))
+    if hashlib.new(state["algorithm"], data).hexdigest() != state["chunks"][i]:
+        raise ValueError("{}: chunk {} does not match its source".format(req["path"], i))
+    fd = os.open(part, os.O_WRONLY)
+    try:
+        os.pwrite(fd, data, i * state["chunk"])
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    state["have"] = sorted(set(state["have"]) | {i})
+    write_file(journal, json.dumps(state).encode())
+    return {"have": len(state["have"])}, b""
+
+
+def op_finish(req, payload):
+    """
+    Cut the partial file of 'path' to 'length' bytes and check every chunk
+    of it against the journal, then rename it into place with its 'mode'
+    and 'mtime', flushed to disk at 'durability', and drop the journal.  A
+    partial file that does not check out is thrown away.
+    """
+    path = os.path.expanduser(req["path"])
+    part, journal = partial_paths(path)
+    state = load_journal(journal)
+    os.truncate(part, req["length"])
+    if state is None or \
+            chunk_digests(part, state["algorithm"], chunk=state["chunk"]) != state["chunks"]:
+        for leftover in (part, journal):
+            if os.path.exists(leftover):
+                os.unlink(leftover)
+        raise ValueError("{}: received file does not match its source".format(req["path"]))
+    os.chmod(part, req["mode"])
+    os.utime(part, ns=(req["mtime"], req["mtime"]))
+    commit({path: part}, req.get("durability", "none"))
+    os.unlink(journal)
+    return {}, b""
+
+
+BACKUP_NAME = re.compile(
+    r"^(?P<name>.+)-(?P<time>\d{4}-\d\d-\d\d-\d\d-\d\d-\d\d)(?:\.\d+)?$")
+
+
+def find_backups(paths, store):
+    """
+    Return {path: [record, ...]} of the backups of each of 'paths', newest
+    first.  Records come from the store's index; each parent directory is
+    listed once to drop records of deleted backups and to pick up timestamped
+    backups that predate the index.
+    """
+    index = load_index(store)
+    wanted = {}
+    for path in paths:
+        path = os.path.abspath(path)
+        wanted.setdefault(os.path.dirname(path), set()).add(os.path.basename(path))
+    found = {}
+    for directory, names in wanted.items():
+        try:
+            entries = {e.name: e for e in os.scandir(directory)}
+        except OSError:
+            entries = {}
+        for name in names:
+            path = os.path.join(directory, name)
+            records = [r for r in index.get(path, [])
+                       if os.path.basename(r["backup"]) in entries]
+            known = {os.path.basename(r["backup"]) for r in records}
+            for entry_name, entry in entries.items():
+                m = BACKUP_NAME.match(entry_name)
+                if m and m.group("name") == name and entry_name not in known:
+                    t = time.mktime(time.strptime(m.group("time"), "%Y-%m-%d-%H-%M-%S"))
+                    records.append({"key": None, "backup": entry.path, "digest": None,
+                                    "size": entry.stat(follow_symlinks=False).st_size,
+                                    "time": t})
+            found[path] = sorted(records, key=lambda r: r["time"], reverse=True)
+    return found
+
+
+def select_expired(found, keep_last=None, keep_days=None, max_size=None):
+    """
+    Return the records in 'found' that the retention policy lets go: all but
+    the 'keep_last' newest of each file and the newest of each of the last
+    'keep_days' days, and then the oldest until the rest fit in 'max_size'
+    bytes.  The newest backup of each file is always kept.
+    """
+    now = time.time()
+    kept, expired = [], []
+    for records in found.values():
+        days = set()
+        for i, r in enumerate(records):
+            day = time.strftime("%Y-%m-%d", time.localtime(r["time"]))
+            keep = i == 0 or (keep_last is None and keep_days is None)
+            if keep_last is not None and i < keep_last:
+                keep = True
+            if keep_days is not None and now - r["time"] < keep_days * 86400 \
+                    and day not in days:
+                keep = True
+            days.add(day)
+            (kept if keep else expired).append((i, r))
+    if max_size is not None:
+        total, seen = 0, set()
+        for i, r in sorted(kept, key=lambda ir: (ir[0] != 0, -ir[1]["time"])):
+            # Backups that were not stored are each a copy of their own
+            content = (r["digest"] if r.get("stored", True) else None) or r["backup"]
+            if content not in seen:
+                seen.add(content)
+                total += r["size"]
+            if total > max_size and i != 0:
+                expired.append((i, r))
+    return [r for _, r in expired]
+
+
+def trash_command():
+    for cmd in (["gio", "trash"], ["gvfs-trash"]):
+        if shutil.which(cmd[0]):
+            return cmd
+    return None
+
+
+def clean(paths, store, force=False, keep_last=None, keep_days=None, max_size=None):
+    """
+    Remove the backups of 'paths' that the retention policy lets go, moving
+    them to the trash when possible.  Without a trash command they are only
+    deleted if 'force' is set, and are otherwise reported as skipped.
+    """
+    store = os.path.expanduser(store)
+    expired = select_expired(find_backups(paths, store), keep_last, keep_days, max_size)
+    backups = [r["backup"] for r in expired]
+    removed, skipped, errors = [], [], {}
+    trash = trash_command()
+    if trash and backups:
+        p = subprocess.run(trash + backups, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        for backup in backups:
+            if os.path.lexists(backup):
+                errors[backup] = p.stderr.decode().strip() or "not trashed"
+            else:
+                removed.append(backup)
+    elif force:
+        for backup in backups:
+            try:
+                if os.path.isdir(backup) and not os.path.islink(backup):
+                    shutil.rmtree(backup)
+                else:
+                    os.unlink(backup)
+                removed.append(backup)
+            except OSError as e:
+                errors[backup] = e.strerror
+    else:
+        skipped = backups
+    if removed:
+        with STORE_LOCK:
+            index = load_index(store)
+            gone = set(removed)
+            for path in list(index):
+                index[path] = [r for r in index[path] if r["backup"] not in gone]
+            # Drop stored content no backup links to any more
+            live = {r["digest"] for records in index.values() for r in records}
+            for r in expired:
+                obj = os.path.join(store, "objects", (r["digest"] or "")[:2], r["digest"] or "")
+                if r["digest"] and r["digest"] not in live and os.path.exists(obj):
+                    os.unlink(obj)
+            save_index(store, {k: v for k, v in index.items() if v})
+    return {"removed": removed, "skipped": skipped, "errors": errors}
+
+
+def op_backup(req, payload):
+    return batch(lambda path: backup(path, req["suffix"], req["store"], req.get("key")),
+                 req["paths"]), b""
+
+
+def op_restore(req, payload):
+    return {"path": restore(req["path"], req["digest"], req["store"])}, b""
+
+
+def op_versions(req, payload):
+    return {"versions": versions(req["path"], req["store"])}, b""
+
+
+def op_read(req, payload):
+    "Read small files; their bytes are concatenated in the payload in 'results' order."
+    chunks = []
+
+    def read(path):
+        with open(path, "rb") as f:
+            chunks.append(f.read())
+        return len(chunks[-1])
+    return batch(read, req["paths"]), b"".join(chunks)
+
+
+def op_write(req, payload):
+    """
+    Write small files given as [path, size, mode, mtime_ns] from the
+    concatenated payload, staging them all before they are renamed into
+    place with commit() at 'durability'.
+    """
+    offsets, offset, staged = {}, 0, {}
+    for path, size, mode, mtime in req["files"]:
+        offsets[path] = offset
+        offset += size
+
+    def stage(item):
+        path, size, mode, mtime = item
+        staged[path] = stage_file(path, payload[offsets[path]:offsets[path] + size], mode, mtime)
+        return size
+    result = batch(stage, req["files"])
+    commit(staged, req.get("durability", "none"))
+    return result, b""
+
+
+def op_fsync(req, payload):
+    return flush(req["paths"]), b""
+
+
+OPS = {"backup": op_backup, "chunk": op_chunk, "chunks": op_chunks, "clean": op_clean,
+       "delta": op_delta, "fetch": op_fetch, "finish": op_finish, "fsync": op_fsync,
+       "pack": op_pack, "patch": op_patch, "probe": op_probe, "read": op_read,
+       "restore": op_restore, "resume": op_resume, "scan": op_scan, "sha": op_sha,
+       "signature": op_signature, "stat": op_stat, "unpack": op_unpack,
+       "versions": op_versions, "write": op_write}
+
+
+def serve(stdin=None, stdout=None):
+    stdin = stdin or sys.stdin.buffer
+    stdout = stdout or sys.stdout.buffer
+    while True:
+        req, payload = recv(stdin)
+        if req is None:
+            break
+        try:
+            resp, data = OPS[req["op"]](req, payload)
+        except Exception as e:
+            resp, data = {"error": "{0}: {1}".format(type(e).__name__, e)}, b""
+        send(stdout, resp, data)
+
+
+if __name__ == "__main__":
+    serve()
@@ -1,23 +1,103 @@
 import argparse
+import atexit
 import configparser
+import contextlib
+import ctypes
+import ctypes.util
+import errno
+import hashlib
+import inspect
+import json
 import logging
+import select
 import os
+import re
 import shlex
+import shutil
+import signal
+import stat
+import struct
 import subprocess
 import sys
+import tempfile
 import textwrap
+import threading
+import time
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from typing import Union as T
 
+try:
+    from fs import agent
+except ImportError:
+    # Run as a script (or built with PyInstaller) from inside fs/
+    import agent
 
+
+BACKUP_STORE = os.path.join("~", ".local", "share", "filesync", "backups")
+DEFAULT_CACHE_DIR = os.path.join(os.getenv("HOME"), ".cache", "filesync")
+DEFAULT_CACHE_SIZE = 10000
+DEFAULT_DIGEST = "sha256"
+DEFAULT_DURABILITY = "none"
+DEFAULT_LINK_RATE = 1 << 23  # Bytes per second assumed for a host with no throughput history
 DEFAULT_CONF_FILE = os.path.join(os.getenv("HOME"), ".config", "filesync", "filesync.conf")
+DEFAULT_STATE_DIR = os.path.join(os.getenv("HOME"), ".local", "state", "filesync")
 DESCRIPTION = "Sync files between two machines.  Works in either `push` or `pull` modes."
+GLOB_PREFIX = "glob:"  # Marks an entry as a pattern; a trailing '/' marks a directory
 LICENSE = 'GPLv3'
 LOGFMT = '==> %(message)s'
 PROGNAME = "filesync"
+RSYNC_TEMP = re.compile(r"(/)\.([^/]+)\.[A-Za-z0-9]{6}$")  # rsync's temp file for NAME
 VERSION = "0.6"
 
+COMPRESS_LEVELS = {1: 1 << 26, 6: 1 << 24}  # zlib levels tried, and the bytes/s each compresses
+DURABILITY_LEVELS = ("none", "batch", "file")
+FSYNC_BATCH = 1000  # Received files flushed to disk per request
+HASH_BUFSIZE = 1 << 20
+# Already compressed formats, never worth compressing again
+INCOMPRESSIBLE = frozenset((".7z", ".bz2", ".cbz", ".chd", ".cso", ".flac", ".gz", ".jpeg",
+                            ".jpg", ".lz", ".lzma", ".mkv", ".mp3", ".mp4", ".ogg", ".png",
+                            ".rar", ".rvz", ".tgz", ".webm", ".webp", ".xz", ".zip", ".zst"))
+KEEP_LAST = 5  # Backups of each file kept by --clean when no retention policy is set
+SMALL_ARCHIVE_FILES = 1000  # Upper bound on the files packed into one archive
+SMALL_ARCHIVE_SIZE = 1 << 25  # Upper bound on the bytes packed into one archive
+LARGE_FILE_SIZE = 1 << 26  # Files this big or bigger go in the large transfer lane
+RESUME_SIZE = 1 << 30  # Files this big or bigger are sent in chunks that survive an interruption
+SCAN_PAGE = 5000  # Files per remote directory scan request
+SMALL_FILE_SIZE = 1 << 20
+SSH_PERSIST = 60  # Seconds an ssh master outlives its last session, should filesync be killed
+TREE_CHUNK = 1000  # Changed files of a directory or glob entry sent per rsync
+WATCH_DELAY = 2.0  # Seconds without new changes before a watched burst is pushed
+WATCH_INTERVAL = 5.0  # Seconds between scans when inotify is not available
+
+# Multiplexed ssh master connections for this run, keyed by host.  A value of
+# None means the master could not be started and plain ssh is used instead.
+# A Session swaps in its own during each of its calls, as it does for the
+# agents, digest caches and stats.
+_SSH_MASTERS = {}
+_SSH_MASTERS_LOCK = threading.Lock()
+_SSH_MASTER_LOCKS = {}
+_SSH_CONTROL_DIR = None
+_SSH_MULTIPLEX = True
+
+# Remote agents for this run, keyed by host
+_AGENTS = {}
+_AGENTS_LOCK = threading.Lock()
+_AGENT_LOCKS = {}
+
+# Held while a Session's own are swapped in, so Sessions in different threads take turns
+_SESSION_LOCK = threading.RLock()
+
+# Whether the rsync that receives on each host (None for this one) takes --fsync
+_RSYNC_FSYNC = {}
+
+# The terminal's '(columns, rows)', looked up once and again on SIGWINCH
+_TERMINAL_DIMS = None
+
+# Read the agent's source from stdin, then hand the rest of stdin over to it
+_AGENT_BOOTSTRAP = "import sys; exec(sys.stdin.buffer.read(int(sys.stdin.buffer.readline())))"
+
 
 class CheckFileAgeException(Exception):
     "Raised when checking a file's age fails."
@@ -29,6 +109,11 @@ class CheckFileShaException(Exception):
     pass
 
 
+class RemoteAgentException(Exception):
+    "Raised when the remote agent cannot be started or fails a request."
+    pass
+
+
 class MissingRequiredOptionException(Exception):
     "Raised when a required config option is missing."
     pass
@@ -39,24 +124,677 @@ class MissingRequiredSectionException(Exception):
     pass
 
 
+class SessionException(Exception):
+    "Raised when a Session's config or options are not usable."
+    pass
+
+
+class LogMessage:
+    """
+    A message for emit_log(), only formatted with its arguments when a
+    handler actually writes it out.
+    """
+    __slots__ = ("fmt", "args", "kwargs", "_text")
+
+    def __init__(self, fmt: str, args: tuple, kwargs: dict):
+        self.fmt, self.args, self.kwargs, self._text = fmt, args, kwargs, None
+
+    def __str__(self):
+        if self._text is None:
+            self._text = self.fmt.format(*self.args, **self.kwargs) \
+                if self.args or self.kwargs else self.fmt
+        return self._text
+
+
+class TerminalFormatter(logging.Formatter):
+    """
+    Format records as LOGFMT, shortened to fit the terminal when stdout is
+    one; piped or redirected output is left whole.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.shorten = sys.stdout.isatty()
+
+    def format(self, record):
+        text = super().format(record)
+        if not self.shorten:
+            return text
+        width = get_terminal_dims()[0] - 1
+        if len(text) > width:
+            text = textwrap.shorten(text, width=width, placeholder="...")
+        return text
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """
+    Format records as one JSON object per line: the time, level and message,
+    plus the fields of the record's 'event', if it has one.
+    """
+    def format(self, record):
+        line = {"time": datetime.fromtimestamp(record.created).isoformat(),
+                "level": record.levelname, "message": record.getMessage()}
+        line.update(getattr(record, "event", None) or {})
+        return json.dumps(line, default=str)
+
+
+class RunStats:
+    """
+    What a run spent its time on: a span for each phase (and each entry
+    within it), every subprocess spawned and how long it ran, counters, and
+    the transfer totals rsync reports.
+    """
+    RSYNC_FIELDS = {"Number of regular files transferred": "files transferred",
+                    "Total file size": "total file size",
+                    "Total transferred file size": "transferred file size",
+                    "Literal data": "literal data", "Matched data": "matched data",
+                    "Total bytes sent": "bytes sent", "Total bytes received": "bytes received"}
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.spans = []
+        self.processes = {}
+        self.counters = {}
+        self.rsync = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, phase: str, key=None):
+        "Time the code run inside this context as 'phase' (for 'key', if given)."
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.spans.append({"phase": phase, "key": key,
+                                   "start": round(start - self.start, 6),
+                                   "seconds": round(time.monotonic() - start, 6)})
+
+    def count(self, name: str, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def process(self, cmd: list, seconds: float):
+        with self._lock:
+            entry = self.processes.setdefault(os.path.basename(cmd[0]), {"count": 0, "seconds": 0.0})
+            entry["count"] += 1
+            entry["seconds"] += seconds
+
+    def rsync_output(self, out: str):
+        "Add the totals from the output of 'rsync --stats'."
+        for line in out.splitlines():
+            name, _, value = line.partition(": ")
+            if name in self.RSYNC_FIELDS:
+                n = int(value.split()[0].replace(",", "").replace(".", ""))
+                with self._lock:
+                    field = self.RSYNC_FIELDS[name]
+                    self.rsync[field] = self.rsync.get(field, 0) + n
+
+    def phases(self) -> dict:
+        "Return each phase's number of spans and total seconds."
+        totals = {}
+        for span in self.spans:
+            entry = totals.setdefault(span["phase"], {"count": 0, "seconds": 0.0})
+            entry["count"] += 1
+            entry["seconds"] += span["seconds"]
+        return totals
+
+    def as_dict(self) -> dict:
+        return {"wall seconds": round(time.monotonic() - self.start, 6), "phases": self.phases(),
+                "spans": self.spans, "processes": self.processes, "counters": self.counters,
+                "rsync": self.rsync}
+
+    def summary(self) -> list:
+        "Return the lines of a table of time per phase and subprocesses."
+        lines = ["{0:<24} {1:>7} {2:>10}".format("phase / process", "count", "seconds")]
+        for name, entry in sorted(self.phases().items()):
+            lines.append("{0:<24} {1:>7} {2:>10.3f}".format(name, entry["count"], entry["seconds"]))
+        for name, entry in sorted(self.processes.items()):
+            lines.append("{0:<24} {1:>7} {2:>10.3f}".format(
+                "[" + name + "]", entry["count"], entry["seconds"]))
+        for name, n in sorted(self.counters.items()):
+            lines.append("{0:<24} {1:>7}".format(name, n))
+        for name, n in sorted(self.rsync.items()):
+            lines.append("rsync {0:<18} {1:>18}".format(name, n))
+        lines.append("{0:<24} {1:>7} {2:>10.3f}".format(
+            "total", "", time.monotonic() - self.start))
+        return lines
+
+
+class DigestCache:
+    """
+    On-disk cache of local file digests, keyed by the digest algorithm and a
+    file's device, inode, size and mtime_ns so an unchanged file costs a stat()
+    instead of a full read.  Holds at most 'max_entries' digests, evicting the
+    least recently used.  'algorithm' is the digest this run computes.
+    """
+    def __init__(self, path: str, max_entries=DEFAULT_CACHE_SIZE):
+        self.path = path
+        self.max_entries = max_entries
+        self.rehash = False
+        self.algorithm = DEFAULT_DIGEST
+        self._entries = None
+        self._dirty = False
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._entries is None:
+            try:
+                with open(self.path) as f:
+                    self._entries = json.load(f)
+            except (OSError, ValueError):
+                self._entries = {}
+
+    @staticmethod
+    def key(st: os.stat_result, algorithm=DEFAULT_DIGEST) -> str:
+        return "{0}:{1}:{2}:{3}:{4}".format(
+            algorithm, st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def get(self, st: os.stat_result, algorithm=DEFAULT_DIGEST) -> T[str, None]:
+        if self.rehash:
+            return None
+        with self._lock:
+            self._load()
+            entry = self._entries.get(self.key(st, algorithm))
+            if entry:
+                entry[1] = time.time()
+                self._dirty = True
+                return entry[0]
+        return None
+
+    def put(self, st: os.stat_result, digest: str, algorithm=DEFAULT_DIGEST):
+        with self._lock:
+            self._load()
+            self._entries[self.key(st, algorithm)] = [digest, time.time()]
+            self._dirty = True
+
+    def save(self):
+        "Write the cache to disk atomically, dropping the oldest entries past the cap."
+        with self._lock:
+            if not self._dirty:
+                return
+            if len(self._entries) > self.max_entries:
+                newest = sorted(self._entries.items(), key=lambda i: i[1][1])[-self.max_entries:]
+                self._entries = dict(newest)
+            _atomic_write_json(self.path, self._entries)
+            self._dirty = False
+
+
+class ChunkIndex:
+    """
+    On-disk record of the chunk digests behind each large local file's tree
+    digest, so a rehash can report which CHUNK_SIZE regions of a file changed
+    since the last one.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._entries = None
+        self._dirty = False
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._entries is None:
+            try:
+                with open(self.path) as f:
+                    self._entries = json.load(f)
+            except (OSError, ValueError):
+                self._entries = {}
+
+    def get(self, path: str, algorithm=DEFAULT_DIGEST) -> T[list, None]:
+        "Return the last recorded chunk digests of 'path', or None."
+        with self._lock:
+            self._load()
+            entry = self._entries.get(path)
+        if entry and entry["algorithm"] == algorithm:
+            return entry["chunks"]
+        return None
+
+    def update(self, path: str, chunks: list, algorithm=DEFAULT_DIGEST) -> T[list, None]:
+        """
+        Record 'chunks' as the chunk digests of 'path' and return the indices of
+        the chunks that differ from the last record, or None if there was none.
+        """
+        old = self.get(path, algorithm)
+        with self._lock:
+            self._entries[path] = {"algorithm": algorithm, "chunks": chunks}
+            self._dirty = True
+        if old is None:
+            return None
+        return [i for i, c in enumerate(chunks) if i >= len(old) or old[i] != c]
+
+    def save(self):
+        "Write the index to disk atomically."
+        with self._lock:
+            if self._dirty:
+                _atomic_write_json(self.path, self._entries)
+                self._dirty = False
+
+
+class LocalFiles:
+    """
+    The metadata and digests of local files, each looked up at most once per
+    run and shared by the syncs to every host.
+    """
+    def __init__(self):
+        self._meta = {}
+        self._digests = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def meta(self, path: str) -> T[list, None]:
+        "Return _local_meta() for 'path'."
+        if path not in self._meta:
+            self._meta[path] = _local_meta(path)
+        return self._meta[path]
+
+    def digest(self, path: str) -> T[str, None]:
+        "Return the digest of the file at 'path', or None if it cannot be read."
+        with self._lock:
+            lock = self._locks.setdefault(path, threading.Lock())
+        # Hosts asking for the same file at once wait for a single hash
+        with lock:
+            if path not in self._digests:
+                try:
+                    self._digests[path] = hash_local_file(path)
+                except OSError:
+                    self._digests[path] = None
+            return self._digests[path]
+
+    def forget(self, path: str):
+        "Drop what is known about 'path', after it has been written."
+        self._meta.pop(path, None)
+        self._digests.pop(path, None)
+
+
+class Manifest:
+    """
+    What each entry looked like at its last successful sync to one host: the
+    local and remote paths, their '[size, mtime_ns]', the local digest and
+    when it was recorded.  It is written atomically after every record() so
+    an interrupted run keeps what it has done so far.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    @classmethod
+    def for_host(cls, host: str, state_dir=None):
+        return cls(os.path.join(state_dir or DEFAULT_STATE_DIR, "manifest-{}.json".format(
+            host.replace(os.sep, "_"))))
+
+    def unchanged(self, key: str, local_path: str, remote_path: str,
+                  local_meta: T[list, None], remote_meta: T[list, None]) -> bool:
+        """
+        Return True if both sides of 'key' look exactly like they did at the
+        last sync, and neither was modified within the second it was recorded
+        in (see _racy().)
+        """
+        entry = self.entries.get(key)
+        if not entry or local_meta is None or remote_meta is None:
+            return False
+        if _racy(local_meta, entry.get("synced")) or _racy(remote_meta, entry.get("synced")):
+            return False
+        return entry["local"] == local_path and entry["remote"] == remote_path \
+            and entry["local meta"] == local_meta and entry["remote meta"] == remote_meta
+
+    def record(self, key: str, local_path: str, remote_path: str,
+               local_meta: list, remote_meta: list, digest: T[str, None]):
+        with self._lock:
+            self.entries[key] = {"local": local_path, "remote": remote_path,
+                                 "local meta": local_meta, "remote meta": remote_meta,
+                                 "digest": digest, "synced": time.time()}
+            _atomic_write_json(self.path, self.entries)
+
+
+class Throughput:
+    """
+    The most recent transfers to one host, as '[bytes, seconds]' samples,
+    kept to estimate how long a plan will take.
+    """
+    SAMPLES = 20
+
+    def __init__(self, path: str):
+        self.path = path
+        try:
+            with open(path) as f:
+                self.samples = json.load(f)
+        except (OSError, ValueError):
+            self.samples = []
+
+    @classmethod
+    def for_host(cls, host: str, state_dir=None):
+        return cls(os.path.join(state_dir or DEFAULT_STATE_DIR, "throughput-{}.json".format(
+            host.replace(os.sep, "_"))))
+
+    def record(self, nbytes: int, seconds: float):
+        if nbytes <= 0 or seconds <= 0:
+            return
+        self.samples = (self.samples + [[nbytes, seconds]])[-self.SAMPLES:]
+        _atomic_write_json(self.path, self.samples)
+
+    def rate(self) -> T[float, None]:
+        "Return the bytes per second over the recent samples, or None without any."
+        seconds = sum(s for _, s in self.samples)
+        return sum(b for b, _ in self.samples) / seconds if seconds else None
+
+
+class TreeManifest:
+    """
+    The '[size, mtime_ns]' of every file of one directory or glob entry at
+    its last successful sync to a host, stored next to that host's Manifest
+    with one record per directory of the tree, which also names the
+    directory's subdirectories.  Only the record of the directory being
+    walked is held, so memory is bounded by the largest directory rather
+    than the whole tree.  What is recorded for other local and remote roots
+    is ignored.
+    """
+    def __init__(self, path: str, local_root: str, remote_root: str):
+        self.path = path
+        self.roots = [local_root, remote_root]
+        self.dir, self.files, self.dirs, self.kept = None, {}, [], {}
+
+    @classmethod
+    def for_entry(cls, manifest: Manifest, key: str, local_root: str, remote_root: str):
+        name = hashlib.sha1(key.encode()).hexdigest()
+        return cls(os.path.join(os.path.splitext(manifest.path)[0] + "-trees", name),
+                   local_root, remote_root)
+
+    def _record_path(self, d: str) -> str:
+        return os.path.join(self.path, hashlib.sha1(d.encode()).hexdigest() + ".json")
+
+    def load(self, d: str) -> tuple:
+        "Return the '(files, subdirectories)' recorded for the relative directory 'd'."
+        try:
+            with open(self._record_path(d)) as f:
+                data = json.load(f)
+            if data["roots"] == self.roots:
+                return data["files"], data["dirs"]
+        except (OSError, ValueError, KeyError):
+            pass
+        return {}, []
+
+    def save(self, d: str, files: dict, dirs: list):
+        _atomic_write_json(self._record_path(d), {"roots": self.roots, "files": files,
+                                                  "dirs": dirs})
+
+    def _enter(self, d: str):
+        if d != self.dir:
+            self.dir, self.kept = d, {}
+            self.files, self.dirs = self.load(d)
+
+    def get(self, rel: str) -> T[list, None]:
+        "Return the '[size, mtime_ns]' recorded for 'rel', reading its directory's record."
+        d, _, name = rel.rpartition("/")
+        self._enter(d)
+        return self.files.get(name)
+
+    def keep(self, rel: str, meta: list):
+        "Carry the record of 'rel', seen unchanged by the walk, over to its directory's new one."
+        d, _, name = rel.rpartition("/")
+        self._enter(d)
+        self.kept[name] = meta
+
+    def update(self, metas: dict):
+        """
+        Record the '[size, mtime_ns]' of each relative path in 'metas', or
+        forget it where that is None.  Paths in the directory being walked
+        go into its new record, the others into their stored ones.
+        """
+        by_dir = {}
+        for rel, meta in metas.items():
+            d, _, name = rel.rpartition("/")
+            by_dir.setdefault(d, {})[name] = meta
+        for d, names in by_dir.items():
+            files, dirs = (self.kept, None) if d == self.dir else self.load(d)
+            for name, meta in names.items():
+                if meta is None:
+                    files.pop(name, None)
+                else:
+                    files[name] = meta
+            if dirs is not None:
+                self.save(d, files, dirs)
+
+    def finish_dir(self, d: str, dirs: list):
+        """
+        Replace the record of the walked directory 'd' with the files kept
+        and updated since, and its subdirectories with 'dirs', dropping the
+        records of those that are gone.
+        """
+        self._enter(d)
+        for name in set(self.dirs) - set(dirs):
+            self.forget("{0}/{1}".format(d, name) if d else name)
+        self.save(d, self.kept, dirs)
+        self.dir, self.files, self.dirs, self.kept = None, {}, [], {}
+
+    def forget(self, d: str):
+        "Drop the records of the directory 'd' and of every directory under it."
+        pending = [d]
+        while pending:
+            d = pending.pop()
+            pending += ["{0}/{1}".format(d, name) if d else name for name in self.load(d)[1]]
+            try:
+                os.unlink(self._record_path(d))
+            except FileNotFoundError:
+                pass
+
+
+class RemoteAgent:
+    """
+    A helper process started once on 'host' over ssh, that answers stat,
+    hash, backup and small-file read/write requests for the rest of the run
+    so each of those costs one message instead of one ssh command.  Requests
+    from different threads are serialised.
+    """
+    def __init__(self, host: str):
+        self.host = host
+        self._lock = threading.Lock()
+        self._stderr = tempfile.TemporaryFile()
+        cmd = ssh_command(host) + [host, "python3", "-u", "-c", shlex.quote(_AGENT_BOOTSTRAP)]
+        self._cmd, self._started = cmd, time.monotonic()
+        self._proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                      stderr=self._stderr)
+        source = inspect.getsource(agent).encode()
+        try:
+            self._proc.stdin.write("{}\n".format(len(source)).encode() + source)
+            self._proc.stdin.flush()
+        except OSError:
+            raise RemoteAgentException(self._error())
+
+    def _error(self) -> str:
+        self._stderr.seek(0)
+        err = self._stderr.read().decode().strip()
+        return err or "The agent on \"{}\" exited".format(self.host)
+
+    def call(self, op: str, payload=b"", **args) -> tuple:
+        """
+        Send request 'op' with the keyword 'args' and 'payload' to the agent.
+        Returns its '(response, payload)' pair; raises RemoteAgentException
+        if the agent reports an error or goes away.
+        """
+        header = dict(args, op=op, size=len(payload))
+        data = json.dumps(header).encode()
+        _STATS.count("agent requests")
+        with self._lock:
+            try:
+                self._proc.stdin.write(struct.pack(">I", len(data)) + data)
+                self._proc.stdin.write(payload)
+                self._proc.stdin.flush()
+                n = self._proc.stdout.read(4)
+                if len(n) < 4:
+                    raise RemoteAgentException(self._error())
+                resp = json.loads(self._proc.stdout.read(struct.unpack(">I", n)[0]).decode())
+                data = self._proc.stdout.read(resp["size"]) if resp["size"] else b""
+            except OSError:
+                raise RemoteAgentException(self._error())
+        if "error" in resp:
+            raise RemoteAgentException(resp["error"])
+        return resp, data
+
+    def close(self):
+        try:
+            self._proc.stdin.close()
+        except OSError:
+            pass
+        self._proc.wait()
+        self._stderr.close()
+        _STATS.process(self._cmd, time.monotonic() - self._started)
+
+
+class InotifyWatcher:
+    """
+    Watch the directory holding each local path in 'paths' (a dict of keys
+    to paths), and directory entries themselves, with inotify.  The keys in
+    'trees' are directory or glob entries, whose every directory is watched,
+    including those made later.  Raises OSError if inotify is not available.
+    """
+    MASK = 0x008 | 0x080 | 0x100 | 0x200  # IN_CLOSE_WRITE, IN_MOVED_TO, IN_CREATE, IN_DELETE
+    IN_ISDIR = 0x40000000
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self, paths: dict, trees=None):
+        name = ctypes.util.find_library("c")
+        self._libc = ctypes.CDLL(name, use_errno=True)
+        if not hasattr(self._libc, "inotify_init1"):
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        # Watch descriptor -> {file name (None for any) -> set of keys}
+        self._watches = {}
+        # Watch descriptor -> directory, for the directories of trees
+        self._tree_dirs = {}
+        for key, path in paths.items():
+            self._add(os.path.dirname(path) or ".", os.path.basename(path), key)
+            if trees and key in trees:
+                self._add_tree(path, key)
+            elif os.path.isdir(path):
+                self._add(path, None, key)
+
+    def _add(self, directory: str, name: T[str, None], key: str) -> T[int, None]:
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), self.MASK)
+        if wd < 0:
+            emit_log("Unable to watch \"{0}\": {1}".format(
+                directory, os.strerror(ctypes.get_errno())), level=logging.WARN)
+            return None
+        self._watches.setdefault(wd, {}).setdefault(name, set()).add(key)
+        return wd
+
+    def _add_tree(self, root: str, key: str):
+        "Watch 'root' and every directory under it for changes to any file."
+        for directory, _, _ in os.walk(root):
+            wd = self._add(directory, None, key)
+            if wd is not None:
+                self._tree_dirs[wd] = directory
+
+    def wait(self, timeout: T[float, None]) -> set:
+        "Wait up to 'timeout' seconds (forever if None) and return the keys that changed."
+        if not select.select([self._fd], [], [], timeout)[0]:
+            return set()
+        keys = set()
+        data = os.read(self._fd, 1 << 16)
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            names = self._watches.get(wd, {})
+            keys |= names.get(name, set()) | names.get(None, set())
+            if mask & self.IN_ISDIR and mask & 0x180 and wd in self._tree_dirs:
+                # A directory made or moved into a tree is watched too
+                for key in names.get(None, set()):
+                    self._add_tree(os.path.join(self._tree_dirs[wd], name), key)
+        return keys
+
+    def close(self):
+        os.close(self._fd)
+
+
+class PollingWatcher:
+    """
+    Find changed local paths by stat'ing all of them every 'interval' seconds.
+    'trees' maps the keys of directory or glob entries to their glob pattern
+    (None for every file); their trees are walked instead, and summed up as
+    the number of files and a hash of every file's '[relpath, size, mtime]'.
+    """
+    def __init__(self, paths: dict, interval=WATCH_INTERVAL, trees=None):
+        self._paths = paths
+        self._trees = trees or {}
+        self.interval = interval
+        self._seen = self._scan()
+
+    def _scan(self) -> dict:
+        seen = {}
+        for key, path in self._paths.items():
+            if key in self._trees:
+                count, total = 0, 0
+                for rel, size, mtime in agent.scan_tree(path, self._trees[key]):
+                    count += 1
+                    total = (total + hash((rel, size, mtime))) & 0xFFFFFFFFFFFFFFFF
+                seen[key] = (count, total)
+                continue
+            try:
+                st = os.stat(path)
+                seen[key] = (st.st_mtime_ns, st.st_size)
+            except OSError:
+                seen[key] = None
+        return seen
+
+    def wait(self, timeout: T[float, None]) -> set:
+        "Wait up to 'timeout' seconds (at most one interval) and return the keys that changed."
+        time.sleep(self.interval if timeout is None else min(timeout, self.interval))
+        seen = self._scan()
+        keys = {k for k, v in seen.items() if v != self._seen.get(k)}
+        self._seen = seen
+        return keys
+
+    def close(self):
+        pass
+
+
+_STATS = RunStats()
+_DIGEST_CACHE = DigestCache(os.path.join(DEFAULT_CACHE_DIR, "digests.json"))
+_CHUNK_INDEX = ChunkIndex(os.path.join(DEFAULT_CACHE_DIR, "chunks.json"))
+_HASH_BUFFERS = threading.local()
+
+
+def _atomic_write_json(path: str, data):
+    "Write 'data' as JSON to 'path' through a temp file and a rename."
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".filesync-")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
 # def _can_do_colors():
 #     return hasattr(sys.stdout, 'isatty') and sys.stdout.isatty()
 
 
-def check_file_age(path: str, host=None) -> T[str, int]:
-    """"""
+def check_file_age(path: str, host=None) -> float:
+    """
+    Return the mtime of 'path' in seconds, on 'host' if one is given.  Both
+    sides are worked out from the nanosecond mtime, so the same file gives
+    the same value wherever it is stat'ed.
+    """
     if host:
-        cli = ['python', '-c',
-               'import os; s=os.stat("{}");t=s.st_mtime;print(t)'.format(path)]
-        p = subprocess.Popen(cli, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-        c = p.communicate()
-        if p.returncode != 0:
-            print(c[1].decode())
+        stats, errors = remote_stat_batch([path], host)
+        if path in errors:
+            emit_log("{0}: {1}".format(path, errors[path]), level=logging.ERROR)
             raise CheckFileAgeException
-        return c.decode()[0]
+        return stats[path][1] / 10 ** 9
     else:
         stat = os.stat(path)
-        return stat.st_mtime
+        return stat.st_mtime_ns / 10 ** 9
 
 
 def check_file_sha(path: str, host=None) -> T[bool, str]:
@@ -64,16 +802,171 @@ def check_file_sha(path: str, host=None) -> T[bool, str]:
     if not host and not os.path.isfile(path):
         # specified file is not a file
         return False
-    if host:
-        cmd = "ssh {0} sha256sum {1}".format(host, path)
-    else:
-        cmd = "sha256sum {}".format(path)
-    p = subprocess.Popen(cmd.split(), stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-    out, error = p.communicate()
-    if out:
-        return out
-    if error:
+    # Same output as sha256sum, without running it: a plain sha256 of the
+    # whole file, whatever its size or the configured digest
+    try:
+        found = _agent_call(host, "sha", paths=[path], algorithm="sha256", tree=False)[0]
+    except RemoteAgentException:
+        raise CheckFileShaException
+    if path in found["errors"]:
+        raise CheckFileShaException
+    return "{0}  {1}\n".format(found["results"][path], path).encode()
+
+
+def _local_meta(path: str) -> T[list, None]:
+    "Return '[size, mtime_ns]' for the regular file at 'path', or None."
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+
+def _racy(meta: T[list, None], when: T[float, None]) -> bool:
+    """
+    Return True if the '[size, mtime_ns]' 'meta' has an mtime in the same
+    second as 'when' (a time.time()) or later.  A file rewritten that soon
+    after it was looked at can keep both its size and, on filesystems with
+    coarse timestamps, its mtime, so its 'meta' proves nothing.
+    """
+    return meta is not None and when is not None and meta[1] // 10 ** 9 >= int(when)
+
+
+def _hash_file(f, algorithm=DEFAULT_DIGEST) -> str:
+    "Return the 'algorithm' hex digest of the open binary file 'f'."
+    h = hashlib.new(algorithm)
+    # Reuse one read buffer per thread instead of allocating per block
+    buf = getattr(_HASH_BUFFERS, "buf", None)
+    if buf is None:
+        buf = _HASH_BUFFERS.buf = memoryview(bytearray(HASH_BUFSIZE))
+    n = f.readinto(buf)
+    while n:
+        h.update(buf[:n])
+        n = f.readinto(buf)
+    return h.hexdigest()
+
+
+def _hash_tree(path: str, algorithm=DEFAULT_DIGEST) -> str:
+    """
+    Return the tree digest of the large local file at 'path', hashing its
+    chunks in parallel, and log how many chunks changed since the last time.
+    """
+    chunks = agent.chunk_digests(path, algorithm)
+    changed = _CHUNK_INDEX.update(path, chunks, algorithm)
+    if changed is not None:
+        emit_log("{0}: {1} of {2} chunks changed", path, len(changed), len(chunks),
+                 level=logging.DEBUG,
+                 event={"event": "chunks", "path": path, "chunks": len(chunks),
+                        "changed": changed})
+    return agent.tree_digest(chunks, algorithm)
+
+
+def hash_local_file(path: str) -> str:
+    """
+    Return the digest of the local file at 'path', from the digest cache when
+    the file has not changed since it was last hashed.  The digest is the same
+    one the remote agent computes (see file_digest() in agent.py.)  Raises
+    OSError if the file cannot be read.
+    """
+    algorithm = _DIGEST_CACHE.algorithm
+    with open(path, "rb") as f:
+        st = os.fstat(f.fileno())
+        if not stat.S_ISREG(st.st_mode):
+            raise IsADirectoryError(errno.EISDIR, os.strerror(errno.EISDIR), path)
+        digest = _DIGEST_CACHE.get(st, algorithm)
+        if digest is None:
+            with _STATS.span("hash", path):
+                if st.st_size >= agent.TREE_SIZE:
+                    digest = _hash_tree(path, algorithm)
+                else:
+                    digest = _hash_file(f, algorithm)
+            _DIGEST_CACHE.put(st, digest, algorithm)
+    return digest
+
+
+def local_sha_batch(paths: list) -> tuple:
+    """
+    Hash every local file in 'paths'.  Returns a '(digests, errors)' pair of
+    dicts, mapping each path to its hex digest or to the reason it
+    could not be hashed.
+    """
+    digests, errors = {}, {}
+    for path in paths:
+        try:
+            digests[path] = hash_local_file(path)
+        except OSError as e:
+            errors[path] = e.strerror
+    return digests, errors
+
+
+def remote_sha_batch(paths: list, host: str) -> tuple:
+    """
+    Hash every file in 'paths' on 'host' with one remote agent request.  Returns
+    a '(digests, errors)' pair of dicts like local_sha_batch().  Raises
+    CheckFileShaException only if the agent itself fails.
+    """
+    try:
+        result = get_agent(host).call("sha", paths=paths, algorithm=_DIGEST_CACHE.algorithm)[0]
+    except RemoteAgentException as e:
+        emit_log(str(e), level=logging.ERROR)
         raise CheckFileShaException
+    return result["results"], result["errors"]
+
+
+def remote_stat_batch(paths: list, host: str, missing_ok=False) -> tuple:
+    """
+    Stat every path in 'paths' on 'host' with one remote agent request.  Returns
+    a '(stats, errors)' pair of dicts, mapping each path to a '[size, mtime,
+    is_regular_file]' list or to the reason it could not be stat'ed.  With
+    'missing_ok', paths that do not exist are in neither.  Raises
+    CheckFileAgeException if the agent itself fails.
+    """
+    try:
+        result = get_agent(host).call("stat", paths=paths, missing_ok=missing_ok)[0]
+    except RemoteAgentException as e:
+        emit_log(str(e), level=logging.ERROR)
+        raise CheckFileAgeException
+    return result["results"], result["errors"]
+
+
+def clean_backups(config: configparser.ConfigParser, force=False, hosts=None) -> dict:
+    """
+    Remove old backups of every configured file, on this host and on each of
+    'hosts' (the config's remote hosts by default), with one agent request
+    each, following the retention policy in the config's [global] section.
+    Returns each host's result, keyed by "local" and the remote host names.
+    """
+    policy = _get_retention(config)
+    sync_dict = _build_sync_dict(config)
+    paths = {"local": [], "remote": []}
+    for v in sync_dict.values():
+        paths["local"].append(v.get("local", v.get("remote")))
+        paths["remote"].append(v.get("remote", v.get("local")))
+    results = {}
+    sides = [("local", None, paths["local"])]
+    sides += [(host, host, paths["remote"]) for host in hosts or _get_remote_hosts(config)]
+    for side, host, side_paths in sides:
+        try:
+            with _STATS.span("clean", side):
+                result = _agent_call(host, "clean", paths=side_paths, store=BACKUP_STORE,
+                                     force=bool(force), **policy)[0]
+        except RemoteAgentException as e:
+            emit_log("Unable to clean {0} backups: {1}".format(side, e), level=logging.ERROR)
+            continue
+        results[side] = result
+        for backup in result["removed"]:
+            emit_log("Removed {0} backup \"{1}\"", side, backup, level=logging.DEBUG)
+        for backup, error in result["errors"].items():
+            emit_log("Unable to remove {0} backup \"{1}\": {2}".format(side, backup, error),
+                     level=logging.ERROR)
+        emit_log("Removed {0} old {1} backups".format(len(result["removed"]), side))
+        if result["skipped"]:
+            emit_log("Left {0} old {1} backups in place; no trash command was found, "
+                     "use --force to delete them".format(len(result["skipped"]), side),
+                     level=logging.WARN)
+    return results
 
 
 def compare_files(file1: str, file2: str) -> bool:
@@ -84,19 +977,34 @@ def compare_files(file1: str, file2: str) -> bool:
     return file1 == file2
 
 
-def emit_log(msg: str, level=logging.INFO, quiet=False, *args, **kwargs):
-    if not quiet:
-        if "verbose" not in kwargs or kwargs["verbose"] is not True:
-            msg = textwrap.shorten(msg, width=int(get_terminal_dims()[0]) - 5,
-                                   placeholder="...")
-        if level == logging.DEBUG:
-            logging.debug(msg, *args, **kwargs)
-        elif level == logging.INFO:
-            logging.info(msg, *args, **kwargs)
-        elif level == logging.WARN:
-            logging.warn(msg, *args, **kwargs)
-        elif level == logging.ERROR:
-            logging.error(msg, *args, **kwargs)
+def emit_log(msg: str, *args, level=logging.INFO, quiet=False, event=None, **kwargs):
+    """
+    Log 'msg' at 'level'.  Any 'args' and 'kwargs' are formatted into 'msg'
+    with str.format(), but only if the message is going to be written, so
+    suppressed DEBUG lines cost next to nothing.  An 'event' dict is added
+    to the line written to the JSON log (see setup_logging().)
+    """
+    if quiet or not logging.getLogger().isEnabledFor(level):
+        return
+    logging.log(level, LogMessage(msg, args, kwargs), extra={"event": event})
+
+
+def setup_logging(level: int, json_path=None):
+    """
+    Log at 'level' and above to stdout, shortened to fit it if it is a
+    terminal, and to 'json_path' (if given) as JSON lines.  The terminal size
+    is cached and looked up again when the terminal is resized.
+    """
+    console = logging.StreamHandler(sys.stdout)
+    console.setFormatter(TerminalFormatter(LOGFMT))
+    handlers = [console]
+    if json_path:
+        json_handler = logging.FileHandler(json_path)
+        json_handler.setFormatter(JsonLinesFormatter())
+        handlers.append(json_handler)
+    logging.basicConfig(level=level, handlers=handlers)
+    if hasattr(signal, "SIGWINCH") and threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGWINCH, _refresh_terminal_dims)
 
 
 def ensure_required_sections(config: configparser.ConfigParser) -> bool:
@@ -114,12 +1022,16 @@ def error_and_die(msg: str) -> SystemExit:
     sys.exit(1)
 
 
-def file_sync(direction: str, local_path: str, remote_path: str, host: str) -> T[bool, str]:
+def file_sync(direction: str, local_path: str, remote_path: str, host: str,
+              bwlimit=None, compress=0, fsync=False) -> T[bool, str]:
     """
     Sync local and remote files given a 'direction'.  If 'pull', a file is
     synced from 'host':'remote_path' to 'local_path'.  If 'push', a file is
     syned from 'local_path' to 'host':'remote_path'.  If the operation is a
-    success, 'True' is returned, if not then 'False' is returned.
+    success, 'True' is returned, if not then 'False' is returned.  A
+    'bwlimit' is passed on to rsync's --bwlimit, a 'compress' level other
+    than 0 turns on rsync's compression at that level, and 'fsync' passes
+    --fsync (see _rsync_fsync().)
 
     Before doing all that, try to locate a local ssh config file, in case there
     are any local configs we should consider in our connection attempts.
@@ -132,6 +1044,14 @@ def file_sync(direction: str, local_path: str, remote_path: str, host: str) -> T
 
     rsync = ["rsync", ]
     rsync.append("-aPv")
+    rsync.append("--stats")
+    if bwlimit:
+        rsync.append("--bwlimit={}".format(bwlimit))
+    if compress:
+        rsync += ["-z", "--compress-level={}".format(compress)]
+    if fsync:
+        rsync.append("--fsync")
+    rsync += ["-e", shlex.join(ssh_command(host))]
 
     # Build the rsync command list as needed for pulling from a remote host
     if direction == "pull":
@@ -148,9 +1068,9 @@ def file_sync(direction: str, local_path: str, remote_path: str, host: str) -> T
             host, os.path.dirname(remote_path)))
 
     # Run the rsync
-    p = subprocess.Popen(rsync, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-    c = p.communicate()
-    if p.returncode != 0:
+    returncode, *c = _run(rsync)
+    _STATS.rsync_output(c[0].decode(errors="replace"))
+    if returncode != 0:
         # The rsync did not succeed for some reason..
         return c[1].decode().rstrip().replace("\n", " ")
     # Everything should have worked.
@@ -158,42 +1078,706 @@ def file_sync(direction: str, local_path: str, remote_path: str, host: str) -> T
     return True
 
 
+def file_sync_native(direction: str, local_path: str, remote_path: str, host: str,
+                     compress=0, durability="none") -> T[bool, str]:
+    """
+    Sync a file like file_sync() does, without rsync: the receiving side
+    sends the block signature of its copy, the sending side answers with a
+    delta of the blocks that changed, a window at a time over the agent's
+    connection, and the receiving side rebuilds the file next to the old
+    one and renames it into place once its digest matches the source.
+    Memory stays within a few windows however large the file is.  Windows
+    are sent compressed at zlib level 'compress', unless it is 0, and the
+    rebuilt file is flushed to disk at 'durability' (see flush_received().)
+    Returns 'True' or an error string.
+    """
+    if direction == "push":
+        src, dest, sender, receiver = local_path, remote_path, None, host
+    else:
+        src, dest, sender, receiver = remote_path, local_path, host, None
+    patch, resp = None, {"delta": None}
+    try:
+        found = _agent_call(receiver, "signature", paths=[dest])[0]
+        if dest in found["errors"]:
+            return found["errors"][dest]
+        sig = found["results"][dest]
+        while True:
+            resp, data = _agent_call(sender, "delta", path=src, block=sig["block"],
+                                     sums=sig["sums"] if resp["delta"] is None else None,
+                                     delta=resp["delta"], compress=compress)
+            _STATS.count("delta literal bytes", len(data))
+            _STATS.count("delta matched blocks", sum(1 for kind, _ in resp["ops"] if kind == "c"))
+            patch = _agent_call(receiver, "patch", data, path=dest, block=sig["block"],
+                                ops=resp["ops"], final=resp["final"], patch=patch,
+                                compressed=resp.get("compressed", False),
+                                durability=durability)[0]["patch"]
+            if resp["final"]:
+                return True
+    except RemoteAgentException as e:
+        # Drop whatever either side still holds; one of them may already have
+        with contextlib.suppress(RemoteAgentException):
+            if resp.get("delta") is not None and not resp.get("final"):
+                _agent_call(sender, "delta", delta=resp["delta"], abort=True)
+        with contextlib.suppress(RemoteAgentException):
+            if patch is not None:
+                _agent_call(receiver, "patch", patch=patch, abort=True)
+        return str(e)
+
+
+def file_sync_resumable(direction: str, local_path: str, remote_path: str, host: str,
+                        compress=0, durability="none") -> T[bool, str]:
+    """
+    Sync a very large file like file_sync() does, a CHUNK_SIZE chunk at a
+    time over the agent's connection.  The receiving side writes the chunks
+    into a partial file next to the destination and records each one in a
+    journal once it matches the source's digest for it, so a transfer that
+    is cut off carries on with the chunks still missing the next time.  A
+    new transfer starts from the chunks of the existing destination that
+    already match the source's, so only changed chunks are sent.  The
+    partial file is renamed into place once all of its chunks check out,
+    flushed to disk at 'durability'.  Chunks are sent compressed at zlib
+    level 'compress', unless it is 0.  Returns 'True' or an error string.
+    """
+    if direction == "push":
+        src, dest, sender, receiver = local_path, remote_path, None, host
+    else:
+        src, dest, sender, receiver = remote_path, local_path, host, None
+    algorithm = _DIGEST_CACHE.algorithm
+    try:
+        found = _agent_call(sender, "chunks", paths=[src], algorithm=algorithm)[0]
+        if src in found["errors"]:
+            return found["errors"][src]
+        info = found["results"][src]
+        missing = _agent_call(receiver, "resume", path=dest, algorithm=algorithm,
+                              chunk=info["chunk"], chunks=info["chunks"])[0]["missing"]
+        done = len(info["chunks"]) - len(missing)
+        if done:
+            emit_log("{0}: {1} of {2} chunks already there", dest, done, len(info["chunks"]),
+                     level=logging.DEBUG, event={"event": "resume", "path": dest, "done": done,
+                                                 "chunks": len(info["chunks"])})
+        for i in missing:
+            resp, data = _agent_call(sender, "fetch", path=src, index=i, chunk=info["chunk"],
+                                     compress=compress)
+            _agent_call(receiver, "chunk", data, path=dest, index=i,
+                        compressed=resp.get("compressed", False))
+            _STATS.count("chunk bytes", len(data))
+        _agent_call(receiver, "finish", path=dest, length=info["size"], mode=info["mode"],
+                    mtime=info["mtime"], durability=durability)
+    except RemoteAgentException as e:
+        return str(e)
+    return True
+
+
+def _group_by_dest_dir(direction: str, entries: dict) -> dict:
+    "Group 'entries' by the directory each one is synced into."
+    groups = {}
+    for key, (local_path, remote_path) in entries.items():
+        if direction == "push":
+            src, dest = local_path, remote_path
+        else:
+            src, dest = remote_path, local_path
+        groups.setdefault(os.path.dirname(dest), []).append((key, src))
+    return groups
+
+
+def _file_sync_group(direction: str, dest_dir: str, group: list, host: str,
+                     compress=0, fsync=False) -> dict:
+    "Sync every '(key, src)' pair in 'group' into 'dest_dir' with one rsync."
+    # Sources are listed relative to '/' so unrelated source dirs can share a run
+    with tempfile.NamedTemporaryFile("w", prefix="filesync-", suffix=".list") as files_from:
+        files_from.write("\0".join(src.lstrip("/") for _, src in group))
+        files_from.flush()
+        rsync = ["rsync", "-aPv", "--stats", "-r", "--no-relative", "--from0",
+                 "--files-from={}".format(files_from.name), "-e", shlex.join(ssh_command(host))]
+        if compress:
+            rsync += ["-z", "--compress-level={}".format(compress)]
+        if fsync:
+            rsync.append("--fsync")
+        if direction == "pull":
+            rsync += ["{}:/".format(host), dest_dir]
+        elif direction == "push":
+            rsync += ["/", "{0}:{1}".format(host, dest_dir)]
+        returncode, *c = _run(rsync)
+    return _rsync_results(returncode, c, {key: src.lstrip("/") for key, src in group})
+
+
+def _rsync_results(returncode: int, c: list, names: dict) -> dict:
+    """
+    Return the result of each key in 'names' after an rsync run with many
+    sources: an error string if one of rsync's error lines quotes its path
+    (or rsync's temp file for it), or if the run failed as a whole, or else
+    True.  'names' are relative, so a quoted path matches when it is the
+    name or ends in '/' and the name.
+    """
+    results = {}
+    _STATS.rsync_output(c[0].decode(errors="replace"))
+    errors = c[1].decode().splitlines()
+    # Each error line's quoted paths, with rsync's '.NAME.XXXXXX' temp files as NAME
+    quoted = [{RSYNC_TEMP.sub(r"\1\2", "/" + path) for path in re.findall(r'"([^"]+)"', line)}
+              for line in errors]
+    for key, name in names.items():
+        failed = [line for line, paths in zip(errors, quoted)
+                  if any(path.endswith("/" + name) for path in paths)]
+        if failed:
+            results[key] = " ".join(failed)
+        elif returncode not in (0, 23, 24):
+            # Not a partial transfer; the whole group failed
+            results[key] = " ".join(errors)
+        else:
+            results[key] = True
+    return results
+
+
+def file_sync_batch(direction: str, entries: dict, host: str, jobs=1, compress=None,
+                    fsync=False) -> dict:
+    """
+    Sync many entries at once.  'entries' maps a config key to its
+    '(local_path, remote_path)' pair; entries sharing a destination directory
+    are synced with a single rsync that reads its sources from a generated
+    file list.  Up to 'jobs' of those rsyncs run at the same time.  Each
+    rsync compresses at the highest of its keys' levels in 'compress', and
+    with 'fsync' is passed --fsync.  Returns a dict of each key and its
+    result, which is 'True' or an error string just like file_sync() would
+    give.
+    """
+    results = {}
+    compress = compress or {}
+    groups = _group_by_dest_dir(direction, entries)
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        futures = [pool.submit(_file_sync_group, direction, dest_dir, group, host,
+                               max(compress.get(key, 0) for key, _ in group), fsync)
+                   for dest_dir, group in groups.items()]
+        for future in as_completed(futures):
+            results.update(future.result())
+    return results
+
+
+def _tree_spec(path: str) -> T[tuple, None]:
+    """
+    Return '(root, pattern)' for a directory ('path/') or 'glob:' entry,
+    where 'pattern' is a list of glob parts under 'root', or None for every
+    file in it.  Returns None for an entry that is a single file.
+    """
+    if path.startswith(GLOB_PREFIX):
+        parts = path[len(GLOB_PREFIX):].split("/")
+        first = next((i for i, part in enumerate(parts) if re.search(r"[*?[]", part)),
+                     len(parts) - 1)
+        return "/".join(parts[:first]) or "/", parts[first:]
+    if path.endswith("/"):
+        return path.rstrip("/") or "/", None
+    return None
+
+
+def _tree_root(path: str) -> str:
+    "Return the directory the files of a tree entry go into on the side configured as 'path'."
+    spec = _tree_spec(path)
+    return spec[0] if spec else path.rstrip("/") or "/"
+
+
+def _relative_glob(path: str) -> bool:
+    "Whether 'path' is a 'glob:' entry that does not start from '/' or '~', and so has no root."
+    return path.startswith(GLOB_PREFIX) and not path[len(GLOB_PREFIX):].startswith(("/", "~"))
+
+
+def walk_tree(root: str, pattern=None, host=None, dirs=False):
+    """
+    Yield '[relpath, size, mtime]' for every regular file under 'root' that
+    matches the glob 'pattern' parts, on 'host' if one is given, and with
+    'dirs', '[relpath, None, subdirs]' after each directory's files (see
+    agent.scan_tree().)  A remote tree is read SCAN_PAGE files per agent
+    request, so neither side holds the whole listing.
+    """
+    if not host:
+        yield from agent.scan_tree(root, pattern, dirs)
+        return
+    scan = None
+    while True:
+        resp = get_agent(host).call("scan", root=root, pattern=pattern, scan=scan,
+                                    limit=SCAN_PAGE, dirs=dirs)[0]
+        yield from resp["files"]
+        if resp["done"]:
+            return
+        scan = resp["scan"]
+
+
+def file_sync_tree(direction: str, local_root: str, remote_root: str, rels: list,
+                   host: str, transfer="rsync", durability="none") -> dict:
+    """
+    Sync the files at the relative paths 'rels' from one root to the other
+    with one rsync, which creates any directories they need, or one by one
+    with file_sync_native() if 'transfer' is "native".  At a 'durability'
+    of "file", each file is flushed to disk before its rename where the
+    receiving side can (see _rsync_fsync().)  Returns each relative path's
+    result, 'True' or an error string.
+    """
+    if transfer == "native":
+        return {rel: file_sync_native(direction, os.path.join(local_root, rel),
+                                      os.path.join(remote_root, rel), host,
+                                      durability=durability) for rel in rels}
+    if direction == "pull":
+        os.makedirs(os.path.expanduser(local_root), exist_ok=True)
+    with tempfile.NamedTemporaryFile("w", prefix="filesync-", suffix=".list") as files_from:
+        files_from.write("\0".join(rels))
+        files_from.flush()
+        rsync = ["rsync", "-aPv", "--stats", "--from0", "--files-from={}".format(files_from.name),
+                 "-e", shlex.join(ssh_command(host))]
+        if durability == "file" and _rsync_fsync(direction, host):
+            rsync.append("--fsync")
+        if direction == "pull":
+            rsync += ["{0}:{1}/".format(host, remote_root), os.path.expanduser(local_root) + "/"]
+        elif direction == "push":
+            rsync += [os.path.expanduser(local_root) + "/", "{0}:{1}/".format(host, remote_root)]
+        returncode, *c = _run(rsync)
+    return _rsync_results(returncode, c, {rel: rel for rel in rels})
+
+
+def sync_tree(direction: str, local_path: str, remote_path: str, host: str,
+              manifest=None, files=None, transfer="rsync", durability="none") -> T[bool, str]:
+    """
+    Sync the files of a directory ('path/') or 'glob:' entry, where either
+    side may be given as a plain directory.  The source side is walked with
+    walk_tree() and only files whose '[size, mtime]' differs from that
+    recorded in 'manifest', a TreeManifest, are sent, up to TREE_CHUNK of
+    them per rsync.  The destination is not walked, so files changed there
+    by anything else are only noticed when their source changes.  Neither
+    the walk nor the manifest holds more than a directory's listing at a
+    time; the manifest's record of each directory is rewritten once it has
+    been walked, without its files and subdirectories that are gone.  A glob
+    must start from an absolute path or one under '~'.
+    When 'files' is given, those '[relpath, size, mtime]' are sent instead
+    of walking the tree and comparing it with the manifest.  'transfer' and
+    'durability' are passed on to file_sync_tree(), and unless 'durability'
+    is "none", each chunk's files are flushed to disk together once sent.
+
+    Returns True, or an error string naming the files that failed.
+    """
+    for path in (local_path, remote_path):
+        if _relative_glob(path):
+            return "A glob needs an absolute path or one under '~': {}".format(path)
+    local_root, remote_root = _tree_root(local_path), _tree_root(remote_path)
+    if direction == "push":
+        root, specs = local_root, (_tree_spec(local_path), _tree_spec(remote_path))
+    else:
+        root, specs = remote_root, (_tree_spec(remote_path), _tree_spec(local_path))
+    pattern = (specs[0] or specs[1])[1]
+    failed, chunk = [], []
+
+    def _send():
+        results = file_sync_tree(direction, local_root, remote_root, [rel for rel, _ in chunk],
+                                 host, transfer, "file" if durability == "file" else "none")
+        if durability != "none":
+            dest_root = remote_root if direction == "push" else local_root
+            paths = [os.path.join(dest_root, rel) for rel, _ in chunk if results[rel] is True]
+            _warn_unflushed(flush_received(direction, paths, host), host)
+        now = time.time()
+        for rel, meta in chunk:
+            if results[rel] is not True:
+                failed.append("{0}: {1}".format(rel, results[rel]))
+        if manifest:
+            # A racy file is sent again next time, once its mtime can be trusted
+            manifest.update({rel: meta if results[rel] is True and not _racy(meta, now) else None
+                             for rel, meta in chunk})
+        chunk.clear()
+
+    if files is None:
+        walk = walk_tree(root, pattern, None if direction == "push" else host, dirs=True)
+    else:
+        walk = iter(files)
+    try:
+        for rel, size, mtime in walk:
+            if size is None:
+                # The end of directory 'rel'; 'mtime' holds its subdirectories
+                if manifest:
+                    manifest.finish_dir(rel, mtime)
+                continue
+            if files is None and manifest and manifest.get(rel) == [size, mtime]:
+                manifest.keep(rel, [size, mtime])
+                continue
+            chunk.append((rel, [size, mtime]))
+            if len(chunk) >= TREE_CHUNK:
+                _send()
+        if chunk:
+            _send()
+    except RemoteAgentException as e:
+        return str(e)
+    if failed:
+        return "{0} files failed: {1}".format(len(failed), "; ".join(failed))
+    return True
+
+
+def _run(cmd: list, input=None, **kwargs) -> tuple:
+    """
+    Run 'cmd' to completion, counting it and its wall time in the run's stats.
+    Returns its '(returncode, stdout, stderr)'.
+    """
+    kwargs.setdefault("stdout", subprocess.PIPE)
+    kwargs.setdefault("stderr", subprocess.PIPE)
+    start = time.monotonic()
+    p = subprocess.Popen(cmd, **kwargs)
+    out, err = p.communicate(input)
+    _STATS.process(cmd, time.monotonic() - start)
+    return p.returncode, out, err
+
+
+def _agent_call(host: T[str, None], op: str, payload=b"", **args) -> tuple:
+    """
+    Run agent request 'op' on 'host' through its RemoteAgent, or in this
+    process when 'host' is None.  Returns the '(response, payload)' pair.
+    """
+    if host:
+        return get_agent(host).call(op, payload, **args)
+    try:
+        return agent.OPS[op](args, payload)
+    except Exception as e:
+        raise RemoteAgentException("{0}: {1}".format(type(e).__name__, e))
+
+
+def flush_received(direction: str, paths: list, host: str) -> dict:
+    """
+    Flush the files at 'paths' that a sync in 'direction' received (on
+    'host' for a push, on this host for a pull) to disk, FSYNC_BATCH at a
+    time: each batch of files and then their directories, so the renames
+    that put them in place last too.
+
+    This is the "batch" durability level.  At "file", each received file is
+    flushed before and after its rename on its own, and at "none" nothing
+    is flushed, leaving it to the system.
+
+    When the agent cannot run on 'host' (without python3 there, say), none
+    of the files are flushed; a system-wide 'sync' is not run in its place.
+    Returns a dict of each path that could not be flushed and why.
+    """
+    errors = {}
+    receiver = host if direction == "push" else None
+    for i in range(0, len(paths), FSYNC_BATCH):
+        with _STATS.span("fsync"):
+            try:
+                found = _agent_call(receiver, "fsync", paths=paths[i:i + FSYNC_BATCH])[0]
+            except RemoteAgentException as e:
+                if receiver is None:
+                    found = {"errors": {path: str(e) for path in paths[i:i + FSYNC_BATCH]}}
+                else:
+                    errors.update({path: str(e) for path in paths[i:]})
+                    return errors
+        errors.update(found["errors"])
+    return errors
+
+
+def _warn_unflushed(errors: dict, host: str):
+    "Log each of the received files in 'errors' that flush_received() could not flush."
+    for path, error in errors.items():
+        emit_log("{0}: synced with \"{1}\", but unable to flush to disk: {2}", path, host, error,
+                 level=logging.WARN, event={"event": "flush error", "path": path, "host": host,
+                                            "error": error})
+
+
+def _rsync_fsync(direction: str, host: str) -> bool:
+    """
+    Return True if the rsync receiving a sync in 'direction' (on 'host' for
+    a push, on this host for a pull) takes --fsync, which flushes each file
+    to disk before its rename.  Only rsync 3.2.4 and later do; each host is
+    asked once per run.
+    """
+    receiver = host if direction == "push" else None
+    if receiver not in _RSYNC_FSYNC:
+        cmd = ["rsync", "--help"]
+        if receiver:
+            cmd = ssh_command(host) + [host, "rsync --help"]
+        returncode, out, err = _run(cmd)
+        _RSYNC_FSYNC[receiver] = "--fsync" in out.decode(errors="replace")
+    return _RSYNC_FSYNC[receiver]
+
+
+def _archive_groups(direction: str, entries: dict, sizes=None) -> list:
+    """
+    Split 'entries' into lists of '(key, src, dest)' of at most
+    SMALL_ARCHIVE_SIZE bytes and SMALL_ARCHIVE_FILES files, so neither side
+    holds more than that in memory at once.  Each source's size comes from
+    'sizes', a dict of each key's size, or for a push from the file itself.
+    """
+    groups, group, size = [], [], 0
+    for key, (local_path, remote_path) in entries.items():
+        if direction == "push":
+            src, dest = local_path, remote_path
+        else:
+            src, dest = remote_path, local_path
+        # Like rsync, keep the source's name in the destination directory
+        dest = os.path.join(os.path.dirname(dest), os.path.basename(src))
+        n = (sizes or {}).get(key)
+        if n is None and direction == "push":
+            n = (_local_meta(src) or [0])[0]
+        n = n or 0
+        if group and (size + n > SMALL_ARCHIVE_SIZE or len(group) >= SMALL_ARCHIVE_FILES):
+            groups.append(group)
+            group, size = [], 0
+        group.append((key, src, dest))
+        size += n
+    if group:
+        groups.append(group)
+    return groups
+
+
+def file_sync_small(direction: str, entries: dict, host: str, durability="none",
+                    sizes=None) -> dict:
+    """
+    Sync small regular files without rsync.  'entries' is like it is for
+    file_sync_batch(); the source files are packed into tar archives that go
+    over the remote agent's connection and are unpacked next to their
+    destinations, each file renamed into place with its mode and mtime.
+    Archives are kept within SMALL_ARCHIVE_SIZE by the sources' 'sizes', a
+    dict of each key's size, which a pull needs to be given.  Each
+    archive's files are flushed to disk together at 'durability' (see
+    flush_received().)  Returns a dict of each key and its result, 'True'
+    or an error string.  Keys whose source is not a regular file itself (a
+    symlink, say) are left out, to be sent with rsync.
+    """
+    results = {}
+    for group in _archive_groups(direction, entries, sizes):
+        srcs = [src for _, src, _ in group]
+        try:
+            if direction == "push":
+                packed, data = agent.pack_archive(srcs)
+            else:
+                packed, data = get_agent(host).call("pack", paths=srcs)
+            # Members are named by their index in 'srcs', which may repeat a source
+            left = set(packed["errors"]) | set(packed.get("skipped", []))
+            files = {str(i): dest for i, (_, src, dest) in enumerate(group) if src not in left}
+            if direction == "push":
+                unpacked = get_agent(host).call("unpack", data, files=files,
+                                                durability=durability)[0]
+            else:
+                unpacked = agent.unpack_archive(data, files, durability)
+        except RemoteAgentException as e:
+            results.update({key: str(e) for key, _, _ in group})
+            continue
+        for key, src, dest in group:
+            if src in packed.get("skipped", []):
+                continue
+            if src in packed["errors"]:
+                results[key] = packed["errors"][src]
+            elif dest in unpacked["errors"]:
+                results[key] = unpacked["errors"][dest]
+            else:
+                results[key] = True
+    return results
+
+
+def _refresh_terminal_dims(signum=None, frame=None):
+    global _TERMINAL_DIMS
+    _TERMINAL_DIMS = tuple(shutil.get_terminal_size(fallback=(80, 24)))
+
+
 def get_terminal_dims() -> tuple:
-    tty = os.popen('stty size', 'r')
-    y, x = tty.read().split()
-    tty.close()
-    return x, y
+    "Return the terminal's '(columns, rows)', or '(80, 24)' without a terminal."
+    if _TERMINAL_DIMS is None:
+        _refresh_terminal_dims()
+    return _TERMINAL_DIMS
+
+
+def _is_batched(config: configparser.ConfigParser) -> bool:
+    if "batch" in config["global"].keys():
+        return config["global"].getboolean("batch")
+    return False
 
 
 def _is_forced(config: configparser.ConfigParser) -> bool:
     if "force" in config["global"].keys():
-        return config["global"]["force"]
+        return config["global"].getboolean("force")
     return False
 
 
+def _get_cache_size(config: configparser.ConfigParser) -> int:
+    if "cache size" in config["global"].keys():
+        return config["global"].getint("cache size")
+    return DEFAULT_CACHE_SIZE
+
+
+def _compress_setting(value: str) -> T[int, None]:
+    "Parse a 'compress' setting: a zlib level, yes or no, or auto (None.)"
+    value = value.strip().lower()
+    if value == "auto":
+        return None
+    if value in configparser.ConfigParser.BOOLEAN_STATES:
+        return 6 if configparser.ConfigParser.BOOLEAN_STATES[value] else 0
+    if value.isdigit() and int(value) <= 9:
+        return int(value)
+    raise ValueError("Unknown compress setting: {}".format(value))
+
+
+def _get_compress(config: configparser.ConfigParser) -> dict:
+    """
+    Return each key's compression setting (see _compress_setting()) from the
+    [compress] section, or from 'compress' in [global] for the keys it lacks.
+    """
+    default = None
+    if "compress" in config["global"].keys():
+        default = _compress_setting(config["global"]["compress"])
+    settings = {k: default for s in ("local", "remote") if s in config.sections()
+                for k in config[s].keys()}
+    if "compress" in config.sections():
+        settings.update({k: _compress_setting(v) for k, v in config["compress"].items()})
+    return settings
+
+
+def _get_digest(config: configparser.ConfigParser) -> str:
+    if "digest" in config["global"].keys():
+        return config["global"]["digest"].strip().lower()
+    return DEFAULT_DIGEST
+
+
+def _get_durability(config: configparser.ConfigParser) -> str:
+    if "durability" in config["global"].keys():
+        return config["global"]["durability"].strip().lower()
+    return DEFAULT_DURABILITY
+
+
+def _get_jobs(config: configparser.ConfigParser) -> int:
+    if "jobs" in config["global"].keys():
+        return config["global"].getint("jobs")
+    return 1
+
+
+def _get_resume_size(config: configparser.ConfigParser) -> int:
+    if "resume size" in config["global"].keys():
+        return config["global"].getint("resume size")
+    return RESUME_SIZE
+
+
+def _get_retention(config: configparser.ConfigParser) -> dict:
+    "Return the backup retention policy; without one, the newest KEEP_LAST are kept."
+    g = config["global"]
+    policy = {"keep_last": g.getint("keep last"), "keep_days": g.getint("keep days"),
+              "max_size": g.getint("max backup size")}
+    if all(v is None for v in policy.values()):
+        policy["keep_last"] = KEEP_LAST
+    return policy
+
+
+def _get_bwlimit(config: configparser.ConfigParser) -> T[str, None]:
+    if "bwlimit" in config["global"].keys():
+        return config["global"]["bwlimit"]
+    return None
+
+
+def _get_large_file_size(config: configparser.ConfigParser) -> int:
+    if "large file size" in config["global"].keys():
+        return config["global"].getint("large file size")
+    return LARGE_FILE_SIZE
+
+
+def _get_large_jobs(config: configparser.ConfigParser) -> int:
+    if "large jobs" in config["global"].keys():
+        return config["global"].getint("large jobs")
+    return 1
+
+
+def _get_priorities(config: configparser.ConfigParser) -> dict:
+    "Return each key's priority from the [priority] section; higher goes first."
+    if "priority" in config.sections():
+        return {k: config["priority"].getint(k) for k in config["priority"].keys()}
+    return {}
+
+
+def _get_parallel_hosts(config: configparser.ConfigParser) -> int:
+    if "parallel hosts" in config["global"].keys():
+        return config["global"].getint("parallel hosts")
+    return 0
+
+
+def _get_remote_hosts(config: configparser.ConfigParser) -> list:
+    "Return the 'remote hosts' list (split on commas or spaces), or the one 'remote host'."
+    if "remote hosts" in config["global"].keys():
+        return config["global"]["remote hosts"].replace(",", " ").split()
+    return [config["global"]["remote host"]]
+
+
+def _get_small_file_size(config: configparser.ConfigParser) -> int:
+    if "small file size" in config["global"].keys():
+        return config["global"].getint("small file size")
+    return SMALL_FILE_SIZE
+
+
+def _get_watch_delay(config: configparser.ConfigParser) -> float:
+    if "watch delay" in config["global"].keys():
+        return config["global"].getfloat("watch delay")
+    return WATCH_DELAY
+
+
+def _get_watch_interval(config: configparser.ConfigParser) -> float:
+    if "watch interval" in config["global"].keys():
+        return config["global"].getfloat("watch interval")
+    return WATCH_INTERVAL
+
+
+def _get_transfer(config: configparser.ConfigParser) -> str:
+    if "transfer" in config["global"].keys():
+        return config["global"]["transfer"].strip().lower()
+    return "rsync" if shutil.which("rsync") else "native"
+
+
+def _use_manifest(config: configparser.ConfigParser) -> bool:
+    if "manifest" in config["global"].keys():
+        return config["global"].getboolean("manifest")
+    return True
+
+
+def _is_multiplexed(config: configparser.ConfigParser) -> bool:
+    if "multiplex" in config["global"].keys():
+        return config["global"].getboolean("multiplex")
+    return True
+
+
 def _is_verbose(config: configparser.ConfigParser) -> bool:
     if "verbose" in config["global"].keys():
         return config["global"]["verbose"]
     return False
 
 
-def make_backup_file(path: str, host=None) -> T[bool, str]:
-    backup = path + "-" + datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
-    if host:
-        cmd = ["ssh", "{}".format(host), "/bin/cp", "-afr",
-               "{}".format(shlex.quote(path)), "{}".format(shlex.quote(backup))]
-    else:
-        cmd = ["/bin/cp", "-afr", "{}".format(path), "{}".format(backup)]
-    p = subprocess.Popen(cmd, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-    c = p.communicate()
-    if p.returncode != 0:
-        return False, c[1].decode()
-    return backup
+def make_backup_file(path: str, host=None, key=None) -> T[bool, str]:
+    """
+    Back 'path' up next to itself with a timestamp suffix, on 'host' if one
+    is given.  Each distinct version of a file is kept once in the backup
+    store, which the backup is a hardlink or reflink of.  Returns the backup
+    path, or a '(False, error)' tuple.
+    """
+    suffix = "-" + datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
+    try:
+        with _STATS.span("backup", key):
+            result = _agent_call(host, "backup", paths=[path], suffix=suffix,
+                                 store=BACKUP_STORE, key=key)[0]
+    except RemoteAgentException as e:
+        return False, str(e)
+    if path in result["errors"]:
+        return False, result["errors"][path]
+    return result["results"][path]
+
+
+def list_backups(path: str, host=None) -> list:
+    """
+    Return the backup store's records of every backup of 'path' (on 'host'
+    if one is given), oldest first.  Each is a dict with the 'key', 'backup'
+    path, content 'digest', 'size' and 'time' of the backup.
+    """
+    return _agent_call(host, "versions", path=path, store=BACKUP_STORE)[0]["versions"]
+
+
+def restore_backup(path: str, digest: str, host=None) -> T[bool, str]:
+    """
+    Atomically replace 'path' (on 'host' if one is given) with the version
+    of it whose content has 'digest'.  Returns True or an error string.
+    """
+    try:
+        _agent_call(host, "restore", path=path, digest=digest, store=BACKUP_STORE)
+    except RemoteAgentException as e:
+        return str(e)
+    return True
 
 
 def read_config_file(f: str) -> T[configparser.ConfigParser, int]:
     c = configparser.ConfigParser()
-    if c.read(f):
+    with _STATS.span("config"):
+        found = c.read(f)
+    if found:
         # Return the loaded config file object
         return c
     else:
@@ -202,6 +1786,117 @@ def read_config_file(f: str) -> T[configparser.ConfigParser, int]:
 '{}'.".format(DEFAULT_CONF_FILE))
 
 
+def _control_path(host: str) -> str:
+    global _SSH_CONTROL_DIR
+    if not _SSH_CONTROL_DIR:
+        _SSH_CONTROL_DIR = tempfile.mkdtemp(prefix="filesync-ssh-")
+    # Hash the host so the socket path stays short and filename-safe, and
+    # whose masters these are, as each Session keeps its own
+    name = "{0}:{1}".format(id(_SSH_MASTERS), host)
+    return os.path.join(_SSH_CONTROL_DIR, hashlib.sha1(name.encode()).hexdigest()[:16])
+
+
+def start_ssh_master(host: str) -> T[str, None]:
+    """
+    Start a multiplexed ssh master connection to 'host' that every later ssh
+    and rsync call for that host reuses.  Returns the control socket path, or
+    None if the master could not be started.
+    """
+    with _SSH_MASTERS_LOCK:
+        if host in _SSH_MASTERS:
+            return _SSH_MASTERS[host]
+        lock = _SSH_MASTER_LOCKS.setdefault(host, threading.Lock())
+        path = _control_path(host)
+    # Only callers for the same host wait on its handshake
+    with lock:
+        with _SSH_MASTERS_LOCK:
+            if host in _SSH_MASTERS:
+                return _SSH_MASTERS[host]
+        cmd = ["ssh", "-o", "ControlMaster=yes", "-o", "ControlPersist={}".format(SSH_PERSIST),
+               "-o", "ControlPath={}".format(path), "-N", "-f", host]
+        returncode, *c = _run(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+        if returncode != 0:
+            emit_log("Unable to start an ssh master for \"{0}\": {1}".format(
+                host, c[1].decode().rstrip()), level=logging.DEBUG)
+            path = None
+        with _SSH_MASTERS_LOCK:
+            if not _SSH_MASTERS:
+                atexit.register(stop_ssh_masters, _SSH_MASTERS)
+            _SSH_MASTERS[host] = path
+        return path
+
+
+def stop_ssh_masters(masters=None):
+    """
+    Close every ssh master connection in 'masters', by default those opened
+    by start_ssh_master() for the current run or Session.
+    """
+    global _SSH_CONTROL_DIR
+    masters = _SSH_MASTERS if masters is None else masters
+    with _SSH_MASTERS_LOCK:
+        for host, path in masters.items():
+            if path:
+                _run(["ssh", "-o", "ControlPath={}".format(path), "-O", "exit", host],
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                     stderr=subprocess.DEVNULL)
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+        masters.clear()
+        if _SSH_CONTROL_DIR:
+            # Other sessions' masters may still be in there
+            try:
+                os.rmdir(_SSH_CONTROL_DIR)
+                _SSH_CONTROL_DIR = None
+            except OSError:
+                pass
+
+
+def get_agent(host: str) -> RemoteAgent:
+    "Return the RemoteAgent for 'host', starting it on first use."
+    with _AGENTS_LOCK:
+        if host in _AGENTS:
+            return _AGENTS[host]
+        lock = _AGENT_LOCKS.setdefault(host, threading.Lock())
+    # Only callers for the same host wait on its agent starting up
+    with lock:
+        with _AGENTS_LOCK:
+            if host in _AGENTS:
+                return _AGENTS[host]
+        remote = RemoteAgent(host)
+        with _AGENTS_LOCK:
+            if not _AGENTS:
+                atexit.register(stop_agents, _AGENTS)
+            _AGENTS[host] = remote
+        return remote
+
+
+def stop_agents(agents=None):
+    """
+    Shut down every RemoteAgent in 'agents', by default those started by
+    get_agent() for the current run or Session.
+    """
+    agents = _AGENTS if agents is None else agents
+    with _AGENTS_LOCK:
+        for remote in agents.values():
+            remote.close()
+        agents.clear()
+
+
+def ssh_command(host: str) -> list:
+    """
+    Return the ssh command list (without the host) to reach 'host', routed
+    through its multiplexed master connection when one is available.
+    """
+    if not _SSH_MULTIPLEX:
+        return ["ssh"]
+    path = start_ssh_master(host)
+    if path:
+        return ["ssh", "-o", "ControlPath={}".format(path)]
+    return ["ssh"]
+
+
 def _check_file(d: dict, k: str, padding: int, local: bool, remote: bool) -> bool:
     if local:
         src = "local"
@@ -209,22 +1904,152 @@ def _check_file(d: dict, k: str, padding: int, local: bool, remote: bool) -> boo
     elif remote:
         dest = "local"
         src = "remote"
-    emit_log("{0: <{n}}Checking {1} file...".format(
-        k + ':', src, n=padding), level=logging.DEBUG)
+    emit_log("{0: <{n}}Checking {1} file...", k + ':', src, n=padding, level=logging.DEBUG)
     try:
         f = d[k][src]
-        emit_log("{0: <{n}}{1} file found: {2}".format(
-            k + ':', src.capitalize(), f, n=padding), level=logging.DEBUG)
+        emit_log("{0: <{n}}{1} file found: {2}", k + ':', src.capitalize(), f, n=padding,
+                 level=logging.DEBUG)
         return f
     except KeyError:
         f = None
-        emit_log(
-            "{0: <{n}}No {1} file configured, attempting to mimic {2} path..."
-            .format(k + ':', src, dest, n=padding), level=logging.DEBUG)
+        emit_log("{0: <{n}}No {1} file configured, attempting to mimic {2} path...",
+                 k + ':', src, dest, n=padding, level=logging.DEBUG)
         return f
 
 
-def sync_files(config: configparser.ConfigParser, direction: str, verbose=False):
+def _build_sync_dict(config: configparser.ConfigParser) -> dict:
+    "Merge the [local] and [remote] sections into one dict keyed by entry name."
+    sync_dict = {}
+    for k, v in config["local"].items():
+        sync_dict.update({k: {"local": v}})
+    for k, v in config["remote"].items():
+        try:
+            sync_dict[k]["remote"] = v
+        except KeyError:
+            # This is a remote file with no configured local file
+            sync_dict.update({k: {"remote": v}})
+    return sync_dict
+
+
+def _resolve_paths(d: dict, k: str, padding: int) -> tuple:
+    """
+    Return the '(local, remote)' paths for 'k', mimicking the opposite path
+    when one side is not configured.
+    """
+    local_file = _check_file(d, k, padding, True, False)
+    remote_file = _check_file(d, k, padding, False, True)
+    return local_file or remote_file, remote_file or local_file
+
+
+def _log_sync_result(key: str, direction: str, local_file: str, remote_file: str,
+                     host: str, synced: T[bool, str], padding: int):
+    if direction == "push":
+        name, word = local_file.rstrip('/').split('/')[-1], "to"
+    else:
+        name, word = remote_file.rstrip('/').split('/')[-1], "from"
+    event = {"event": "synced" if synced is True else "failed", "key": key,
+             "direction": direction, "local": local_file, "remote": remote_file, "host": host}
+    if synced is True:
+        emit_log("{0: <{n}}\"{1}\" synced {2} \"{3}\"", key + ':', name, word, host, n=padding,
+                 event=event)
+    else:
+        emit_log("{0: <{n}}Unable to sync \"{1}\" {2} \"{3}\": {4}", key + ':', name, word, host,
+                 synced, n=padding, level=logging.ERROR, event=dict(event, error=synced))
+
+
+def _log_summary(results: dict, host: str):
+    failed = [k for k, v in results.items() if v is not True]
+    emit_log("{0} of {1} entries synced with \"{2}\", {3} failed{4}", len(results) - len(failed),
+             len(results), host, len(failed), ": " + ", ".join(failed) if failed else "",
+             level=logging.ERROR if failed else logging.INFO,
+             event={"event": "summary", "host": host, "synced": len(results) - len(failed),
+                    "failed": failed})
+
+
+def _log_host_summary(results: dict):
+    "Log, for each key, how many of the hosts in 'results' it was synced with."
+    keys = sorted({key for host_results in results.values() for key in host_results})
+    padding = max([len(k) for k in keys] or [0]) + 3
+    for key in keys:
+        failed = [host for host, host_results in results.items()
+                  if host_results.get(key, True) is not True]
+        emit_log("{0: <{n}}Synced with {1} of {2} hosts{3}", key + ':', len(results) - len(failed),
+                 len(results), ", failed on: " + ", ".join(failed) if failed else "", n=padding,
+                 level=logging.ERROR if failed else logging.INFO,
+                 event={"event": "hosts summary", "key": key, "failed": failed})
+
+
+def compression_level(path: str, ratios: dict, rate=None) -> int:
+    """
+    Return the zlib level to send 'path' at, or 0 to send it as it is: the
+    choice that takes the fewest seconds per byte, counting the time spent
+    compressing, on a link of 'rate' bytes per second (DEFAULT_LINK_RATE if
+    it is not known.)  'ratios' maps each level in COMPRESS_LEVELS that was
+    probed to how small the file got at it.  Files with an extension in
+    INCOMPRESSIBLE are never compressed.
+    """
+    if os.path.splitext(path)[1].lower() in INCOMPRESSIBLE:
+        return 0
+    rate = rate or DEFAULT_LINK_RATE
+    best, cost = 0, 1 / rate
+    for level, ratio in sorted(ratios.items()):
+        level_cost = ratio / rate + 1 / COMPRESS_LEVELS[level]
+        if level_cost < cost:
+            best, cost = level, level_cost
+    return best
+
+
+def _compression_levels(direction: str, entries: dict, host: str, settings: dict,
+                        rate=None) -> dict:
+    """
+    Return the compression level of each of 'entries' ('key: (local, remote)'):
+    its level in 'settings', or for keys set to None there, compression_level()
+    from a probe of its source file.  The probes of the remote files take one
+    agent request.
+    """
+    levels, probes = {}, {}
+    for key, (local_path, remote_path) in entries.items():
+        src = local_path if direction == "push" else remote_path
+        if settings.get(key) is not None:
+            levels[key] = settings[key]
+        elif os.path.splitext(src)[1].lower() in INCOMPRESSIBLE:
+            levels[key] = 0
+        else:
+            probes[key] = src
+    if probes:
+        try:
+            found = _agent_call(None if direction == "push" else host, "probe",
+                                paths=list(probes.values()), levels=list(COMPRESS_LEVELS))[0]
+        except RemoteAgentException as e:
+            emit_log("Unable to probe files for compression: {}", e, level=logging.WARN)
+            found = {"results": {}}
+        for key, src in probes.items():
+            ratios = dict(zip(COMPRESS_LEVELS, found["results"].get(src, [])))
+            levels[key] = compression_level(src, ratios, rate)
+    return levels
+
+
+def schedule_transfers(sizes: dict, priorities: dict, large_file_size: int) -> tuple:
+    """
+    Split the keys of 'sizes' (each key's size in bytes, or None if it is
+    not known) into '(small, large)' lists, where 'large' has the keys of at
+    least 'large_file_size' bytes.  Each list is ordered by descending
+    priority (from 'priorities', 0 by default) and then by ascending size.
+    """
+    def _order(key: str) -> tuple:
+        return -priorities.get(key, 0), sizes[key] or 0
+
+    small = sorted((k for k, v in sizes.items() if (v or 0) < large_file_size), key=_order)
+    large = sorted((k for k, v in sizes.items() if (v or 0) >= large_file_size), key=_order)
+    return small, large
+
+
+def sync_files(config: configparser.ConfigParser, direction: str, verbose=False,
+               batch=False, jobs=1, manifest=None, small_file_size=0, keys=None, host=None,
+               local_files=None, large_file_size=LARGE_FILE_SIZE, large_jobs=1, bwlimit=None,
+               priorities=None, remote_stats=None, throughput=None, transfer="rsync",
+               compress=None, resume_size=RESUME_SIZE,
+               durability=DEFAULT_DURABILITY) -> dict:
     """
     Sync 'src' to 'dest', or 'dest' to 'src' (depending on the 'direction',)
     but check the sha256sum of each file first to ensure that a sync
@@ -247,110 +2072,877 @@ def sync_files(config: configparser.ConfigParser, direction: str, verbose=False)
     is pulled with no configured local path, or a local file pushed with no
     configured remote path, then an attempt is made to mimic the opposite path
     and do the right thing.
+
+    When 'batch' is True, all entries are handed to file_sync_batch() so that
+    each destination directory costs one rsync instead of one per entry.  When
+    'jobs' is more than 1, up to that many file_sync() (or batched rsync) runs
+    happen at once; each key's result is logged as a whole once it is done.
+
+    When a 'manifest' is given, every entry whose local and remote files still
+    have the size and mtime recorded at their last successful sync is skipped,
+    and every successful sync is recorded in it.
+
+    Regular files smaller than 'small_file_size' bytes skip rsync and are sent
+    together through file_sync_small() instead.
+
+    The remaining entries are scheduled with schedule_transfers(), by their
+    'priorities' and size.  Those of at least 'large_file_size' bytes go in
+    a separate lane of 'large_jobs' file_sync() runs, limited to 'bwlimit'
+    if one is given, which works alongside the small entries instead of
+    holding them up.
+
+    If 'keys' is given, only those entries are synced.
+
+    The sync is with 'host', or the config's first remote host.  Local file
+    metadata and digests come from 'local_files', a LocalFiles that can be
+    shared by the syncs to several hosts.  Remote files are stat'd with one
+    batched request unless their '[size, mtime]' is given in 'remote_stats'.
+    The bytes sent and the time it took are recorded in 'throughput', a
+    Throughput, if one is given.
+
+    With a 'transfer' of "native", file_sync_native() is used instead of
+    rsync: there is no batching and no 'bwlimit'.
+
+    Each transfer is compressed at the zlib level given for its key in
+    'compress', or where that is None or missing, at the level chosen by
+    compression_level() from a probe of the file and the rate in
+    'throughput'.
+
+    Regular files of at least 'resume_size' bytes (unless it is 0) are sent
+    with file_sync_resumable(), so an interrupted transfer carries on where
+    it stopped the next time.
+
+    Received files are written next to their destinations and renamed into
+    place.  With a 'durability' of "batch", those sent by rsync, the native
+    transfer or in chunks are flushed to disk together by flush_received()
+    once they are all done, and small files a whole archive at a time; with
+    "file", each one is flushed on its own as soon as it is in place; with
+    "none", none are.  A file that cannot be flushed is only warned of.
+
+    Returns a dict of each key and its file_sync() result.
     """
-    # Convenience variables
-    local = config["local"]
-    remote = config["remote"]
-    remote_host = config["global"]["remote host"]
+    remote_host = host or _get_remote_hosts(config)[0]
+    if local_files is None:
+        local_files = LocalFiles()
+    sync_dict = _build_sync_dict(config)
 
-    # Build the sync_dict
-    sync_dict = {}
-    for k, v in local.items():
-        sync_dict.update({k: {"local": v}})
-    for k, v in remote.items():
+    # Find out our longest config key so terminal output is padded correctly
+    padding = max([len(k) for k in sync_dict] or [0]) + 3  # Pad for a colon and two spaces
+
+    def _pad(key: str) -> int:
+        return len(key) + 3 if verbose else padding
+
+    results = {}
+    entries = {}
+    with _STATS.span("check"):
+        for key in sync_dict.keys():
+            if keys is not None and key not in keys:
+                continue
+            entries[key] = _resolve_paths(sync_dict, key, _pad(key))
+    # Directory and glob entries are walked and synced file by file in sync_tree()
+    trees = {key: entries.pop(key) for key, paths in list(entries.items())
+             if _tree_spec(paths[0]) or _tree_spec(paths[1])}
+
+    # Regular remote files as '[size, mtime]'; anything else is None
+    if remote_stats is None and entries and (manifest or small_file_size or direction == "pull"):
+        remote_stats = {}
+        with _STATS.span("remote stat"):
+            try:
+                found = remote_stat_batch([r for _, r in entries.values()], remote_host)[0]
+            except CheckFileAgeException:
+                emit_log("Unable to stat remote files, syncing everything", level=logging.WARN)
+                found = {}
+        for path, info in found.items():
+            remote_stats[path] = info[:2] if info[2] else None
+    remote_stats = remote_stats or {}
+
+    if manifest:
+        with _STATS.span("manifest"):
+            for key, (local_file, remote_file) in list(entries.items()):
+                if manifest.unchanged(key, local_file, remote_file, local_files.meta(local_file),
+                                      remote_stats.get(remote_file)):
+                    emit_log("{0: <{n}}Unchanged since the last sync, skipping", key + ':',
+                             n=_pad(key), level=logging.DEBUG,
+                             event={"event": "unchanged", "key": key})
+                    results[key] = True
+                    del entries[key]
+
+    def _done(key: str, synced: T[bool, str]):
+        local_file, remote_file = entries[key]
+        results[key] = synced
+        _log_sync_result(key, direction, local_file, remote_file, remote_host, synced, _pad(key))
+        if synced is True and direction == "pull":
+            local_files.forget(local_file)
+        if synced is True and manifest:
+            local_meta = local_files.meta(local_file)
+            if local_meta is None:
+                return
+            # rsync -a carries size and mtime over, so a push leaves the remote
+            # looking like the local file; a pull leaves the remote untouched.
+            remote_meta = local_meta if direction == "push" else remote_stats.get(remote_file)
+            if remote_meta is None:
+                return
+            manifest.record(key, local_file, remote_file, local_meta, remote_meta,
+                            local_files.digest(local_file))
+
+    # Sizes of the regular source files; None for anything else
+    sizes = {}
+    for key, (local_file, remote_file) in entries.items():
+        if direction == "push":
+            meta = local_files.meta(local_file)
+        else:
+            meta = remote_stats.get(remote_file)
+        sizes[key] = meta[0] if meta else None
+    started = time.monotonic()
+
+    # Small regular files all go over the agent in archives, the rest through
+    # rsync, which also gets back any that turn out to be symlinks when packed
+    pending = dict(entries)
+    if small_file_size:
+        small = {key: pending.pop(key) for key in entries
+                 if sizes[key] is not None and sizes[key] < small_file_size
+                 and not (direction == "push" and os.path.islink(entries[key][0]))}
+        if small:
+            with _STATS.span("small files"):
+                small_results = file_sync_small(direction, small, remote_host, durability,
+                                                {key: sizes[key] for key in small})
+            for key, synced in small_results.items():
+                _done(key, synced)
+            pending.update({key: small[key] for key in small if key not in small_results})
+
+    with _STATS.span("compression"):
+        levels = _compression_levels(direction, pending, remote_host, compress or {},
+                                     throughput.rate() if throughput else None)
+    for key, level in levels.items():
+        emit_log("{0: <{n}}Compression level {1}", key + ':', level, n=_pad(key),
+                 level=logging.DEBUG, event={"event": "compression", "key": key, "level": level})
+
+    small_lane, large_lane = schedule_transfers({key: sizes[key] for key in pending},
+                                                priorities or {}, large_file_size)
+    for lane, lane_keys in (("small", small_lane), ("large", large_lane)):
+        for i, key in enumerate(lane_keys):
+            emit_log("{0: <{n}}Scheduled {1} in the {2} lane ({3} bytes, priority {4})", key + ':',
+                     i + 1, lane, sizes[key], (priorities or {}).get(key, 0), n=_pad(key),
+                     level=logging.DEBUG, event={"event": "scheduled", "key": key, "lane": lane,
+                                                 "position": i + 1, "size": sizes[key]})
+    if large_lane:
+        emit_log("{0} small entries on {1} jobs, {2} large entries on {3} jobs{4}", len(small_lane),
+                 jobs, len(large_lane), large_jobs,
+                 ", limited to {}".format(bwlimit) if bwlimit else "", level=logging.DEBUG)
+
+    def _resumable(key: str) -> bool:
+        return bool(resume_size) and sizes[key] is not None and sizes[key] >= resume_size
+
+    def _received(key: str) -> str:
+        "Return the path 'key' was written to on the receiving side."
+        local_file, remote_file = pending[key]
+        src, dest = (local_file, remote_file) if direction == "push" else (remote_file, local_file)
+        if transfer == "native" or _resumable(key):
+            return dest
+        # rsync keeps the source's name in the destination directory
+        return os.path.join(os.path.dirname(dest), os.path.basename(src))
+
+    def _flush(synced: dict) -> dict:
+        "Flush the received files of the keys 'synced' to disk, warning of any that fail."
+        paths = [_received(key) for key, result in synced.items() if result is True]
+        _warn_unflushed(flush_received(direction, paths, remote_host), remote_host)
+        return synced
+
+    # The native and chunked transfers flush their own files at "file", as
+    # does rsync if it can; either way rsync's are flushed again afterwards
+    each = "file" if durability == "file" else "none"
+    fsync = durability == "file" and transfer == "rsync" and _rsync_fsync(direction, remote_host)
+
+    def _transfer(key: str, limit=None) -> dict:
+        local_file, remote_file = pending[key]
+        with _STATS.span("transfer", key):
+            if _resumable(key):
+                return {key: file_sync_resumable(direction, local_file, remote_file, remote_host,
+                                                 levels[key], each)}
+            if transfer == "native":
+                return {key: file_sync_native(direction, local_file, remote_file, remote_host,
+                                              levels[key], each)}
+            synced = {key: file_sync(direction, local_file, remote_file, remote_host, limit,
+                                     levels[key], fsync)}
+        return _flush(synced) if durability == "file" else synced
+
+    def _transfer_batch(keys: list) -> dict:
+        with _STATS.span("batch transfer"):
+            synced = file_sync_batch(direction, {key: pending[key] for key in keys}, remote_host,
+                                     jobs=jobs, compress=levels, fsync=fsync)
+        return _flush(synced) if durability == "file" else synced
+
+    # Each lane's pool runs its keys in their scheduled order, both at once
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as small_pool, \
+            ThreadPoolExecutor(max_workers=max(large_jobs, 1)) as large_pool:
+        if batch and small_lane and transfer == "rsync":
+            futures = [small_pool.submit(_transfer_batch, small_lane)]
+        else:
+            futures = [small_pool.submit(_transfer, key) for key in small_lane]
+        futures += [large_pool.submit(_transfer, key, bwlimit) for key in large_lane]
+        for future in as_completed(futures):
+            for key, synced in future.result().items():
+                _done(key, synced)
+    if durability == "batch":
+        _flush({key: results[key] for key in pending})
+    if throughput:
+        throughput.record(sum(sizes[key] or 0 for key in entries if results.get(key) is True),
+                          time.monotonic() - started)
+
+    for key, (local_path, remote_path) in trees.items():
+        tree_manifest = None
+        if manifest:
+            tree_manifest = TreeManifest.for_entry(manifest, key, _tree_root(local_path),
+                                                   _tree_root(remote_path))
+        with _STATS.span("tree", key):
+            results[key] = sync_tree(direction, local_path, remote_path, remote_host,
+                                     tree_manifest, transfer=transfer, durability=durability)
+        _log_sync_result(key, direction, local_path, remote_path, remote_host, results[key],
+                         _pad(key))
+
+    _log_summary(results, remote_host)
+    return results
+
+
+def classify_change(base: T[dict, None], local_meta: T[list, None], remote_meta: T[list, None],
+                    local_digest=None, remote_digest=None) -> str:
+    """
+    Decide what a two-way sync does with one entry, given what it looked like
+    at its last sync ('base', a Manifest entry, or None) and the '[size,
+    mtime_ns]' of each side now (None if missing.)  A side modified within
+    the second its base was recorded in counts as changed (see _racy().)  Returns "unchanged",
+    "push", "pull", "same" (both changed, to the same content), "conflict"
+    or "missing".  The digests, when given, tell apart entries that changed
+    on both sides (or that have no base) but still have the same content.
+    """
+    if local_meta is None and remote_meta is None:
+        return "missing"
+    if local_meta is None:
+        return "pull"
+    if remote_meta is None:
+        return "push"
+    if base:
+        synced = base.get("synced")
+        local_changed = local_meta != base["local meta"] or _racy(local_meta, synced)
+        remote_changed = remote_meta != base["remote meta"] or _racy(remote_meta, synced)
+        if not local_changed and not remote_changed:
+            return "unchanged"
+        if local_changed and not remote_changed:
+            return "push"
+        if remote_changed and not local_changed:
+            return "pull"
+    if local_digest and remote_digest and compare_files(local_digest, remote_digest):
+        return "same"
+    return "conflict"
+
+
+def sync_bidirectional(config: configparser.ConfigParser, manifest=None, host=None,
+                       local_files=None, **sync_opts) -> dict:
+    """
+    Sync every entry once, in whichever direction it changed since its last
+    sync.  The local and remote metadata are collected once, and each entry
+    is classified with classify_change() against its 'manifest' record.
+    Entries changed on both sides are hashed on both sides (remotely in one
+    batch); those that differ are conflicts, which are reported and left
+    alone, as are directory and glob entries.  The rest go out with one
+    sync_files() per direction.  Files missing on one side are copied from
+    the other; deletions are never synced.
+
+    Returns a dict of each key and its result, which is True or an error
+    string, such as the description of a conflict.
+    """
+    remote_host = host or _get_remote_hosts(config)[0]
+    if local_files is None:
+        local_files = LocalFiles()
+    sync_dict = _build_sync_dict(config)
+    padding = max([len(k) for k in sync_dict] or [0]) + 3
+    results, entries = {}, {}
+    for key in sync_dict:
+        local_file, remote_file = _resolve_paths(sync_dict, key, padding)
+        if _tree_spec(local_file) or _tree_spec(remote_file):
+            results[key] = "Directory and glob entries can only be pushed or pulled"
+        else:
+            entries[key] = (local_file, remote_file)
+
+    # Without the remote metadata every remote file would look missing and
+    # be overwritten, so nothing is synced unless it was all collected
+    with _STATS.span("remote stat"):
         try:
-            sync_dict[k]["remote"] = v
-        except KeyError:
-            # This is a remote file with no configured local file
-            sync_dict.update({k: {"remote": v}})
+            found, errors = remote_stat_batch([r for _, r in entries.values()], remote_host,
+                                              missing_ok=True)
+        except CheckFileAgeException:
+            emit_log("Unable to stat remote files on \"{}\", not syncing", remote_host,
+                     level=logging.ERROR)
+            results.update({key: "Unable to stat the remote files" for key in entries})
+            return results
+    for key, (_, remote_file) in list(entries.items()):
+        if remote_file in errors:
+            results[key] = "Unable to stat the remote file: {}".format(errors[remote_file])
+            emit_log("{0: <{n}}{1}", key + ':', results[key], n=padding, level=logging.ERROR,
+                     event={"event": "stat error", "key": key, "error": errors[remote_file]})
+            del entries[key]
+    remote_stats = {path: info[:2] if info[2] else None for path, info in found.items()}
+
+    def _base(key: str) -> T[dict, None]:
+        entry = manifest.entries.get(key) if manifest else None
+        if entry and entry["local"] == entries[key][0] and entry["remote"] == entries[key][1]:
+            return entry
+        return None
+
+    # First by metadata alone, then with digests for whatever is left
+    actions = {key: classify_change(_base(key), local_files.meta(local_file),
+                                    remote_stats.get(remote_file))
+               for key, (local_file, remote_file) in entries.items()}
+    unsure = [key for key, action in actions.items() if action == "conflict"]
+    if unsure:
+        with _STATS.span("hash"):
+            try:
+                remote_digests = remote_sha_batch([entries[k][1] for k in unsure], remote_host)[0]
+            except CheckFileShaException:
+                remote_digests = {}
+        for key in unsure:
+            local_file, remote_file = entries[key]
+            actions[key] = classify_change(_base(key), local_files.meta(local_file),
+                                           remote_stats.get(remote_file),
+                                           local_files.digest(local_file),
+                                           remote_digests.get(remote_file))
+
+    for key, action in actions.items():
+        local_file, remote_file = entries[key]
+        emit_log("{0: <{n}}{1}", key + ':', action.capitalize(), n=padding, level=logging.DEBUG,
+                 event={"event": "classified", "key": key, "action": action})
+        if action in ("unchanged", "same"):
+            results[key] = True
+            if action == "same" and manifest:
+                manifest.record(key, local_file, remote_file, local_files.meta(local_file),
+                                remote_stats[remote_file], local_files.digest(local_file))
+        elif action == "missing":
+            results[key] = "Missing on both sides"
+        elif action == "conflict":
+            results[key] = "Conflict: changed on both sides since the last sync"
+            if not _base(key):
+                results[key] = "Conflict: the two sides differ and were never synced"
+            emit_log("{0: <{n}}{1} (local \"{2}\", remote \"{3}\" on \"{4}\")", key + ':',
+                     results[key], local_file, remote_file, remote_host, n=padding,
+                     level=logging.ERROR, event={"event": "conflict", "key": key,
+                                                 "local": local_file, "remote": remote_file,
+                                                 "host": remote_host})
+
+    for direction in ("push", "pull"):
+        keys = {key for key, action in actions.items() if action == direction}
+        if keys:
+            results.update(sync_files(config, direction, manifest=manifest, keys=keys,
+                                      host=remote_host, local_files=local_files,
+                                      remote_stats=remote_stats, **sync_opts))
+    pushed, pulled = [[k for k, a in actions.items() if a == d] for d in ("push", "pull")]
+    conflicts = [k for k, a in actions.items() if a == "conflict"]
+    emit_log("{0} pushed, {1} pulled, {2} unchanged, {3} conflicts{4}", len(pushed), len(pulled),
+             len([a for a in actions.values() if a in ("unchanged", "same")]), len(conflicts),
+             ": " + ", ".join(conflicts) if conflicts else "",
+             level=logging.ERROR if conflicts else logging.INFO,
+             event={"event": "sync summary", "host": remote_host, "pushed": pushed,
+                    "pulled": pulled, "conflicts": conflicts})
+    return results
+
+
+def _plan_action(direction: str, change: str, has_base: bool, local: tuple,
+                 remote: tuple) -> tuple:
+    """
+    Return the '(action, direction)' a plan gives an entry, from its
+    classify_change() result and the '(meta, digest)' of each side.
+    """
+    if direction == "sync":
+        if change in ("push", "pull"):
+            return "transfer", change
+        if change in ("unchanged", "same"):
+            return "unchanged", None
+        return change, None
+    src, opposite = (local, "pull") if direction == "push" else (remote, "push")
+    if src[0] is None:
+        return "missing", None
+    if local[1] and remote[1] and compare_files(local[1], remote[1]):
+        return "unchanged", None
+    # The destination changed since the last sync; sending would overwrite that
+    if has_base and change in (opposite, "conflict"):
+        return "conflict", None
+    return "transfer", direction
+
+
+def make_plan(config: configparser.ConfigParser, direction: str, host=None, manifest=None,
+              local_files=None, throughput=None) -> dict:
+    """
+    Work out what a push, pull or sync ('direction') with 'host' would do,
+    without doing it.  The size, mtime and digest of every remote file are
+    collected with one stat and one hash request.  Each key is classified as
+    "unchanged", "transfer" (with the direction it goes), "missing" or
+    "conflict", the latter meaning that the destination changed since its
+    last sync in 'manifest' as well.  Directory and glob entries are walked
+    and compared with their TreeManifest, and the files they would send are
+    listed; they are "skipped" by a sync.  The bytes to send are added up
+    and, given a 'throughput' with
+    some history, turned into an estimated number of seconds.  A key whose
+    remote file cannot be stat'ed (other than for not existing) is an
+    "error", with the reason in its "error".
+
+    Returns the plan as a dict that can be saved as JSON and run later with
+    execute_plan().  Raises CheckFileAgeException or CheckFileShaException
+    if the remote metadata cannot be collected at all, rather than planning
+    from none.
+    """
+    remote_host = host or _get_remote_hosts(config)[0]
+    if local_files is None:
+        local_files = LocalFiles()
+    sync_dict = _build_sync_dict(config)
+    padding = max([len(k) for k in sync_dict] or [0]) + 3
+    entries, trees = {}, {}
+    for key in sync_dict:
+        paths = _resolve_paths(sync_dict, key, padding)
+        if _tree_spec(paths[0]) or _tree_spec(paths[1]):
+            trees[key] = paths
+        else:
+            entries[key] = paths
+
+    with _STATS.span("remote stat"):
+        found, errors = remote_stat_batch([r for _, r in entries.values()], remote_host,
+                                          missing_ok=True)
+    remote_stats = {path: info[:2] if info[2] else None for path, info in found.items()}
+    with _STATS.span("hash"):
+        present = [r for _, r in entries.values() if remote_stats.get(r)]
+        remote_digests = remote_sha_batch(present, remote_host)[0] if present else {}
+
+    plan = {"direction": direction, "host": remote_host, "created": time.time(), "entries": {}}
+    for key, (local_file, remote_file) in entries.items():
+        if remote_file in errors:
+            plan["entries"][key] = {
+                "action": "error", "direction": None, "local": local_file, "remote": remote_file,
+                "error": "Unable to stat the remote file: {}".format(errors[remote_file]),
+                "bytes": 0}
+            continue
+        local_meta, remote_meta = local_files.meta(local_file), remote_stats.get(remote_file)
+        local_digest = local_files.digest(local_file) if local_meta else None
+        remote_digest = remote_digests.get(remote_file)
+        base = manifest.entries.get(key) if manifest else None
+        if base and (base["local"], base["remote"]) != (local_file, remote_file):
+            base = None
+        change = classify_change(base, local_meta, remote_meta, local_digest, remote_digest)
+        action, way = _plan_action(direction, change, base is not None,
+                                   (local_meta, local_digest), (remote_meta, remote_digest))
+        src_meta = local_meta if way == "push" else remote_meta
+        plan["entries"][key] = {
+            "action": action, "direction": way, "local": local_file, "remote": remote_file,
+            "local meta": local_meta, "remote meta": remote_meta, "local digest": local_digest,
+            "remote digest": remote_digest,
+            "bytes": src_meta[0] if action == "transfer" and src_meta else 0}
+
+    for key, (local_path, remote_path) in trees.items():
+        entry = {"action": "skipped", "direction": None, "local": local_path,
+                 "remote": remote_path, "files": [], "bytes": 0}
+        if _relative_glob(local_path) or _relative_glob(remote_path):
+            emit_log("{0}: A glob needs an absolute path or one under '~'", key,
+                     level=logging.ERROR)
+        elif direction != "sync":
+            # What sync_tree() would send, from the same walk and manifest
+            tree_manifest = TreeManifest.for_entry(manifest, key, _tree_root(local_path),
+                                                   _tree_root(remote_path)) if manifest else None
+            src_path, dest_path = (local_path, remote_path) if direction == "push" \
+                else (remote_path, local_path)
+            pattern = (_tree_spec(src_path) or _tree_spec(dest_path))[1]
+            try:
+                for rel, size, mtime in walk_tree(_tree_root(src_path), pattern,
+                                                  None if direction == "push" else remote_host):
+                    if not tree_manifest or tree_manifest.get(rel) != [size, mtime]:
+                        entry["files"].append([rel, size, mtime])
+                        entry["bytes"] += size
+            except RemoteAgentException as e:
+                emit_log("{0}: {1}".format(key, e), level=logging.ERROR)
+            entry["action"] = "transfer" if entry["files"] else "unchanged"
+            entry["direction"] = direction if entry["files"] else None
+        plan["entries"][key] = entry
+
+    plan["bytes"] = sum(e["bytes"] for e in plan["entries"].values())
+    rate = throughput.rate() if throughput else None
+    plan["seconds"] = plan["bytes"] / rate if rate else None
+    return plan
+
+
+def print_plan(plan: dict):
+    "Log every entry of 'plan' and what it adds up to."
+    padding = max([len(k) for k in plan["entries"]] or [0]) + 3
+    for key, entry in plan["entries"].items():
+        emit_log("{0: <{n}}{1}{2}{3}{4}", key + ':', entry["action"].capitalize(),
+                 " ({})".format(entry["direction"]) if entry["direction"] else "",
+                 ", {} bytes".format(entry["bytes"]) if entry["bytes"] else "",
+                 ": " + entry["error"] if "error" in entry else "", n=padding,
+                 level=logging.WARN if entry["action"] in ("conflict", "error") else logging.INFO)
+    counts = {action: [k for k, e in plan["entries"].items() if e["action"] == action]
+              for action in ("transfer", "unchanged", "missing", "conflict", "error")}
+    emit_log("Plan for \"{0}\" ({1}): {2} to transfer, {3} unchanged, {4} missing, "
+             "{5} conflicts, {6} errors", plan["host"], plan["direction"],
+             len(counts["transfer"]), len(counts["unchanged"]), len(counts["missing"]),
+             len(counts["conflict"]), len(counts["error"]),
+             event=dict({"event": "plan", "host": plan["host"]}, **counts))
+    if plan["seconds"] is None:
+        emit_log("{0} bytes to send; there is no throughput history yet to estimate the time",
+                 plan["bytes"])
+    else:
+        emit_log("{0} bytes to send, about {1:.1f} seconds at recent rates", plan["bytes"],
+                 plan["seconds"])
 
-    # Find out our longest config key so terminal output is padded correctly
-    l_list = []
-    [l_list.append(len(k)) for k in config["local"].keys()]
-    l_list.sort()
-    l_pad = l_list[-1] + 3  # Pad for a colon and two spaces
-    r_list = []
-    [r_list.append(len(k)) for k in config["remote"].keys()]
-    r_list.sort()
-    r_pad = l_list[-1] + 3  # Pad for a colon and two spaces
-
-    # Iterate through the sync_dict, sync as needed
-    for key in sync_dict.keys():
-        if verbose:
-            l_pad = len(key) + 3
-            r_pad = len(key) + 3
-
-        # Check local file
-        local_file = _check_file(sync_dict, key, l_pad, True, False)
-
-        # Check remote file
-        remote_file = _check_file(sync_dict, key, r_pad, False, True)
-
-        # No local file, pull command
-        if not local_file and direction == "pull":
-            synced = file_sync(direction, remote_file,
-                               remote_file, host=remote_host)
-            if synced is True:
-                emit_log("{0: <{n}}\"{1}\" synced from \"{1}\"".format(
-                    key + ':', remote_host, remote_file, n=r_pad))
-            else:
-                emit_log('TODO TODO')#TODO
-                # emit_log("{0: <{n}}Unable to sync \"{1}\" from \"{1}\"!".format(
-                #     key + ':', remote_host, remote_file, n=r_pad))
-
-        # No remote file, push command
-        elif not remote_file and direction == "push":
-            synced = file_sync(direction, local_file,
-                               local_file, host=remote_host)
-            if synced is True:
-                emit_log("{0: <{n}}\"{1}\" synced to \"{2}\"".format(
-                    key + ':', local_file.split('/')[-1], remote_host, n=l_pad))
-            else:
-                # TODO: Need to show a meaningful message here...
-                emit_log("{0: <{n}}Unable to sync \"{1}\" to \"{1}\"!".format(
-                    key + ':', local_file, remote_host, n=l_pad))
-
-        # Both files present
-        elif local_file and remote_file:
-            synced = file_sync(direction, local_file, remote_file, remote_host)
-
-            # Pull command
-            if direction == "pull":
-                if synced is True:
-                    emit_log("{0: <{n}}\"{1}\" synced from \"{2}\"".format(
-                        key + ':', remote_file.split('/')[-1], remote_host, n=r_pad))
-                else:
-                    emit_log("{0: <{n}}Unable to sync \"{1}\" from \"{2}\"!".format(
-                        key + ':', remote_file.split('/')[-1], remote_host, n=r_pad))
-
-            # Push command
-            elif direction == "push":
-                if synced is True:
-                    emit_log("{0: <{n}}\"{1}\" synced to \"{2}\"".format(
-                        key + ':', local_file.split('/')[-1], remote_host, n=l_pad))
-                else:
-                    emit_log("{0: <{n}}ERROR: {1}".format(
-                        key + ':', synced, n=l_pad))
 
-        else:  # pull local file with no remote configuration
-            if local_file:
-                remote_file = local_file
-            synced = file_sync(direction, local_file, remote_file, remote_host)
-            if direction == "push":
-                word = "to"
-            elif direction == "pull":
-                word = "from"
-            if synced is True:
-                emit_log("{0: <{n}}\"{1}\" synced {2} \"{3}\"".format(
-                    key + ':', remote_file.split('/')[-1], word, remote_host, n=r_pad))
-            else:
-                emit_log("{0: <{n}}Unable to sync \"{1}\" {2} \"{3}\"!".format(
-                    key + ':', remote_file.split('/')[-1], word, remote_host, n=r_pad))
+def execute_plan(plan: dict, manifest=None, throughput=None, **sync_opts) -> dict:
+    """
+    Make the transfers in 'plan' from make_plan(), using the metadata it
+    collected instead of collecting it again.  Entries that were unchanged,
+    missing or in conflict when the plan was made are left alone.  Returns
+    a dict of each transferred key and its result.
+    """
+    host = plan["host"]
+    config = configparser.ConfigParser(interpolation=None)
+    config.read_dict({"global": {"remote host": host}, "local": {}, "remote": {}})
+    remote_stats = {}
+    results = {}
+    for key, entry in plan["entries"].items():
+        if entry["action"] != "transfer" or "files" in entry:
+            continue
+        config["local"][key] = entry["local"]
+        config["remote"][key] = entry["remote"]
+        remote_stats[entry["remote"]] = entry["remote meta"]
+    for direction in ("push", "pull"):
+        keys = {key for key, e in plan["entries"].items()
+                if e["action"] == "transfer" and e["direction"] == direction and "files" not in e}
+        if keys:
+            results.update(sync_files(config, direction, manifest=manifest, keys=keys, host=host,
+                                      remote_stats=remote_stats, throughput=throughput,
+                                      **sync_opts))
+    for key, entry in plan["entries"].items():
+        if entry["action"] != "transfer" or "files" not in entry:
+            continue
+        tree_manifest = None
+        if manifest:
+            tree_manifest = TreeManifest.for_entry(manifest, key, _tree_root(entry["local"]),
+                                                   _tree_root(entry["remote"]))
+        with _STATS.span("tree", key):
+            results[key] = sync_tree(entry["direction"], entry["local"], entry["remote"], host,
+                                     tree_manifest, files=entry["files"],
+                                     transfer=sync_opts.get("transfer", "rsync"),
+                                     durability=sync_opts.get("durability",
+                                                              DEFAULT_DURABILITY))
+        _log_sync_result(key, entry["direction"], entry["local"], entry["remote"], host,
+                         results[key], len(key) + 3)
+    return results
+
+
+def sync_hosts(config: configparser.ConfigParser, direction: str, hosts: list,
+               parallel_hosts=0, manifests=None, throughputs=None, **sync_opts) -> dict:
+    """
+    Run sync_files() (or sync_bidirectional(), when 'direction' is "sync")
+    with each of 'hosts', up to 'parallel_hosts' of them at once (all of
+    them when it is 0.)  Each host's sync keeps to the 'jobs' limit in
+    'sync_opts', and uses its own manifest and Throughput from the
+    'manifests' and 'throughputs' dicts, if they are given.  Local file
+    metadata and digests are looked up once and shared by all hosts.
+
+    Returns a dict of each host and its sync_files() results.
+    """
+    manifests = manifests or {}
+    throughputs = throughputs or {}
+    local_files = LocalFiles()
+
+    def _sync(host: str) -> dict:
+        if direction == "sync":
+            return sync_bidirectional(config, manifest=manifests.get(host), host=host,
+                                      local_files=local_files, throughput=throughputs.get(host),
+                                      **sync_opts)
+        return sync_files(config, direction, manifest=manifests.get(host), host=host,
+                          local_files=local_files, throughput=throughputs.get(host), **sync_opts)
+
+    if len(hosts) == 1:
+        return {hosts[0]: _sync(hosts[0])}
+    results = {}
+    with ThreadPoolExecutor(max_workers=parallel_hosts or len(hosts)) as pool:
+        futures = {pool.submit(_sync, host): host for host in hosts}
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+    results = {host: results[host] for host in hosts}
+    _log_host_summary(results)
+    return results
+
+
+def watch_files(config: configparser.ConfigParser, delay=WATCH_DELAY, interval=WATCH_INTERVAL,
+                hosts=None, **sync_opts):
+    """
+    Push local files to the remote hosts as they change, until interrupted.
+    Changes are gathered until 'delay' seconds pass without another one, then
+    only the changed entries are pushed with sync_hosts() to 'hosts' (the
+    config's remote hosts by default.)  Uses inotify, or checks every file
+    each 'interval' seconds if inotify is not available.  Directory and glob
+    entries are watched throughout their trees.
+    """
+    hosts = hosts or _get_remote_hosts(config)
+    sync_dict = _build_sync_dict(config)
+    paths, trees = {}, {}
+    for key, entry in sync_dict.items():
+        local_path, remote_path = entry.get("local", entry.get("remote")), entry.get("remote", "")
+        if _relative_glob(local_path) or _relative_glob(remote_path):
+            # sync_tree() refuses these; watching one would mean watching "/"
+            continue
+        paths[key] = os.path.expanduser(_tree_root(local_path))
+        spec = _tree_spec(local_path) or _tree_spec(remote_path)
+        if spec:
+            trees[key] = spec[1]
+    try:
+        watcher = InotifyWatcher(paths, trees)
+        emit_log("Watching {} files with inotify".format(len(paths)))
+    except OSError as e:
+        emit_log("Unable to use inotify ({}), checking files every {} seconds".format(
+            e.strerror, interval))
+        watcher = PollingWatcher(paths, interval, trees)
+    changed = set()
+    deadline = None
+    try:
+        while True:
+            timeout = max(deadline - time.monotonic(), 0) if deadline else None
+            keys = watcher.wait(timeout)
+            if keys:
+                changed |= keys
+                deadline = time.monotonic() + delay
+            elif deadline and time.monotonic() >= deadline:
+                emit_log("Pushing {} changed entries", len(changed), level=logging.DEBUG)
+                sync_hosts(config, "push", hosts, keys=changed, **sync_opts)
+                changed = set()
+                deadline = None
+    finally:
+        watcher.close()
+
+
+def _key_results(results: dict) -> dict:
+    "Turn each key's True or error string result into a dict."
+    return {key: {"synced": result is True, "error": None if result is True else result}
+            for key, result in results.items()}
+
+
+class Session:
+    """
+    Runs filesync from Python: the config file is read and checked once, and
+    the remote agents, ssh master connections, manifests and digest caches
+    stay open from one call to the next until close().  Each Session keeps
+    its own, swapped in for the module's during its calls, so closing one
+    leaves the others' alone.  Calls from different threads run one at a
+    time, each waiting for the one before to finish; a watch() holds the
+    module until it is interrupted.
+
+        with Session("~/.config/filesync/filesync.conf") as session:
+            session.push(["chrono trigger"])
+
+    Any keyword argument takes the place of its config setting, as the
+    matching command line option does.  push(), pull() and sync() take the
+    keys to sync (all of them by default) and return a dict of each host and
+    of each key's result, '{"synced": True, "error": None}' or False and the
+    reason; plan() returns the plans from make_plan() without printing them.
+    After each call, 'stats' is the RunStats of what it spent its time on;
+    the first call's also counts reading the config, and close() adds the
+    lifetimes of the connections to the last one's.  A config that cannot be
+    read or used raises SessionException.
+    """
+    def __init__(self, conf=DEFAULT_CONF_FILE, hosts=None, batch=False, jobs=None,
+                 bwlimit=None, transfer=None, parallel_hosts=None, manifest=True,
+                 multiplex=True, rehash=False, force=False, verbose=False, durability=None):
+        self.stats, self._calls = RunStats(), 0
+        c = configparser.ConfigParser()
+        with self.stats.span("config"):
+            found = c.read(os.path.expanduser(conf))
+        if not found:
+            raise SessionException("Provide a config file with '-c' or place one at '{}'.".format(
+                DEFAULT_CONF_FILE))
+        try:
+            self.hosts = list(hosts or _get_remote_hosts(c))
+            c["global"]["remote host"] = self.hosts[0]
+            self.force = force or _is_forced(c)
+            self.verbose = verbose or _is_verbose(c)
+            self.multiplex = multiplex and _is_multiplexed(c)
+            self.parallel_hosts = parallel_hosts or _get_parallel_hosts(c)
+            self.rehash = rehash
+            self.cache_size = _get_cache_size(c)
+            self.digest = _get_digest(c)
+            self.sync_opts = dict(
+                verbose=self.verbose, batch=batch or _is_batched(c), jobs=jobs or _get_jobs(c),
+                small_file_size=_get_small_file_size(c), large_file_size=_get_large_file_size(c),
+                large_jobs=_get_large_jobs(c), bwlimit=bwlimit or _get_bwlimit(c),
+                priorities=_get_priorities(c), transfer=transfer or _get_transfer(c),
+                compress=_get_compress(c), resume_size=_get_resume_size(c),
+                durability=durability or _get_durability(c))
+        except (configparser.Error, KeyError, ValueError) as e:
+            raise SessionException("Unable to use the config in \"{0}\": {1}.".format(conf, e))
+        if self.sync_opts["transfer"] not in ("rsync", "native"):
+            raise SessionException("Unknown transfer: {}".format(self.sync_opts["transfer"]))
+        if self.sync_opts["durability"] not in DURABILITY_LEVELS:
+            raise SessionException("Unknown durability: {}".format(self.sync_opts["durability"]))
+        if self.digest not in hashlib.algorithms_guaranteed or self.digest.startswith("shake_"):
+            raise SessionException("Unknown digest: {}".format(self.digest))
+        self.config = c
+        self.manifests = None
+        if manifest and _use_manifest(c):
+            self.manifests = {host: Manifest.for_host(host) for host in self.hosts}
+        self.throughputs = {host: Throughput.for_host(host) for host in self.hosts}
+        self._agents, self._ssh_masters = {}, {}
+        self._digest_cache = DigestCache(os.path.join(DEFAULT_CACHE_DIR, "digests.json"),
+                                         self.cache_size)
+        self._digest_cache.rehash = self.rehash
+        self._digest_cache.algorithm = self.digest
+        self._chunk_index = ChunkIndex(os.path.join(DEFAULT_CACHE_DIR, "chunks.json"))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @contextlib.contextmanager
+    def _bound(self):
+        """
+        Swap this session's connections, caches and stats in for the
+        module-wide ones, holding _SESSION_LOCK until they are swapped back.
+        """
+        global _AGENTS, _SSH_MASTERS, _SSH_MULTIPLEX, _DIGEST_CACHE, _CHUNK_INDEX, _STATS
+        with _SESSION_LOCK:
+            saved = _AGENTS, _SSH_MASTERS, _SSH_MULTIPLEX, _DIGEST_CACHE, _CHUNK_INDEX, _STATS
+            _AGENTS, _SSH_MASTERS, _SSH_MULTIPLEX = self._agents, self._ssh_masters, self.multiplex
+            _DIGEST_CACHE, _CHUNK_INDEX, _STATS = self._digest_cache, self._chunk_index, self.stats
+            try:
+                yield
+            finally:
+                _AGENTS, _SSH_MASTERS, _SSH_MULTIPLEX, _DIGEST_CACHE, _CHUNK_INDEX, _STATS = saved
+
+    @contextlib.contextmanager
+    def _call(self):
+        "Run a call under _bound(), with new stats unless it is the first."
+        with _SESSION_LOCK:
+            if self._calls:
+                self.stats = RunStats()
+            self._calls += 1
+            with self._bound():
+                yield
+
+    def _config(self, keys=None) -> configparser.ConfigParser:
+        "Return the config, with only 'keys' left in its [local] and [remote] sections."
+        if keys is None:
+            return self.config
+        keys = {self.config.optionxform(k) for k in keys}
+        unknown = keys - set(_build_sync_dict(self.config))
+        if unknown:
+            raise SessionException("Unknown keys: {}".format(", ".join(sorted(unknown))))
+        c = configparser.ConfigParser(interpolation=None)
+        c.read_dict({section: {k: v for k, v in self.config[section].items()
+                               if section not in ("local", "remote") or k in keys}
+                     for section in self.config.sections()})
+        return c
+
+    def log_settings(self):
+        "Log every setting at DEBUG."
+        emit_log("Force: {}", self.force, level=logging.DEBUG)
+        emit_log("Verbose: {}", self.verbose, level=logging.DEBUG)
+        emit_log("Batch: {}", self.sync_opts["batch"], level=logging.DEBUG)
+        emit_log("Jobs: {}", self.sync_opts["jobs"], level=logging.DEBUG)
+        emit_log("Multiplex: {}", self.multiplex, level=logging.DEBUG)
+        emit_log("Rehash: {}", self.rehash, level=logging.DEBUG)
+        emit_log("Digest: {}", self.digest, level=logging.DEBUG)
+        emit_log("Hosts: {}", ", ".join(self.hosts), level=logging.DEBUG)
+        emit_log("Parallel hosts: {}", self.parallel_hosts or len(self.hosts),
+                 level=logging.DEBUG)
+        emit_log("Manifests: {}", ", ".join(m.path for m in self.manifests.values())
+                 if self.manifests else None, level=logging.DEBUG)
+        emit_log("Small file size: {}", self.sync_opts["small_file_size"], level=logging.DEBUG)
+        emit_log("Large file size: {}", self.sync_opts["large_file_size"], level=logging.DEBUG)
+        emit_log("Large jobs: {}", self.sync_opts["large_jobs"], level=logging.DEBUG)
+        emit_log("Bandwidth limit: {}", self.sync_opts["bwlimit"], level=logging.DEBUG)
+        emit_log("Transfer: {}", self.sync_opts["transfer"], level=logging.DEBUG)
+        emit_log("Compress: {}", self.sync_opts["compress"], level=logging.DEBUG)
+        emit_log("Resume size: {}", self.sync_opts["resume_size"], level=logging.DEBUG)
+        emit_log("Durability: {}", self.sync_opts["durability"], level=logging.DEBUG)
+        emit_log("Priorities: {}", self.sync_opts["priorities"], level=logging.DEBUG)
+
+    def _sync(self, direction: str, keys=None) -> dict:
+        if direction != "push" and len(self.hosts) > 1:
+            raise SessionException("Files can only be {0} one host at a time; pick one with "
+                                   "'-H'.".format("pulled from" if direction == "pull"
+                                                  else "synced with"))
+        config = self._config(keys)
+        with self._call():
+            results = sync_hosts(config, direction, self.hosts,
+                                 parallel_hosts=self.parallel_hosts, manifests=self.manifests,
+                                 throughputs=self.throughputs, **self.sync_opts)
+        return {host: _key_results(r) for host, r in results.items()}
+
+    def push(self, keys=None) -> dict:
+        "Push 'keys' (every entry by default) to each host."
+        return self._sync("push", keys)
+
+    def pull(self, keys=None) -> dict:
+        "Pull 'keys' (every entry by default) from the one host."
+        return self._sync("pull", keys)
+
+    def sync(self, keys=None) -> dict:
+        "Push or pull each of 'keys', whichever side changed since its last sync."
+        return self._sync("sync", keys)
+
+    def plan(self, keys=None, direction="push") -> list:
+        """
+        Return a make_plan() plan for each host, for a push, pull or sync of
+        'keys'.  Raises SessionException if a host's metadata cannot be had.
+        """
+        if direction not in ("push", "pull", "sync"):
+            raise SessionException("A plan can only be made for a push, pull or sync.")
+        config = self._config(keys)
+        manifests = self.manifests or {}
+        local_files = LocalFiles()
+        plans = []
+        with self._call():
+            for host in self.hosts:
+                try:
+                    plans.append(make_plan(config, direction, host, manifests.get(host),
+                                           local_files, self.throughputs.get(host)))
+                except (CheckFileAgeException, CheckFileShaException):
+                    raise SessionException("Unable to collect the metadata of the files on "
+                                           "\"{}\", so no plan was made.".format(host))
+        return plans
+
+    def execute(self, plans: list) -> dict:
+        "Make the transfers in 'plans' from plan(); returns results like push()."
+        results = {}
+        with self._call():
+            for plan in plans:
+                host = plan["host"]
+                manifest = None
+                if self.manifests is not None:
+                    manifest = self.manifests.get(host) or Manifest.for_host(host)
+                throughput = self.throughputs.get(host) or Throughput.for_host(host)
+                results[host] = _key_results(execute_plan(
+                    plan, manifest=manifest, throughput=throughput, **self.sync_opts))
+        return results
+
+    def clean(self) -> dict:
+        "Clean up the backup files on each host; returns clean_backups() results."
+        with self._call():
+            return clean_backups(self.config, force=self.force, hosts=self.hosts)
+
+    def watch(self):
+        "Push entries to each host as they change, until interrupted."
+        with self._call():
+            watch_files(self.config, delay=_get_watch_delay(self.config),
+                        interval=_get_watch_interval(self.config), hosts=self.hosts,
+                        parallel_hosts=self.parallel_hosts, manifests=self.manifests,
+                        throughputs=self.throughputs, **self.sync_opts)
+
+    def close(self):
+        "Close the agents and ssh connections, and save the digest caches."
+        with self._bound():
+            stop_agents()
+            stop_ssh_masters()
+            self._digest_cache.save()
+            self._chunk_index.save()
 
 
 def parse_args(args: list) -> str:
-    force = False
-    verbose = False
     parser = argparse.ArgumentParser(description=DESCRIPTION, prog=PROGNAME)
     actions = parser.add_mutually_exclusive_group(required=True)
     actions.add_argument("--clean", action="store_true", help="Clean up backup files created during sync")
@@ -358,53 +2950,73 @@ def parse_args(args: list) -> str:
     #                      help="Print a formatted config file to stdout, formatted from loaded options.")
     actions.add_argument("--pull", action="store_true", help="Sync files from the remote to your local")
     actions.add_argument("--push", action="store_true", help="Sync files from your local to the remote")
+    actions.add_argument("--sync", action="store_true",
+                         help="Push or pull each file, whichever side changed since the last sync")
+    actions.add_argument("--execute-plan", help="Make the transfers in a plan saved with --plan-out",
+                         metavar="PLAN FILE")
+    actions.add_argument("--watch", action="store_true",
+                         help="Keep running and push local files to the remote as they change")
     options = parser.add_argument_group("Options")
-    options.add_argument("-H", "--host", help="Specify a remote host to sync to", metavar="REMOTE HOST")
+    options.add_argument("-H", "--host", action="append",
+                         help="Specify a remote host to sync to; repeat it to sync to several",
+                         metavar="REMOTE HOST")
     options.add_argument("-L", "--local-file", help="Specify a local file to sync when pushing",
                          metavar="LOCAL FILE")
     options.add_argument("-R", "--remote-file", help="Specify a remote file to sync when pulling",
                          metavar="REMOTE FILE")
+    options.add_argument("--batch", action="store_true",
+                         help="Sync all entries that share a destination directory with one rsync")
+    options.add_argument("-j", "--jobs", type=int, help="Run up to N syncs at the same time",
+                         metavar="N")
+    options.add_argument("--bwlimit", help="Limit the bandwidth of each large file's rsync to RATE",
+                         metavar="RATE")
+    options.add_argument("--transfer", choices=("rsync", "native"),
+                         help="Send files with rsync or with filesync's own delta transfer")
+    options.add_argument("--durability", choices=DURABILITY_LEVELS,
+                         help="Flush received files to disk never, in batches, or one by one")
     options.add_argument("-c", "--conf", help="Optionally specify a config file.",
                          metavar="CONFIG FILE")
     options.add_argument("--force", action="store_true",
                          help="Force removal of backup files when 'gvfs-trash' is not available")
     # TODO: single file sync option; specify the keyname of the single file
+    options.add_argument("--log-json", help="Also write every log message to PATH as JSON lines",
+                         metavar="PATH")
+    options.add_argument("--no-manifest", action="store_true",
+                         help="Sync every entry, even those unchanged since their last sync")
+    options.add_argument("--no-multiplex", action="store_true",
+                         help="Open a new ssh connection for every remote operation")
+    options.add_argument("--plan", action="store_true",
+                         help="Show what --push, --pull or --sync would do, without doing it")
+    options.add_argument("--plan-out", help="Save the plan to PATH (implies --plan)", metavar="PATH")
+    options.add_argument("--parallel-hosts", type=int,
+                         help="Sync with up to N remote hosts at the same time", metavar="N")
+    options.add_argument("--rehash", action="store_true",
+                         help="Hash every local file again instead of using cached digests")
+    options.add_argument("--stats-json", help="Write timings and process counts for the run to PATH",
+                         metavar="PATH")
     options.add_argument("-v", "--verbose", action="store_true", help="Show extra logging messages")
     parser.add_argument("--version", action="version", version=VERSION, help=argparse.SUPPRESS)
     parsed_args = parser.parse_args(args)
 
-    # Options
-    if parsed_args.conf:
-        # Read the passed-in config file
-        c = read_config_file(parsed_args.conf)
-    elif not parsed_args.conf:
-        # Read the default config file
-        c = read_config_file(DEFAULT_CONF_FILE)
-    if parsed_args.force:
-        # Force rm'ing backup files
-        force = True
-    if parsed_args.host:
-        c["global"]["remote host"] = parsed_args.host
-    if parsed_args.verbose:
-        verbose = True
-
-    # Check for optional global settings
-    if not force:
-        force = _is_forced(c)
-    if not verbose:
-        verbose = _is_verbose(c)
-
-    if verbose:
-        verbose = True
-        log_level = logging.DEBUG
-    else:
-        log_level = logging.INFO
-
-    logging.basicConfig(format=LOGFMT, level=log_level, stream=sys.stdout)
+    try:
+        session = Session(parsed_args.conf or DEFAULT_CONF_FILE, hosts=parsed_args.host,
+                          batch=parsed_args.batch, jobs=parsed_args.jobs,
+                          bwlimit=parsed_args.bwlimit, transfer=parsed_args.transfer,
+                          parallel_hosts=parsed_args.parallel_hosts,
+                          manifest=not parsed_args.no_manifest,
+                          multiplex=not parsed_args.no_multiplex, rehash=parsed_args.rehash,
+                          force=parsed_args.force, verbose=parsed_args.verbose,
+                          durability=parsed_args.durability)
+    except SessionException as e:
+        error_and_die(str(e))
+
+    setup_logging(logging.DEBUG if session.verbose else logging.INFO,
+                  json_path=parsed_args.log_json)
     emit_log("BEGIN filesync run at {}".format(
         datetime.now().strftime("%Y-%m-%d %H:%M:%S")), level=logging.DEBUG)
-    emit_log("Force: {}".format(force), level=logging.DEBUG)
-    emit_log("Verbose: {}".format(verbose), level=logging.DEBUG)
+    session.log_settings()
+    emit_log("Stats JSON: {}", parsed_args.stats_json, level=logging.DEBUG)
+    emit_log("Log JSON: {}", parsed_args.log_json, level=logging.DEBUG)
 
     def _unpack_file_args(arg: str) -> T[list, SystemExit]:
         try:
@@ -413,35 +3025,69 @@ def parse_args(args: list) -> str:
             error_and_die("This needs to be formatted like: \"NAME:/PATH.txt\".")
         return name, path
 
-    if parsed_args.local_file:
-        name, path = _unpack_file_args(parsed_args.local_file)
-        c['local'].update({name: path})
-    if parsed_args.remote_file:
-        name, path = _unpack_file_args(parsed_args.remote_file)
-        c['remote'].update({name: path})
-
-    # TODO: set up options read from config file here
-    # TODO: also ensure we have all required options
-
-    # Actions
-    if parsed_args.clean:
-        # Clean out backup files
-        print("CLEAN!")
-    elif parsed_args.pull:
-        # Pull files from the remote host
-        sync_files(c, "pull", verbose=verbose)
-    elif parsed_args.push:
-        # Push files to the remote host
-        sync_files(c, "push", verbose=verbose)
-    else:
-        parser.print_usage()
+    with session:
+        if parsed_args.local_file:
+            name, path = _unpack_file_args(parsed_args.local_file)
+            session.config['local'].update({name: path})
+        if parsed_args.remote_file:
+            name, path = _unpack_file_args(parsed_args.remote_file)
+            session.config['remote'].update({name: path})
+
+        # Actions
+        plan_direction = [d for d in ("push", "pull", "sync") if getattr(parsed_args, d)]
+        if (parsed_args.plan or parsed_args.plan_out) and not plan_direction:
+            error_and_die("A plan can only be made for --push, --pull or --sync.")
+        try:
+            if parsed_args.plan or parsed_args.plan_out:
+                # Only show (and save) what would be done
+                plans = session.plan(direction=plan_direction[0])
+                for plan in plans:
+                    print_plan(plan)
+                if parsed_args.plan_out:
+                    _atomic_write_json(os.path.abspath(parsed_args.plan_out), {"plans": plans})
+            elif parsed_args.execute_plan:
+                # Make the transfers of a saved plan
+                try:
+                    with open(parsed_args.execute_plan) as f:
+                        plans = json.load(f)["plans"]
+                except (OSError, ValueError, KeyError) as e:
+                    error_and_die("Unable to read the plan in \"{0}\": {1}.".format(
+                        parsed_args.execute_plan, e))
+                session.execute(plans)
+            elif parsed_args.clean:
+                # Clean out backup files
+                session.clean()
+            elif parsed_args.pull:
+                # Pull files from the remote host
+                session.pull()
+            elif parsed_args.sync:
+                # Push or pull each file, whichever way it changed
+                session.sync()
+            elif parsed_args.push:
+                # Push files to the remote hosts
+                session.push()
+            elif parsed_args.watch:
+                # Push local files to the remote hosts as they change
+                session.watch()
+            else:
+                parser.print_usage()
+        except SessionException as e:
+            error_and_die(str(e))
+    # Leaving the session closed its connections, so their lifetimes are counted
+    if parsed_args.stats_json:
+        _atomic_write_json(os.path.abspath(parsed_args.stats_json), session.stats.as_dict())
+    for line in session.stats.summary():
+        emit_log(line, level=logging.DEBUG)
     emit_log("END filesync run at {}".format(
         datetime.now().strftime("%Y-%m-%d %H:%M:%S")), level=logging.DEBUG)
 
 
 def main():
-    # TODO: catch KeyboardInterrupt
-    parse_args(sys.argv[1:])
+    try:
+        parse_args(sys.argv[1:])
+    except KeyboardInterrupt:
+        # The session closed its connections on the way out
+        error_and_die("Interrupted, closing connections.")
 
 
 if __name__ == '__main__':
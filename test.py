@@ -1,16 +1,48 @@
 #!/usr/bin/env python3 -Wd
+import hashlib
+import importlib
+import io
+import json
+import logging
 import os
+import shutil
 import sys
+import threading
+import time
 
 from configparser import ConfigParser
-from tempfile import mkstemp
+from tempfile import TemporaryDirectory, mkdtemp, mkstemp
 from unittest import TestCase, main as test_main
-from fs.fs import check_file_sha, compare_files, ensure_required_sections, \
-    file_sync, make_backup_file, parse_args, read_config_file
+from unittest.mock import MagicMock, patch
+from fs import agent, fs as filesync
+from fs.fs import CheckFileAgeException, ChunkIndex, DigestCache, InotifyWatcher, \
+    JsonLinesFormatter, LogMessage, Manifest, PollingWatcher, RemoteAgentException, \
+    RunStats, Session, SessionException, TerminalFormatter, Throughput, TreeManifest, \
+    _agent_call, _archive_groups, _get_compress, _get_remote_hosts, _rsync_results, \
+    _run, _tree_spec, check_file_age, check_file_sha, classify_change, clean_backups, \
+    compare_files, compression_level, emit_log, ensure_required_sections, execute_plan, \
+    file_sync, file_sync_batch, file_sync_native, file_sync_resumable, file_sync_small, \
+    flush_received, get_agent, get_terminal_dims, hash_local_file, list_backups, \
+    local_sha_batch, make_backup_file, make_plan, parse_args, read_config_file, \
+    remote_sha_batch, remote_stat_batch, restore_backup, schedule_transfers, \
+    ssh_command, start_ssh_master, stop_agents, stop_ssh_masters, sync_bidirectional, \
+    sync_files, sync_hosts, sync_tree, walk_tree
 
 
 class FileSyncTestCase(TestCase):
     def setUp(self):
+        # Keep backups, caches and state out of the real home directory
+        home = TemporaryDirectory()
+        self.addCleanup(home.cleanup)
+        cache, self.store = os.path.join(home.name, "cache"), os.path.join(home.name, "backups")
+        for name, value in (("BACKUP_STORE", self.store),
+                            ("DEFAULT_CACHE_DIR", cache),
+                            ("DEFAULT_STATE_DIR", os.path.join(home.name, "state")),
+                            ("_DIGEST_CACHE", DigestCache(os.path.join(cache, "digests.json"))),
+                            ("_CHUNK_INDEX", ChunkIndex(os.path.join(cache, "chunks.json")))):
+            patcher = patch("fs.fs." + name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
         self.c = ConfigParser()
         self.c.read("filesync.conf")
         self.e = mkstemp()[1]
@@ -18,20 +50,104 @@ class FileSyncTestCase(TestCase):
         self.f.read("idkjaja")
         self.h = "localhost"
 
+    def test_check_file_age_localhost(self):
+        path = mkstemp()[1]
+        os.utime(path, ns=(1500000000123456789, 1500000000123456789))
+        self.assertEqual(check_file_age(path, host=self.h), check_file_age(path))
+        self.assertEqual(check_file_age(path), 1500000000.1234567)
+        os.unlink(path)
+
     def test_check_file_sha_returns_sha265sum(self):
         self.assertEqual(
             check_file_sha('filesync.conf', None).decode().split()[0],
             '315dc23cbcad8094dce9eec33fab67ff6cfc691e40bbae5cd4a9f3a2bf7c53ff')
 
+    def test_check_file_sha_is_sha256sum_for_large_files(self):
+        with open(self.e, "wb") as f:
+            f.write(os.urandom(5000))
+        with open(self.e, "rb") as f:
+            expected = hashlib.sha256(f.read()).hexdigest()
+        with patch.object(agent, "TREE_SIZE", 4096):
+            self.assertEqual(check_file_sha(self.e).decode().split()[0], expected)
+
     def test_check_file_sha_returns_false_for_fake_file(self):
         self.assertEqual(check_file_sha('idkjaja', None), False)
 
+    def test_clean_backups(self):
+        d = mkdtemp()
+        f = os.path.join(d, "save.ram")
+        for name in ("save.ram", "save.ram-2020-01-01-10-00-00", "save.ram-2020-01-02-10-00-00",
+                     "save.ram-2020-01-03-10-00-00", "other-2020-01-01-10-00-00"):
+            with open(os.path.join(d, name), "w") as fh:
+                fh.write(name)
+        c = ConfigParser()
+        c.read_dict({"global": {"remote host": self.h, "keep last": "2"},
+                     "local": {"save": f}, "remote": {}})
+        results = clean_backups(c, force=True)
+        self.assertEqual(results["local"]["removed"], [f + "-2020-01-01-10-00-00"])
+        self.assertEqual(sorted(os.listdir(d)),
+                         ["other-2020-01-01-10-00-00", "save.ram", "save.ram-2020-01-02-10-00-00",
+                          "save.ram-2020-01-03-10-00-00"])
+        shutil.rmtree(d)
+
     def test_compare_files_equal(self):
         self.assertTrue(compare_files("foo", "foo"))
 
     def test_compare_files_not_equal(self):
         self.assertFalse(compare_files("foo", "bar"))
 
+    def test_digest_cache(self):
+        cache = DigestCache(self.e, max_entries=1)
+        st = os.stat("filesync.conf")
+        cache.put(st, "foo")
+        self.assertEqual(cache.get(st), "foo")
+        cache.rehash = True
+        self.assertIsNone(cache.get(st))
+
+    def test_digest_cache_keys_by_algorithm(self):
+        cache = DigestCache(self.e)
+        st = os.stat("filesync.conf")
+        cache.put(st, "foo", "blake2b")
+        self.assertIsNone(cache.get(st))
+        self.assertEqual(cache.get(st, "blake2b"), "foo")
+
+    def test_hash_local_file_tree_digest(self):
+        d = mkdtemp()
+        path = os.path.join(d, "big")
+        with open(path, "wb") as f:
+            f.write(os.urandom(5000))
+        with patch.object(agent, "TREE_SIZE", 4096), patch.object(agent, "CHUNK_SIZE", 1024), \
+                patch("fs.fs._DIGEST_CACHE.algorithm", "blake2b"), \
+                patch("fs.fs._DIGEST_CACHE.rehash", True):
+            digest = hash_local_file(path)
+            self.assertEqual(digest, agent.file_digest(path, "blake2b"))
+        with open(path, "rb") as f:
+            data = f.read()
+        chunks = "".join(hashlib.blake2b(data[i:i + 1024]).hexdigest()
+                         for i in range(0, 5000, 1024))
+        self.assertEqual(digest, hashlib.blake2b(chunks.encode()).hexdigest())
+        self.assertNotEqual(digest, hashlib.blake2b(data).hexdigest())
+        shutil.rmtree(d)
+
+    def test_chunk_index_reports_changed_chunks(self):
+        index = ChunkIndex(self.e)
+        self.assertIsNone(index.update("f", ["a", "b", "c"]))
+        self.assertEqual(index.update("f", ["a", "x", "c", "d"]), [1, 3])
+        index.save()
+        index = ChunkIndex(self.e)
+        self.assertEqual(index.get("f"), ["a", "x", "c", "d"])
+        self.assertIsNone(index.get("f", "blake2b"))
+
+    def test_digest_cache_evicts_oldest(self):
+        cache = DigestCache(self.e, max_entries=1)
+        old, new = os.stat("filesync.conf"), os.stat("test.py")
+        cache.put(old, "old")
+        cache.put(new, "new")
+        cache.save()
+        cache = DigestCache(self.e)
+        self.assertIsNone(cache.get(old))
+        self.assertEqual(cache.get(new), "new")
+
     def test_ensure_required_sections_fake_conf_file(self):
         self.assertFalse(ensure_required_sections(self.f))
 
@@ -55,11 +171,346 @@ class FileSyncTestCase(TestCase):
         os.remove(f)
         self.assertTrue(fs)
 
+    def test_file_sync_batch_push(self):
+        f1, f2 = mkstemp()[1], mkstemp()[1]
+        fs = file_sync_batch("push", {"one": (f1, f1), "two": (f2, f2)}, host=self.h)
+        os.remove(f1)
+        os.remove(f2)
+        self.assertEqual(fs, {"one": True, "two": True})
+
+    def test_file_sync_batch_fake_file(self):
+        f = mkstemp()[1]
+        fs = file_sync_batch("push", {"real": (f, f), "fake": ("/tmp/idkjaja", "/tmp/idkjaja")},
+                             host=self.h)
+        os.remove(f)
+        self.assertTrue(fs["real"])
+        self.assertTrue("idkjaja" in fs["fake"])
+
+    def test_rsync_results_match_exact_paths(self):
+        err = (b'rsync: [sender] link_stat "/saves/a.srm2" failed: No such file or directory (2)\n'
+               b'rsync: [receiver] mkstemp "/dest/snes/.b.srm.Xy12Ab" failed: Permission denied\n')
+        results = _rsync_results(23, [b"", err], {"a": "saves/a.srm", "a2": "saves/a.srm2",
+                                                  "b": "snes/b.srm"})
+        self.assertIs(results["a"], True)
+        self.assertIn("link_stat", results["a2"])
+        self.assertIn("mkstemp", results["b"])
+
+    def test_agent_write_and_read(self):
+        agent = get_agent(self.h)
+        agent.call("write", b"foobar", files=[[self.e, 6, 0o600, 10 ** 18]])
+        resp, data = agent.call("read", paths=[self.e, "/tmp/idkjaja"])
+        self.assertEqual(data, b"foobar")
+        self.assertIn("/tmp/idkjaja", resp["errors"])
+        self.assertEqual(os.stat(self.e).st_mtime_ns, 10 ** 18)
+
+    def test_agent_serve_streams(self):
+        # Importing the agent must not touch stdin, which may be closed or replaced
+        with patch("sys.stdin", None), patch("sys.stdout", None):
+            importlib.reload(agent)
+        stdin, stdout = io.BytesIO(), io.BytesIO()
+        agent.send(stdin, {"op": "stat", "paths": [self.e]})
+        stdin.seek(0)
+        agent.serve(stdin, stdout)
+        stdout.seek(0)
+        resp, _ = agent.recv(stdout)
+        self.assertEqual(list(resp["results"]), [self.e])
+
+    def test_get_agent_does_not_wait_on_other_hosts(self):
+        slow = threading.Event()
+
+        def _start(host):
+            if host == "slow":
+                slow.wait(5)
+            return MagicMock(host=host)
+
+        with patch("fs.fs.RemoteAgent", side_effect=_start):
+            thread = threading.Thread(target=get_agent, args=("slow",))
+            thread.start()
+            self.assertEqual(get_agent("fast").host, "fast")
+            self.assertFalse(slow.is_set())
+            slow.set()
+            thread.join()
+            self.assertEqual(get_agent("slow").host, "slow")
+        stop_agents()
+
+    def test_local_sha_batch(self):
+        digests, errors = local_sha_batch(["filesync.conf", "idkjaja"])
+        self.assertEqual(
+            digests["filesync.conf"],
+            '315dc23cbcad8094dce9eec33fab67ff6cfc691e40bbae5cd4a9f3a2bf7c53ff')
+        self.assertIn("idkjaja", errors)
+
+    def test_remote_sha_batch_localhost(self):
+        annoying_file = '/tmp/s p a ! c 3 s ? [ ] ) ( .txt'
+        os.system("touch '{}'".format(annoying_file))
+        digests, errors = remote_sha_batch([annoying_file, "/tmp/idkjaja"], self.h)
+        os.remove(annoying_file)
+        self.assertEqual(
+            digests[annoying_file],
+            'e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855')
+        self.assertIn("/tmp/idkjaja", errors)
+
+    def test_file_sync_small_push(self):
+        d = mkdtemp()
+        annoying_file = '/tmp/s p a ! c 3 s ? [ ] ) ( .txt'
+        with open(annoying_file, "w") as f:
+            f.write("foo")
+        os.utime(annoying_file, (1000000000, 1000000000))
+        dest = os.path.join(d, os.path.basename(annoying_file))
+        fs = file_sync_small("push", {"annoying": (annoying_file, dest),
+                                      "fake": ("/tmp/idkjaja", "/tmp/idkjaja")}, host=self.h)
+        self.assertTrue(fs["annoying"] is True)
+        self.assertTrue("idkjaja" in fs["fake"] or "No such file" in fs["fake"])
+        self.assertEqual(os.stat(dest).st_mtime, 1000000000)
+        os.remove(annoying_file)
+        shutil.rmtree(d)
+
+    def test_file_sync_native_push_and_pull(self):
+        d = mkdtemp()
+        local, remote = os.path.join(d, "local.sav"), os.path.join(d, "remote dir", "r.sav")
+        data = os.urandom(200000)
+        with open(local, "wb") as f:
+            f.write(data)
+        os.utime(local, (1000000000, 1000000000))
+        self.assertTrue(file_sync_native("push", local, remote, self.h))
+        with open(remote, "rb") as f:
+            self.assertEqual(f.read(), data)
+        self.assertEqual(os.stat(remote).st_mtime, 1000000000)
+        with open(remote, "r+b") as f:
+            f.seek(100000)
+            f.write(b"changed")
+        self.assertTrue(file_sync_native("pull", local, remote, self.h))
+        with open(local, "rb") as f:
+            self.assertEqual(f.read(), data[:100000] + b"changed" + data[100007:])
+        self.assertEqual(sorted(os.listdir(d)), ["local.sav", "remote dir"])
+        shutil.rmtree(d)
+
+    def test_delta_sends_only_changed_blocks(self):
+        d = mkdtemp()
+        basis, src = os.path.join(d, "basis"), os.path.join(d, "src")
+        data = os.urandom(1 << 20)
+        changed = data[:5000] + b"inserted" + data[5000:]
+        for path, content in ((basis, data), (src, changed)):
+            with open(path, "wb") as f:
+                f.write(content)
+        sig = agent.signature(basis)
+        patch, literal = agent.Patch(basis, sig["block"]), 0
+        for ops, payload, final in agent.delta(src, sig["block"], sig["sums"]):
+            literal += len(payload)
+            patch.apply(ops, payload)
+            if final:
+                patch.finish(**final)
+        self.assertLess(literal, 3 * sig["block"])
+        with open(basis, "rb") as f:
+            self.assertEqual(f.read(), changed)
+        shutil.rmtree(d)
+
+    def test_file_sync_native_missing_source(self):
+        d = mkdtemp()
+        dest = os.path.join(d, "dest")
+        with open(dest, "w") as f:
+            f.write("keep")
+        fs = file_sync_native("push", os.path.join(d, "idkjaja"), dest, self.h)
+        self.assertTrue("idkjaja" in fs or "No such file" in fs)
+        self.assertEqual(os.listdir(d), ["dest"])
+        with open(dest) as f:
+            self.assertEqual(f.read(), "keep")
+        shutil.rmtree(d)
+
+    def _interrupted_resumable_push(self, d: str) -> tuple:
+        "Start pushing a three chunk file into 'd', cut off after its first chunk."
+        src, dest = os.path.join(d, "disk.img"), os.path.join(d, "remote", "disk.img")
+        with open(src, "wb") as f:
+            f.write(os.urandom(20 << 20))
+        fetches = []
+
+        def _cut_off(host, op, *args, **kwargs):
+            if op == "fetch":
+                fetches.append(kwargs["index"])
+                if len(fetches) == 2:
+                    raise RemoteAgentException("Connection closed")
+            return _agent_call(host, op, *args, **kwargs)
+        with patch("fs.fs._agent_call", side_effect=_cut_off):
+            self.assertEqual(file_sync_resumable("push", src, dest, self.h), "Connection closed")
+        self.assertFalse(os.path.exists(dest))
+        return src, dest
+
+    def test_file_sync_resumable_push_and_pull(self):
+        d = mkdtemp()
+        local, remote = os.path.join(d, "local.img"), os.path.join(d, "remote", "remote.img")
+        with open(local, "wb") as f:
+            f.write(os.urandom(100000))
+        os.utime(local, (1000000000, 1000000000))
+        self.assertIs(file_sync_resumable("push", local, remote, self.h), True)
+        self.assertEqual(os.listdir(os.path.dirname(remote)), ["remote.img"])
+        self.assertEqual(os.stat(remote).st_mtime, 1000000000)
+        os.remove(local)
+        self.assertIs(file_sync_resumable("pull", local, remote, self.h, compress=1), True)
+        with open(local, "rb") as a, open(remote, "rb") as b:
+            self.assertEqual(a.read(), b.read())
+        shutil.rmtree(d)
+
+    def test_file_sync_resumable_continues(self):
+        d = mkdtemp()
+        src, dest = self._interrupted_resumable_push(d)
+        fetches = []
+
+        def _count(host, op, *args, **kwargs):
+            if op == "fetch":
+                fetches.append(kwargs["index"])
+            return _agent_call(host, op, *args, **kwargs)
+        with patch("fs.fs._agent_call", side_effect=_count):
+            self.assertIs(file_sync_resumable("push", src, dest, self.h), True)
+        self.assertEqual(fetches, [1, 2])
+        with open(src, "rb") as a, open(dest, "rb") as b:
+            self.assertEqual(a.read(), b.read())
+        self.assertEqual(os.listdir(os.path.dirname(dest)), ["disk.img"])
+        shutil.rmtree(d)
+
+    def test_file_sync_resumable_sends_changed_chunks(self):
+        d = mkdtemp()
+        src, dest = os.path.join(d, "disk.img"), os.path.join(d, "remote", "disk.img")
+        with open(src, "wb") as f:
+            f.write(os.urandom(20 << 20))
+        self.assertIs(file_sync_resumable("push", src, dest, self.h), True)
+        with open(src, "r+b") as f:
+            f.seek(9 << 20)
+            f.write(b"changed")
+        fetches = []
+
+        def _count(host, op, *args, **kwargs):
+            if op == "fetch":
+                fetches.append(kwargs["index"])
+            return _agent_call(host, op, *args, **kwargs)
+        with patch("fs.fs._agent_call", side_effect=_count):
+            self.assertIs(file_sync_resumable("push", src, dest, self.h), True)
+        self.assertEqual(fetches, [1])
+        with open(src, "rb") as a, open(dest, "rb") as b:
+            self.assertEqual(a.read(), b.read())
+        self.assertEqual(os.listdir(os.path.dirname(dest)), ["disk.img"])
+        shutil.rmtree(d)
+
+    def test_file_sync_resumable_rejects_damaged_partial(self):
+        d = mkdtemp()
+        src, dest = self._interrupted_resumable_push(d)
+        with open(os.path.join(d, "remote", ".disk.img.filesync-partial"), "r+b") as f:
+            f.write(b"damaged")
+        self.assertIn("does not match", file_sync_resumable("push", src, dest, self.h))
+        self.assertEqual(os.listdir(os.path.dirname(dest)), [])
+        self.assertIs(file_sync_resumable("push", src, dest, self.h), True)
+        shutil.rmtree(d)
+
+    def test_file_sync_small_pull(self):
+        d = mkdtemp()
+        dest = os.path.join(d, "filesync.conf")
+        fs = file_sync_small("pull", {"conf": (dest, os.path.abspath("filesync.conf"))},
+                             host=self.h)
+        self.assertTrue(fs["conf"] is True)
+        self.assertEqual(check_file_sha(dest).split()[0], check_file_sha("filesync.conf").split()[0])
+        shutil.rmtree(d)
+
+    def test_sync_files_sends_small_symlinks_with_rsync(self):
+        a, b = mkdtemp(), mkdtemp()
+        for d in (a, b):
+            with open(os.path.join(d, "save"), "w") as f:
+                f.write("foo")
+        os.symlink("save", os.path.join(a, "link"))
+        os.symlink("save", os.path.join(b, "back"))
+        c = ConfigParser()
+        c.read_dict({"global": {"remote host": self.h},
+                     "local": {"link": os.path.join(a, "link"), "back": os.path.join(a, "back")},
+                     "remote": {"link": os.path.join(b, "link"), "back": os.path.join(b, "back")}})
+        packed = agent.pack_archive([os.path.join(a, "link")])[0]
+        self.assertEqual(packed["skipped"], [os.path.join(a, "link")])
+        with patch("fs.fs.file_sync_batch", wraps=file_sync_batch) as rsync_mock:
+            self.assertEqual(sync_files(c, "push", keys={"link"}, batch=True), {"link": True})
+            self.assertEqual(sync_files(c, "pull", keys={"back"}, batch=True), {"back": True})
+        # Both links went to rsync, which keeps them as links with -a
+        self.assertEqual([set(call[0][1]) for call in rsync_mock.call_args_list],
+                         [{"link"}, {"back"}])
+        shutil.rmtree(a)
+        shutil.rmtree(b)
+
+    def test_file_sync_small_pull_groups(self):
+        d = mkdtemp()
+        src = os.path.abspath("filesync.conf")
+        entries = {k: (os.path.join(d, k, "filesync.conf"), src) for k in ("a", "b", "c")}
+        sizes = {k: 10 for k in entries}
+        with patch("fs.fs.SMALL_ARCHIVE_SIZE", 25):
+            self.assertEqual([len(g) for g in _archive_groups("pull", entries, sizes)], [2, 1])
+        with patch("fs.fs.SMALL_ARCHIVE_FILES", 1):
+            self.assertEqual([len(g) for g in _archive_groups("pull", entries, sizes)],
+                             [1, 1, 1])
+        # The same source pulled to several places lands in each of them
+        for k in entries:
+            os.mkdir(os.path.join(d, k))
+        results = file_sync_small("pull", entries, self.h, sizes=sizes)
+        self.assertEqual(results, {k: True for k in entries})
+        for k in entries:
+            with open(os.path.join(d, k, "filesync.conf")) as f, open(src) as g:
+                self.assertEqual(f.read(), g.read())
+        shutil.rmtree(d)
+
     def test_make_backup_file(self):
         backup = make_backup_file("filesync.conf")
         self.assertTrue(os.path.isfile(backup))
         os.remove(backup)
 
+    def test_make_backup_file_shares_content(self):
+        f = mkstemp()[1]
+        first, second = make_backup_file(self.e), make_backup_file(f)
+        self.assertEqual(os.stat(first).st_ino, os.stat(second).st_ino)
+        os.remove(first)
+        os.remove(second)
+        os.remove(f)
+
+    def test_list_and_restore_backup(self):
+        with open(self.e, "w") as f:
+            f.write("foo")
+        backup = make_backup_file(self.e, key="e")
+        with open(self.e, "w") as f:
+            f.write("bar")
+        version = list_backups(self.e)[-1]
+        self.assertEqual(version["key"], "e")
+        self.assertTrue(restore_backup(self.e, version["digest"]))
+        with open(self.e) as f:
+            self.assertEqual(f.read(), "foo")
+        os.remove(backup)
+
+    def test_backups_in_the_same_second_keep_both_versions(self):
+        suffix = "-2020-01-01-00-00-00"
+        with open(self.e, "w") as f:
+            f.write("foo")
+        first = agent.backup(self.e, suffix, self.store)
+        with open(self.e, "w") as f:
+            f.write("barbaz")
+        second = agent.backup(self.e, suffix, self.store)
+        self.assertEqual(second, first + ".1")
+        for path, content in ((first, "foo"), (second, "barbaz")):
+            with open(path) as f:
+                self.assertEqual(f.read(), content)
+        for version, content in zip(list_backups(self.e), ("foo", "barbaz")):
+            obj = os.path.join(self.store, "objects", version["digest"][:2], version["digest"])
+            with open(obj) as f:
+                self.assertEqual(f.read(), content)
+        os.remove(first)
+        os.remove(second)
+
+    def test_make_backup_file_on_another_filesystem(self):
+        with open(self.e, "w") as f:
+            f.write("foo")
+        with patch.object(agent, "same_device", return_value=False):
+            backup = make_backup_file(self.e)
+        self.assertFalse(os.path.exists(os.path.join(self.store, "objects")))
+        version = list_backups(self.e)[-1]
+        self.assertFalse(version["stored"])
+        with open(self.e, "w") as f:
+            f.write("bar")
+        self.assertTrue(restore_backup(self.e, version["digest"]))
+        with open(self.e) as f:
+            self.assertEqual(f.read(), "foo")
+        os.remove(backup)
+
     def test_make_backup_file_fake_file(self):
         backup = make_backup_file("idkjaja")
         self.assertTrue(False in backup)
@@ -122,6 +573,516 @@ class FileSyncTestCase(TestCase):
     def test_parse_args_remote_file_real(self):
         pass
 
+    def test_ssh_command_uses_master(self):
+        stop_ssh_masters()
+        with patch("fs.fs._run", wraps=_run) as run_mock:
+            path = start_ssh_master(self.h)
+        self.assertIn("ControlPersist=60", run_mock.call_args[0][0])
+        self.assertIn("ControlPath={}".format(path), ssh_command(self.h))
+        stop_ssh_masters()
+        self.assertFalse(os.path.exists(path))
+
+    def test_sync_files_jobs(self):
+        f1, f2 = mkstemp()[1], mkstemp()[1]
+        c = ConfigParser()
+        c.read_dict({"global": {"remote host": self.h},
+                     "local": {"one": f1, "two": f2, "fake": "/tmp/idkjaja"},
+                     "remote": {}})
+        results = sync_files(c, "push", jobs=2)
+        os.remove(f1)
+        os.remove(f2)
+        self.assertTrue(results["one"] is True and results["two"] is True)
+        self.assertTrue("idkjaja" in results["fake"])
+
+    def test_manifest_unchanged(self):
+        m = Manifest(self.e)
+        m.record("one", "/a", "/b", [1, 2], [1, 2], None)
+        m = Manifest(self.e)
+        self.assertTrue(m.unchanged("one", "/a", "/b", [1, 2], [1, 2]))
+        self.assertFalse(m.unchanged("one", "/a", "/b", [1, 3], [1, 2]))
+        self.assertFalse(m.unchanged("one", "/a", "/c", [1, 2], [1, 2]))
+        self.assertFalse(m.unchanged("two", "/a", "/b", [1, 2], [1, 2]))
+
+    def test_remote_stat_batch_localhost(self):
+        stats, errors = remote_stat_batch([os.path.abspath("filesync.conf"), "/tmp/idkjaja"],
+                                          self.h)
+        self.assertEqual(stats[os.path.abspath("filesync.conf")][0],
+                         os.path.getsize("filesync.conf"))
+        self.assertIn("/tmp/idkjaja", errors)
+
+    def test_manifest_distrusts_same_second_changes(self):
+        m = Manifest(self.e)
+        now = time.time_ns()
+        m.record("one", "/a", "/b", [1, now], [1, now], None)
+        # Rewritten in the second it was recorded in; the size and mtime prove nothing
+        self.assertFalse(m.unchanged("one", "/a", "/b", [1, now], [1, now]))
+        self.assertEqual(classify_change(m.entries["one"], [1, now], [1, now]), "conflict")
+        old = now - 5 * 10 ** 9
+        m.record("one", "/a", "/b", [1, old], [1, old], None)
+        self.assertTrue(m.unchanged("one", "/a", "/b", [1, old], [1, old]))
+        self.assertFalse(m.unchanged("one", "/a", "/b", [1, old + 1], [1, old]))
+
+    def test_sync_files_skips_unchanged(self):
+        f = mkstemp()[1]
+        os.utime(f, (1000000000, 1000000000))
+        c = ConfigParser()
+        c.read_dict({"global": {"remote host": self.h}, "local": {"one": f}, "remote": {}})
+        m = Manifest(self.e)
+        sync_files(c, "push", manifest=m)
+        with patch("fs.fs.file_sync") as file_sync_mock:
+            sync_files(c, "push", manifest=m)
+        os.remove(f)
+        self.assertFalse(file_sync_mock.called)
+        self.assertIn("one", m.entries)
+
+    def test_sync_hosts_shares_local_files(self):
+        f = mkstemp()[1]
+        d = mkdtemp()
+        c = ConfigParser()
+        c.read_dict({"global": {"remote hosts": "localhost, 127.0.0.1"}, "local": {"one": f},
+                     "remote": {"one": os.path.join(d, "one")}})
+        manifests = {h: Manifest(os.path.join(d, h + ".json")) for h in _get_remote_hosts(c)}
+        with patch("fs.fs.hash_local_file", return_value="0" * 64) as hash_mock:
+            results = sync_hosts(c, "push", _get_remote_hosts(c), manifests=manifests)
+        os.remove(f)
+        shutil.rmtree(d)
+        self.assertEqual(results, {"localhost": {"one": True}, "127.0.0.1": {"one": True}})
+        self.assertEqual(hash_mock.call_count, 1)
+        self.assertIn("one", manifests["127.0.0.1"].entries)
+
+    def test_pull_from_several_hosts_dies(self):
+        with patch("sys.stderr"), self.assertRaises(SystemExit):
+            parse_args(["-c", "filesync.conf", "--pull", "-H", "one", "-H", "two"])
+
+    def test_tree_spec(self):
+        self.assertEqual(_tree_spec("glob:/saves/**/*.srm"), ("/saves", ["**", "*.srm"]))
+        self.assertEqual(_tree_spec("/saves/snes/"), ("/saves/snes", None))
+        self.assertIsNone(_tree_spec("/saves/WWF No Mercy (U) (V1.0) [!].mpk"))
+
+    def _make_tree(self) -> str:
+        d = mkdtemp()
+        os.makedirs(os.path.join(d, "snes", "deep"))
+        for name in ("a.srm", "b.txt", "snes/c.srm", "snes/deep/d.srm"):
+            with open(os.path.join(d, name), "w") as f:
+                f.write(name)
+            # Old enough that a manifest can trust the mtime
+            os.utime(os.path.join(d, name), (1500000000, 1500000000))
+        return d
+
+    def test_walk_tree_local_and_remote(self):
+        d = self._make_tree()
+        local = sorted(f[0] for f in walk_tree(d, ["**", "*.srm"]))
+        with patch("fs.fs.SCAN_PAGE", 2):
+            remote = sorted(f[0] for f in walk_tree(d, ["snes", "*"], host=self.h))
+        shutil.rmtree(d)
+        self.assertEqual(local, ["a.srm", "snes/c.srm", "snes/deep/d.srm"])
+        self.assertEqual(remote, ["snes/c.srm"])
+
+    def test_sync_tree_sends_only_changed_files(self):
+        src, dest, state = self._make_tree(), mkdtemp(), mkdtemp()
+        m = TreeManifest(os.path.join(state, "tree.json"), src, dest)
+        self.assertTrue(sync_tree("push", src + "/", dest + "/", self.h, m))
+        self.assertTrue(os.path.isfile(os.path.join(dest, "snes", "deep", "d.srm")))
+        os.utime(os.path.join(src, "snes", "c.srm"), (1000000000, 1000000000))
+        m = TreeManifest(os.path.join(state, "tree.json"), src, dest)
+        with patch("fs.fs.file_sync_tree", return_value={"snes/c.srm": True}) as send_mock:
+            sync_tree("push", src + "/", dest + "/", self.h, m)
+        for d in (src, dest, state):
+            shutil.rmtree(d)
+        send_mock.assert_called_once_with("push", src, dest, ["snes/c.srm"], self.h, "rsync",
+                                          "none")
+
+    def test_tree_manifest_prunes_per_directory(self):
+        src, dest, state = self._make_tree(), mkdtemp(), mkdtemp()
+        m = TreeManifest(os.path.join(state, "tree"), src, dest)
+        self.assertTrue(sync_tree("push", src + "/", dest + "/", self.h, m))
+        self.assertEqual(len(os.listdir(m.path)), 3)
+        self.assertEqual(m.load("snes"), ({"c.srm": [10, 1500000000 * 10 ** 9]}, ["deep"]))
+        shutil.rmtree(os.path.join(src, "snes", "deep"))
+        os.unlink(os.path.join(src, "b.txt"))
+        with patch("fs.fs.file_sync_tree") as send_mock:
+            self.assertTrue(sync_tree("push", src + "/", dest + "/", self.h, m))
+        send_mock.assert_not_called()
+        self.assertEqual(sorted(m.load("")[0]), ["a.srm"])
+        self.assertEqual(m.load("snes")[1], [])
+        self.assertEqual(len(os.listdir(m.path)), 2)
+        for d in (src, dest, state):
+            shutil.rmtree(d)
+
+    def test_schedule_transfers(self):
+        sizes = {"big": 1 << 30, "save": 512, "state": 4096, "iso": 1 << 31, "gone": None}
+        small, large = schedule_transfers(sizes, {"state": 1, "iso": 5}, 1 << 26)
+        self.assertEqual(small, ["state", "gone", "save"])
+        self.assertEqual(large, ["iso", "big"])
+
+    def test_sync_files_large_lane_bwlimit(self):
+        f = mkstemp()[1]
+        with open(f, "wb") as big:
+            big.truncate(4096)
+        c = ConfigParser()
+        c.read_dict({"global": {"remote host": self.h}, "local": {"big": f, "small": self.e},
+                     "remote": {}})
+        with patch("fs.fs.file_sync", return_value=True) as file_sync_mock:
+            sync_files(c, "push", large_file_size=1024, bwlimit="1m", compress={"big": 0})
+        os.remove(f)
+        file_sync_mock.assert_any_call("push", f, f, self.h, "1m", 0, False)
+        file_sync_mock.assert_any_call("push", self.e, self.e, self.h, None, 0, False)
+
+    def test_compression_level(self):
+        ratios = {1: 0.3, 6: 0.25}
+        self.assertEqual(compression_level("save.srm", ratios, rate=1 << 20), 6)
+        self.assertEqual(compression_level("save.srm", ratios, rate=1 << 27), 0)
+        self.assertEqual(compression_level("save.srm", ratios, rate=1 << 24), 1)
+        self.assertEqual(compression_level("save.srm", {1: 0.99, 6: 0.98}, rate=1 << 20), 0)
+        self.assertEqual(compression_level("game.zip", ratios, rate=1 << 20), 0)
+
+    def test_sync_files_compression(self):
+        d = mkdtemp()
+        text, packed = os.path.join(d, "save.srm"), os.path.join(d, "saves.7z")
+        for path in (text, packed):
+            with open(path, "wb") as f:
+                f.write(b"\0" * 4096)
+        c = ConfigParser()
+        c.read_dict({"global": {"remote host": self.h, "compress": "auto"},
+                     "local": {"text": text, "packed": packed, "fixed": self.e},
+                     "remote": {}, "compress": {"fixed": "9"}})
+        with patch("fs.fs.file_sync", return_value=True) as file_sync_mock:
+            sync_files(c, "push", compress=_get_compress(c))
+        shutil.rmtree(d)
+        file_sync_mock.assert_any_call("push", text, text, self.h, None, 1, False)
+        file_sync_mock.assert_any_call("push", packed, packed, self.h, None, 0, False)
+        file_sync_mock.assert_any_call("push", self.e, self.e, self.h, None, 9, False)
+
+    def test_file_sync_native_compressed(self):
+        d = mkdtemp()
+        src, dest = os.path.join(d, "src"), os.path.join(d, "dest")
+        with open(src, "wb") as f:
+            f.write(b"save data " * 50000)
+        with patch("fs.fs._STATS", RunStats()) as stats:
+            self.assertTrue(file_sync_native("push", src, dest, self.h, compress=6))
+        with open(src, "rb") as a, open(dest, "rb") as b:
+            self.assertEqual(a.read(), b.read())
+        self.assertLess(stats.counters["delta literal bytes"], 50000)
+        shutil.rmtree(d)
+
+    def test_classify_change(self):
+        base = {"local meta": [1, 10], "remote meta": [1, 10]}
+        self.assertEqual(classify_change(base, [1, 10], [1, 10]), "unchanged")
+        self.assertEqual(classify_change(base, [2, 20], [1, 10]), "push")
+        self.assertEqual(classify_change(base, [1, 10], [2, 20]), "pull")
+        self.assertEqual(classify_change(base, [2, 20], [3, 30]), "conflict")
+        self.assertEqual(classify_change(base, [2, 20], [2, 30], "a" * 64, "a" * 64), "same")
+        self.assertEqual(classify_change(None, [2, 20], [3, 30], "a" * 64, "b" * 64), "conflict")
+        self.assertEqual(classify_change(None, None, [3, 30]), "pull")
+        self.assertEqual(classify_change(base, None, None), "missing")
+
+    def test_sync_bidirectional(self):
+        a, b = mkdtemp(), mkdtemp()
+        for d, name in ((a, "one"), (b, "two"), (a, "three"), (b, "three")):
+            with open(os.path.join(d, name), "w") as f:
+                f.write(d)
+        c = ConfigParser()
+        c.read_dict({"global": {"remote host": self.h},
+                     "local": {k: os.path.join(a, k) for k in ("one", "two", "three")},
+                     "remote": {k: os.path.join(b, k) for k in ("one", "two", "three")}})
+        results = sync_bidirectional(c, manifest=Manifest(self.e))
+        self.assertTrue(os.path.isfile(os.path.join(b, "one")))
+        self.assertTrue(os.path.isfile(os.path.join(a, "two")))
+        with open(os.path.join(a, "three")) as f:
+            self.assertEqual(f.read(), a)
+        shutil.rmtree(a)
+        shutil.rmtree(b)
+        self.assertTrue(results["one"] is True and results["two"] is True)
+        self.assertIn("Conflict", results["three"])
+
+    def test_sync_bidirectional_needs_remote_metadata(self):
+        a, b = mkdtemp(), mkdtemp()
+        for d in (a, b):
+            with open(os.path.join(d, "one"), "w") as f:
+                f.write(d)
+        c = ConfigParser()
+        c.read_dict({"global": {"remote host": self.h},
+                     "local": {"one": os.path.join(a, "one"), "long": "/tmp/" + "x" * 300},
+                     "remote": {"one": os.path.join(b, "one"), "long": "/tmp/" + "x" * 300}})
+        with patch("fs.fs.remote_stat_batch", side_effect=CheckFileAgeException):
+            results = sync_bidirectional(c, manifest=Manifest(self.e))
+        self.assertIn("Unable to stat", results["one"])
+        with open(os.path.join(b, "one")) as f:
+            self.assertEqual(f.read(), b)
+        results = sync_bidirectional(c, manifest=Manifest(self.e))
+        self.assertIn("Unable to stat the remote file", results["long"])
+        shutil.rmtree(a)
+        shutil.rmtree(b)
+
+    def test_make_plan_needs_remote_metadata(self):
+        c = ConfigParser()
+        c.read_dict({"global": {"remote host": self.h},
+                     "local": {"one": self.e, "long": "/tmp/" + "x" * 300},
+                     "remote": {"one": self.e, "long": "/tmp/" + "x" * 300}})
+        with patch("fs.fs.remote_stat_batch", side_effect=CheckFileAgeException), \
+                self.assertRaises(CheckFileAgeException):
+            make_plan(c, "push")
+        plan = make_plan(c, "push")
+        self.assertEqual(plan["entries"]["long"]["action"], "error")
+        self.assertIn("Unable to stat", plan["entries"]["long"]["error"])
+        self.assertEqual(execute_plan(plan), {})
+
+    def test_throughput_rate(self):
+        t = Throughput(self.e)
+        self.assertIsNone(t.rate())
+        t.record(100, 1.0)
+        t.record(300, 1.0)
+        t.record(0, 1.0)
+        self.assertEqual(Throughput(self.e).rate(), 200.0)
+
+    def test_make_plan_and_execute_plan(self):
+        a, b = mkdtemp(), mkdtemp()
+        for d, name in ((a, "one"), (a, "same"), (b, "same")):
+            with open(os.path.join(d, name), "w") as f:
+                f.write("foo")
+        c = ConfigParser()
+        c.read_dict({"global": {"remote host": self.h},
+                     "local": {k: os.path.join(a, k) for k in ("one", "same", "gone")},
+                     "remote": {k: os.path.join(b, k) for k in ("one", "same", "gone")}})
+        plan = make_plan(c, "push", manifest=Manifest(self.e))
+        self.assertEqual({k: e["action"] for k, e in plan["entries"].items()},
+                         {"one": "transfer", "same": "unchanged", "gone": "missing"})
+        self.assertEqual(plan["bytes"], 3)
+        with patch("fs.fs.remote_stat_batch") as stat_mock:
+            results = execute_plan(plan)
+        self.assertFalse(stat_mock.called)
+        self.assertEqual(results, {"one": True})
+        self.assertTrue(os.path.isfile(os.path.join(b, "one")))
+        shutil.rmtree(a)
+        shutil.rmtree(b)
+
+    def _session_conf(self, a: str, b: str, **settings) -> str:
+        c = ConfigParser()
+        c.read_dict({"global": dict({"remote host": self.h}, **settings),
+                     "local": {k: os.path.join(a, k) for k in ("one", "two")},
+                     "remote": {k: os.path.join(b, k) for k in ("one", "two")}})
+        with open(self.e, "w") as f:
+            c.write(f)
+        return self.e
+
+    def test_session_push_and_plan(self):
+        a, b = mkdtemp(), mkdtemp()
+        for name in ("one", "two"):
+            with open(os.path.join(a, name), "w") as f:
+                f.write(name)
+        with Session(self._session_conf(a, b), manifest=False) as session:
+            with patch("fs.fs.print_plan") as print_mock:
+                plans = session.plan(["One"])
+            self.assertFalse(print_mock.called)
+            self.assertEqual([p["host"] for p in plans], [self.h])
+            self.assertEqual({k: e["action"] for k, e in plans[0]["entries"].items()},
+                             {"one": "transfer"})
+            self.assertIn("config", session.stats.phases())
+            self.assertEqual(session.push(["one"]),
+                             {self.h: {"one": {"synced": True, "error": None}}})
+            self.assertNotIn("config", session.stats.phases())
+            self.assertEqual(os.listdir(b), ["one"])
+            results = session.pull()
+        self.assertIs(results[self.h]["one"]["synced"], True)
+        self.assertIs(results[self.h]["two"]["synced"], False)
+        self.assertIsInstance(results[self.h]["two"]["error"], str)
+        shutil.rmtree(a)
+        shutil.rmtree(b)
+
+    def test_session_close_leaves_other_sessions_alone(self):
+        first = Session(self._session_conf("/tmp", "/tmp"), manifest=False)
+        second = Session(self._session_conf("/tmp", "/tmp"), manifest=False)
+        first._agents[self.h], second._agents[self.h] = MagicMock(), MagicMock()
+        remote = second._agents[self.h]
+        first.close()
+        self.assertEqual(first._agents, {})
+        self.assertIs(second._agents[self.h], remote)
+        self.assertFalse(remote.close.called)
+        second.close()
+        self.assertTrue(remote.close.called)
+
+    def test_sessions_in_threads_take_turns(self):
+        sessions = [Session(self._session_conf("/tmp", "/tmp"), manifest=False) for _ in range(2)]
+        entered, seen = threading.Event(), []
+
+        def _sync_hosts(*args, **kwargs):
+            agents = filesync._AGENTS
+            entered.set()
+            time.sleep(0.1)
+            seen.append(agents is filesync._AGENTS)
+            return {}
+        with patch("fs.fs.sync_hosts", side_effect=_sync_hosts):
+            threads = [threading.Thread(target=session.push) for session in sessions]
+            threads[0].start()
+            entered.wait(5)
+            threads[1].start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(seen, [True, True])
+        for session in sessions:
+            session.close()
+
+    def test_session_rejects_bad_config_and_keys(self):
+        with self.assertRaises(SessionException):
+            Session("idkjaja")
+        with self.assertRaises(SessionException):
+            Session(self._session_conf("/tmp", "/tmp", digest="md6"))
+        session = Session(self._session_conf("/tmp", "/tmp"), hosts=["one", "two"],
+                          manifest=False)
+        with self.assertRaises(SessionException):
+            session.push(["three"])
+        with self.assertRaises(SessionException):
+            session.pull()
+
+    def test_commit_flushes_by_durability(self):
+        d = mkdtemp()
+        for durability, fsyncs in (("none", 0), ("batch", 3), ("file", 4)):
+            paths = [os.path.join(d, name) for name in ("one", "two")]
+            staged = {path: agent.stage_file(path, durability.encode()) for path in paths}
+            with patch("os.fsync") as fsync_mock:
+                agent.commit(staged, durability)
+            self.assertEqual(fsync_mock.call_count, fsyncs)
+            for path in paths:
+                with open(path) as f:
+                    self.assertEqual(f.read(), durability)
+        self.assertEqual(sorted(os.listdir(d)), ["one", "two"])
+        found = _agent_call(None, "fsync", paths=[paths[0], os.path.join(d, "gone")])[0]
+        self.assertEqual(list(found["results"]), [paths[0]])
+        self.assertEqual(list(found["errors"]), [os.path.join(d, "gone")])
+        shutil.rmtree(d)
+
+    def test_sync_files_flushes_received_files(self):
+        a, b = mkdtemp(), mkdtemp()
+        with open(os.path.join(a, "one"), "w") as f:
+            f.write("foo")
+        c = ConfigParser()
+        c.read_dict({"global": {"remote host": self.h}, "local": {"one": os.path.join(a, "one")},
+                     "remote": {"one": os.path.join(b, "one")}})
+        with patch("fs.fs.flush_received", return_value={}) as flush_mock:
+            self.assertEqual(sync_files(c, "push", durability="none"), {"one": True})
+        self.assertFalse(flush_mock.called)
+        with patch("fs.fs.flush_received",
+                   return_value={os.path.join(b, "one"): "EIO"}) as flush_mock:
+            with self.assertLogs(level=logging.WARN) as logs:
+                results = sync_files(c, "push", durability="batch")
+        flush_mock.assert_called_once_with("push", [os.path.join(b, "one")], self.h)
+        self.assertEqual(results, {"one": True})
+        self.assertIn("unable to flush to disk: EIO", logs.output[0])
+        self.assertEqual(sync_files(c, "push", durability="file", transfer="native"),
+                         {"one": True})
+        shutil.rmtree(a)
+        shutil.rmtree(b)
+
+    def test_flush_received_without_agent_warns(self):
+        # Without the agent, nothing is flushed; no system-wide sync is run
+        paths = ["/tmp/one", "/tmp/two"]
+        with patch("fs.fs._agent_call", side_effect=RemoteAgentException("no python3")), \
+                patch("fs.fs._run") as run_mock:
+            self.assertEqual(flush_received("push", paths, self.h),
+                             {"/tmp/one": "no python3", "/tmp/two": "no python3"})
+        run_mock.assert_not_called()
+
+    def test_inotify_watcher(self):
+        watcher = InotifyWatcher({"one": self.e, "two": "filesync.conf"})
+        with open(self.e, "w") as f:
+            f.write("foo")
+        self.assertEqual(watcher.wait(1), {"one"})
+        self.assertEqual(watcher.wait(0), set())
+        watcher.close()
+
+    def test_inotify_watcher_watches_trees(self):
+        d = mkdtemp()
+        os.mkdir(os.path.join(d, "snes"))
+        watcher = InotifyWatcher({"tree": d}, {"tree": None})
+        with open(os.path.join(d, "snes", "a.srm"), "w") as f:
+            f.write("foo")
+        self.assertEqual(watcher.wait(1), {"tree"})
+        os.mkdir(os.path.join(d, "n64"))
+        self.assertEqual(watcher.wait(1), {"tree"})
+        with open(os.path.join(d, "n64", "b.srm"), "w") as f:
+            f.write("foo")
+        self.assertEqual(watcher.wait(1), {"tree"})
+        watcher.close()
+        shutil.rmtree(d)
+
+    def test_polling_watcher_walks_trees(self):
+        d = mkdtemp()
+        os.mkdir(os.path.join(d, "snes"))
+        watcher = PollingWatcher({"tree": d}, interval=0.01, trees={"tree": ["**", "*.srm"]})
+        with open(os.path.join(d, "snes", "a.txt"), "w") as f:
+            f.write("foo")
+        self.assertEqual(watcher.wait(None), set())
+        with open(os.path.join(d, "snes", "a.srm"), "w") as f:
+            f.write("foo")
+        self.assertEqual(watcher.wait(None), {"tree"})
+        shutil.rmtree(d)
+
+    def test_sync_tree_rejects_relative_globs(self):
+        self.assertIn("absolute path", sync_tree("push", "glob:*.srm", "/tmp/idkjaja", self.h))
+
+    def test_polling_watcher(self):
+        watcher = PollingWatcher({"one": self.e, "two": "filesync.conf"}, interval=0.01)
+        os.utime(self.e, (1000000000, 1000000000))
+        self.assertEqual(watcher.wait(None), {"one"})
+        self.assertEqual(watcher.wait(None), set())
+
+    def test_run_stats_spans_and_processes(self):
+        stats = RunStats()
+        with stats.span("transfer", "one"):
+            pass
+        with stats.span("transfer", "two"):
+            pass
+        stats.process(["/usr/bin/rsync", "-a"], 0.5)
+        stats.process(["rsync"], 0.25)
+        d = stats.as_dict()
+        self.assertEqual(d["phases"]["transfer"]["count"], 2)
+        self.assertEqual([s["key"] for s in d["spans"]], ["one", "two"])
+        self.assertEqual(d["processes"]["rsync"], {"count": 2, "seconds": 0.75})
+        self.assertTrue(any(line.startswith("[rsync]") for line in stats.summary()))
+
+    def test_run_stats_rsync_output(self):
+        stats = RunStats()
+        out = "Number of regular files transferred: 1\nTotal bytes sent: 1,234\n"
+        stats.rsync_output(out)
+        stats.rsync_output(out)
+        self.assertEqual(stats.rsync, {"files transferred": 2, "bytes sent": 2468})
+
+    def test_run_counts_processes(self):
+        with patch("fs.fs._STATS", RunStats()) as stats:
+            returncode, out, err = _run(["echo", "foo"])
+        self.assertEqual((returncode, out), (0, b"foo\n"))
+        self.assertEqual(stats.processes["echo"]["count"], 1)
+
+    def test_emit_log_skips_formatting_suppressed_messages(self):
+        class Exploding:
+            def __format__(self, spec):
+                raise AssertionError("formatted")
+        with patch("fs.fs.logging.getLogger") as get_logger:
+            get_logger.return_value.isEnabledFor.return_value = False
+            emit_log("{0}", Exploding(), level=logging.DEBUG)
+
+    def test_get_terminal_dims_without_a_tty(self):
+        with patch("fs.fs._TERMINAL_DIMS", None), \
+                patch("shutil.os.get_terminal_size", side_effect=OSError), \
+                patch.dict(os.environ, {"COLUMNS": "", "LINES": ""}):
+            self.assertEqual(get_terminal_dims(), (80, 24))
+
+    def test_terminal_formatter_shortens_only_on_a_tty(self):
+        record = logging.LogRecord("root", logging.INFO, __file__, 1, "x" * 200, None, None)
+        with patch("fs.fs.get_terminal_dims", return_value=(80, 24)):
+            with patch.object(sys.stdout, "isatty", return_value=False):
+                self.assertEqual(TerminalFormatter("%(message)s").format(record), "x" * 200)
+            with patch.object(sys.stdout, "isatty", return_value=True):
+                self.assertLessEqual(len(TerminalFormatter("%(message)s").format(record)), 79)
+
+    def test_json_lines_formatter(self):
+        record = logging.LogRecord("root", logging.INFO, __file__, 1,
+                                   LogMessage("{0} synced", ("one",), {}), None, None)
+        record.event = {"event": "synced", "key": "one"}
+        line = json.loads(JsonLinesFormatter().format(record))
+        self.assertEqual((line["message"], line["event"], line["key"]),
+                         ("one synced", "synced", "one"))
+
     def test_read_config_file_fake_file(self):
         old_stdout, old_stderr = sys.stdout, sys.stderr
         sys.stdout = open('/dev/null', 'w')